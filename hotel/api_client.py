@@ -0,0 +1,704 @@
+import asyncio
+import contextlib
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+from typing import Callable, Optional
+
+from django.conf import settings
+
+from hotel import metrics
+from hotel.external_api import APIError
+
+"""
+A shared policy for calls to the external API of a PMS: retries with jittered exponential backoff,
+limited by a retry budget, optional hedged requests and a circuit breaker per PMS.
+Every endpoint has a rate limit (token bucket) and an adaptive concurrency limit (AIMD),
+shared by the threads and tasks of the process.
+"""
+
+
+class CircuitOpenError(APIError):
+    """
+    The PMS API failed too often recently, the call was not made.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures. While open, calls are rejected.
+    After `reset_timeout` seconds one trial call is let through: when it succeeds the circuit closes,
+    when it fails the circuit opens again, and when it ends without an outcome (it was cancelled)
+    the next call is the trial.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    # What allow() lets through
+    CALL = "call"
+    TRIAL = "trial"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        # The number of calls rejected so far
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> Optional[str]:
+        """
+        Returns None when the call is rejected, TRIAL for the trial call of a half-open circuit, CALL otherwise.
+        The caller of a trial must end it with record_success(), record_failure() or release_trial().
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return self.CALL
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return self.TRIAL
+            self.rejected += 1
+            return None
+
+    def retry_after(self) -> float:
+        """
+        Seconds until a rejected call can expect to be let through: the rest of the open period,
+        or a whole reset_timeout while a trial call is running. 0 when calls are let through.
+        """
+        with self._lock:
+            if self._state == self.OPEN:
+                return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+            if self._state == self.HALF_OPEN and self._trial_running:
+                return self.reset_timeout
+            return 0.0
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def release_trial(self) -> None:
+        """
+        The trial call ended without an outcome, let the next call be the trial.
+        """
+        with self._lock:
+            self._trial_running = False
+
+
+class RetryBudget:
+    """
+    Limits retries (and hedged requests) to a fraction of the calls, so retries can't multiply
+    the load on a PMS that is struggling. Every call adds `ratio` tokens, every retry costs one.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float = 10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._tokens = max_tokens
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average, and bursts of up to `burst` calls.
+    A caller that takes a token from an empty bucket waits until the token would have been refilled,
+    so waiting callers are served in order.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._refilled_at = time.monotonic()
+        self.waiting = 0
+
+    def _reserve(self) -> float:
+        """
+        Take a token, returns the seconds to wait before using it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            if delay:
+                self.waiting += 1
+            return delay
+
+    def _done_waiting(self, used: bool = True) -> None:
+        with self._lock:
+            self.waiting -= 1
+            if not used:
+                # A caller that was cancelled while waiting gives its token back to the next callers
+                self._tokens += 1
+
+    def acquire(self) -> None:
+        delay = self._reserve()
+        if delay:
+            try:
+                time.sleep(delay)
+            except BaseException:
+                self._done_waiting(used=False)
+                raise
+            self._done_waiting()
+
+    async def aacquire(self) -> None:
+        delay = self._reserve()
+        if delay:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                self._done_waiting(used=False)
+                raise
+            self._done_waiting()
+
+
+class AdaptiveLimit:
+    """
+    Limits the number of calls in flight, and adapts the limit with AIMD (additive increase,
+    multiplicative decrease): every successful call of a saturated limit raises it by 1 / limit, so by about
+    one per round trip. The limit is multiplied by `backoff` on a call slower than `latency_target`, or on a
+    failed call while the recent error rate (a moving average) is above `error_threshold`: APIs that fail
+    now and then whatever the load don't push the limit down.
+    Calls that wait for a slot are served in order, threads and asyncio tasks share the same queue.
+    """
+
+    def __init__(
+        self,
+        initial: float,
+        min_limit: float,
+        max_limit: float,
+        backoff: float = 0.5,
+        latency_target: Optional[float] = None,
+        error_threshold: float = 0.2,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_target = latency_target
+        self.error_threshold = error_threshold
+        # Moving average of failed calls, about the last 20 calls count
+        self.error_rate = 0.0
+        self._lock = threading.Lock()
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._in_flight = 0
+        # threading.Events of waiting threads and futures of waiting tasks, oldest first
+        self._waiters = deque()
+        self._decreased_at = 0.0
+
+    @property
+    def limit(self) -> int:
+        return max(1, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def acquire(self) -> None:
+        with self._lock:
+            if not self._waiters and self._in_flight < self.limit:
+                self._in_flight += 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        # release() takes the slot for us before it sets the event
+        event.wait()
+
+    async def aacquire(self) -> None:
+        with self._lock:
+            if not self._waiters and self._in_flight < self.limit:
+                self._in_flight += 1
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if future in self._waiters:
+                    self._waiters.remove(future)
+                    raise
+            # The slot was handed over already
+            if future.done() and not future.cancelled():
+                self._give_back()
+            raise
+
+    def release(self, latency: float, failed: bool) -> None:
+        """
+        Give back the slot of a call that took `latency` seconds, and adapt the limit.
+        """
+        with self._lock:
+            saturated = self._in_flight >= self.limit or bool(self._waiters)
+            self._in_flight -= 1
+            self.error_rate += 0.05 * (failed - self.error_rate)
+            overloaded = (failed and self.error_rate > self.error_threshold) or (
+                self.latency_target is not None and latency > self.latency_target
+            )
+            if overloaded:
+                # Calls that were in flight together fail together: only back off once per round trip,
+                # for the calls that started after the previous decrease
+                now = time.monotonic()
+                if now - latency >= self._decreased_at:
+                    self._limit = max(self.min_limit, self._limit * self.backoff)
+                    self._decreased_at = now
+            elif saturated:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._wake()
+
+    def _give_back(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            self._wake()
+
+    def _wake(self) -> None:
+        # Called with the lock held
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            self._in_flight += 1
+            if isinstance(waiter, threading.Event):
+                waiter.set()
+            else:
+                waiter.get_loop().call_soon_threadsafe(self._resolve, waiter)
+
+    def _resolve(self, future: asyncio.Future) -> None:
+        if future.cancelled():
+            self._give_back()
+        else:
+            future.set_result(None)
+
+
+class Throttle:
+    """
+    The rate limit and the concurrency limit of one endpoint. Every attempt of a call (retries and hedges too)
+    takes a token and a slot, failures are APIErrors.
+    """
+
+    def __init__(self, bucket: Optional[TokenBucket], limit: AdaptiveLimit):
+        self.bucket = bucket
+        self.limit = limit
+
+    def wrap(self, func: Callable) -> Callable:
+        def call(*args, **kwargs):
+            if self.bucket is not None:
+                self.bucket.acquire()
+            self.limit.acquire()
+            start = time.monotonic()
+            failed = False
+            try:
+                return func(*args, **kwargs)
+            except APIError:
+                failed = True
+                raise
+            finally:
+                self.limit.release(time.monotonic() - start, failed)
+
+        return call
+
+    def awrap(self, func: Callable) -> Callable:
+        async def call(*args, **kwargs):
+            if self.bucket is not None:
+                await self.bucket.aacquire()
+            await self.limit.aacquire()
+            start = time.monotonic()
+            failed = False
+            try:
+                return await func(*args, **kwargs)
+            except APIError:
+                failed = True
+                raise
+            finally:
+                # A hedge that lost the race is cancelled, that doesn't count as a failure
+                self.limit.release(time.monotonic() - start, failed)
+
+        return call
+
+    def as_dict(self) -> dict:
+        return {
+            "rate_limit": self.bucket.rate if self.bucket is not None else None,
+            "concurrency_limit": self.limit.limit,
+            "error_rate": self.limit.error_rate,
+            "in_flight": self.limit.in_flight,
+            "queued": self.limit.waiting + (self.bucket.waiting if self.bucket is not None else 0),
+        }
+
+
+class EndpointStats:
+    """
+    Counters and the latencies of the most recent calls of one endpoint.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.hedges = 0
+        self.rejected = 0
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "rejected": self.rejected,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+        }
+
+
+class CallAttempts:
+    """
+    The retry policy of one call, shared by ResilientClient.call and acall: only the waiting differs.
+    Every attempt runs inside next(), which asks the circuit breaker first and records the outcome in
+    the breaker, the retry budget and the stats. An APIError that may be retried is swallowed: the caller
+    waits `delay` seconds and makes the next attempt.
+    """
+
+    def __init__(self, client: "ResilientClient", endpoint: str):
+        self.client = client
+        self.endpoint = endpoint
+        self.stats = client.stats[endpoint]
+        self.attempt = 0
+        self.delay = 0.0
+        self.start = time.monotonic()
+        client.budget.deposit()
+
+    @contextlib.contextmanager
+    def next(self):
+        client = self.client
+        stats = self.stats
+        self.attempt += 1
+        permit = client.breaker.allow()
+        if permit is None:
+            with stats.lock:
+                stats.rejected += 1
+            raise CircuitOpenError(f"The {client.pms_name} API is unavailable, {self.endpoint} was not called.")
+        try:
+            yield self
+        except APIError:
+            client.breaker.record_failure()
+            if self.attempt >= client.max_attempts or not client.budget.withdraw():
+                with stats.lock:
+                    stats.errors += 1
+                raise
+            with stats.lock:
+                stats.retries += 1
+            self.delay = client._backoff(self.attempt)
+        except Exception:
+            # The API did answer, the call itself is wrong: not a reason to open the circuit
+            client.breaker.record_success()
+            raise
+        except BaseException:
+            # Cancelled (or interrupted) without an outcome, a trial must not keep the circuit half open
+            if permit == CircuitBreaker.TRIAL:
+                client.breaker.release_trial()
+            raise
+        else:
+            client.breaker.record_success()
+
+    def record(self) -> None:
+        self.client._record_call(self.endpoint, self.stats, self.start)
+
+
+class ResilientClient:
+    """
+    Wraps the API functions of a PMS. The endpoints are available as methods:
+    client.get_reservation_details(reservation_id) calls the wrapped function with the retry policy.
+    Only APIError is retried, other exceptions are raised right away.
+    Async code uses await client.acall("get_reservation_details", reservation_id), with the same policy.
+    """
+
+    def __init__(
+        self,
+        pms_name: str,
+        endpoints: dict[str, Callable],
+        max_attempts: int,
+        base_delay: float,
+        max_delay: float,
+        budget: RetryBudget,
+        breaker: CircuitBreaker,
+        hedge_after: Optional[float] = None,
+        async_endpoints: Optional[dict[str, Callable]] = None,
+        throttles: Optional[dict[str, Throttle]] = None,
+    ):
+        self.pms_name = pms_name
+        self.endpoints = endpoints
+        # Coroutine functions of the endpoints, for acall
+        self.async_endpoints = async_endpoints or {}
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.breaker = breaker
+        self.hedge_after = hedge_after
+        # The rate and concurrency limits by endpoint, endpoints without one are not limited
+        self.throttles = throttles or {}
+        self.stats = {endpoint: EndpointStats() for endpoint in endpoints}
+        self._random = random.Random()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name in self.__dict__.get("endpoints", {}):
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    def call(self, endpoint: str, *args, **kwargs):
+        func = self.endpoints[endpoint]
+        if endpoint in self.throttles:
+            func = self.throttles[endpoint].wrap(func)
+        attempts = CallAttempts(self, endpoint)
+        try:
+            while True:
+                with attempts.next():
+                    return self._attempt(func, args, kwargs, attempts.stats)
+                time.sleep(attempts.delay)
+        finally:
+            attempts.record()
+
+    async def acall(self, endpoint: str, *args, **kwargs):
+        """
+        call() for async code. Uses the async function of the endpoint if there is one, otherwise the
+        sync function runs in a thread. Waiting for a retry doesn't block the event loop.
+        """
+        func = self.async_endpoints.get(endpoint)
+        if func is None:
+            sync_func = self.endpoints[endpoint]
+
+            def func(*args, **kwargs):
+                return asyncio.to_thread(sync_func, *args, **kwargs)
+
+        if endpoint in self.throttles:
+            func = self.throttles[endpoint].awrap(func)
+        attempts = CallAttempts(self, endpoint)
+        try:
+            while True:
+                with attempts.next():
+                    return await self._aattempt(func, args, kwargs, attempts.stats)
+                await asyncio.sleep(attempts.delay)
+        finally:
+            attempts.record()
+
+    def seed(self, value) -> None:
+        """
+        Seed the jitter of the retry delays, for reproducible benchmarks.
+        """
+        self._random.seed(value)
+
+    def _record_call(self, endpoint: str, stats: EndpointStats, start: float) -> None:
+        latency = time.monotonic() - start
+        with stats.lock:
+            stats.calls += 1
+            stats.latencies.append(latency)
+        if settings.METRICS_ENABLED:
+            metrics.STAGE_SECONDS.labels(f"api:{endpoint}", self.pms_name, "").observe(latency)
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter": a random delay up to the exponential backoff, so retries of many callers spread out
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _attempt(self, func: Callable, args: tuple, kwargs: dict, stats: EndpointStats):
+        """
+        Call func once. When hedging is enabled and the call takes longer than hedge_after seconds,
+        a second, identical call is made and the first successful result is used.
+        """
+        if self.hedge_after is None:
+            return func(*args, **kwargs)
+
+        executor = self._get_executor()
+        first = executor.submit(func, *args, **kwargs)
+        try:
+            return first.result(timeout=self.hedge_after)
+        except TimeoutError:
+            pass
+        if not self._hedge(stats):
+            return first.result()
+
+        pending = {first, executor.submit(func, *args, **kwargs)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _aattempt(self, func: Callable, args: tuple, kwargs: dict, stats: EndpointStats):
+        """
+        _attempt for coroutine functions, the call that loses the race is cancelled.
+        """
+        if self.hedge_after is None:
+            return await func(*args, **kwargs)
+
+        first = asyncio.ensure_future(func(*args, **kwargs))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+        if done or not self._hedge(stats):
+            return await first
+
+        pending = {first, asyncio.ensure_future(func(*args, **kwargs))}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise error
+
+    def _hedge(self, stats: EndpointStats) -> bool:
+        """
+        Whether a slow attempt gets a second call, hedges are paid from the retry budget.
+        """
+        if not self.budget.withdraw():
+            return False
+        with stats.lock:
+            stats.hedges += 1
+        return True
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=settings.PMS_MAX_CONCURRENCY * 2, thread_name_prefix=f"{self.pms_name}-hedge"
+                )
+            return self._executor
+
+    def report(self) -> dict:
+        endpoints = {endpoint: stats.as_dict() for endpoint, stats in self.stats.items()}
+        for endpoint, throttle in self.throttles.items():
+            endpoints[endpoint].update(throttle.as_dict())
+        return {"circuit": self.breaker.state, "endpoints": endpoints}
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def make_throttle(pms_name: str, endpoint: str) -> Throttle:
+    """
+    The rate and concurrency limits of an endpoint from the settings. API_RATE_LIMITS overrides
+    the rate limit of single endpoints, by "<pms name>.<endpoint>".
+    """
+    rate = settings.API_RATE_LIMITS.get(f"{pms_name}.{endpoint}", settings.API_RATE_LIMIT)
+    return Throttle(
+        TokenBucket(rate, settings.API_RATE_BURST) if rate else None,
+        AdaptiveLimit(
+            initial=settings.PMS_MAX_CONCURRENCY,
+            min_limit=settings.API_CONCURRENCY_MIN,
+            max_limit=settings.API_CONCURRENCY_MAX,
+            backoff=settings.API_CONCURRENCY_BACKOFF,
+            latency_target=settings.API_LATENCY_TARGET,
+            error_threshold=settings.API_ERROR_RATE_THRESHOLD,
+        ),
+    )
+
+
+def get_api_client(
+    pms_name: str, endpoints: dict[str, Callable], async_endpoints: Optional[dict[str, Callable]] = None
+) -> ResilientClient:
+    """
+    Returns the client of a PMS, shared by all instances of that PMS in this process,
+    so they share one circuit breaker, retry budget and the limits of the endpoints.
+    """
+    with _clients_lock:
+        if pms_name not in _clients:
+            _clients[pms_name] = ResilientClient(
+                pms_name,
+                endpoints,
+                max_attempts=settings.API_RETRY_ATTEMPTS,
+                base_delay=settings.API_RETRY_BASE_DELAY,
+                max_delay=settings.API_RETRY_MAX_DELAY,
+                budget=RetryBudget(settings.API_RETRY_BUDGET_RATIO),
+                breaker=CircuitBreaker(settings.API_CIRCUIT_FAILURE_THRESHOLD, settings.API_CIRCUIT_RESET_TIMEOUT),
+                hedge_after=settings.API_HEDGE_AFTER,
+                async_endpoints=async_endpoints,
+                throttles={endpoint: make_throttle(pms_name, endpoint) for endpoint in endpoints},
+            )
+        return _clients[pms_name]
+
+
+def collect_metrics() -> list:
+    with _clients_lock:
+        clients = dict(_clients)
+
+    collected = []
+    latencies = metrics.CollectedMetric(
+        "hotel_api_latency_seconds", "gauge", "Latency of recent API calls, including retries.", []
+    )
+    circuits = metrics.CollectedMetric(
+        "hotel_api_circuit_state", "gauge", "The state of the circuit breaker of a PMS API.", []
+    )
+    for pms_name, client in clients.items():
+        report = client.report()
+        for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN):
+            circuits.samples.append(({"pms": pms_name, "state": state}, int(report["circuit"] == state)))
+        for endpoint, stats in report["endpoints"].items():
+            labels = {"pms": pms_name, "endpoint": endpoint}
+            collected.append((labels, stats))
+            for key, quantile in (("p50", "0.5"), ("p99", "0.99")):
+                if stats[key] is not None:
+                    latencies.samples.append(({**labels, "quantile": quantile}, stats[key]))
+
+    # p50 and p99 are left out of the counters, they are reported as latencies
+    counters = [(labels, {k: v for k, v in stats.items() if k not in ("p50", "p99")}) for labels, stats in collected]
+    gauges = ("rate_limit", "concurrency_limit", "error_rate", "in_flight", "queued")
+    return metrics.collect_stats("hotel_api", "External API calls", counters, gauges) + [latencies, circuits]
+
+
+metrics.registry.register_collector(collect_metrics)
@@ -0,0 +1,111 @@
+import datetime
+import time
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from hotel.models import Hotel, Stay
+
+"""
+The read side of the arrivals: pages of the stays checking in at a hotel on a date, for the arrivals endpoint.
+Pages are cached for ARRIVALS_CACHE_TTL seconds in the default Django cache. Every (hotel, date) has
+a generation number that is part of the cache keys of its pages. Writing a Stay increments the generation
+of its (hotel, date), which makes all cached pages of that date unreachable at once.
+
+Bulk writes don't send signals: code that writes Stays with bulk_create or update() must call
+invalidate_arrivals itself, see hotel.bulk.
+"""
+
+# The columns of an arrival, the guest is joined in the same query
+STAY_FIELDS = (
+    "id",
+    "pms_reservation_id",
+    "status",
+    "checkin",
+    "checkout",
+    "guest__name",
+    "guest__phone",
+    "guest__language",
+)
+
+
+def _generation_key(hotel_id: int, checkin: datetime.date) -> str:
+    return f"arrivals:generation:{hotel_id}:{checkin.isoformat()}"
+
+
+def _generation(hotel_id: int, checkin: datetime.date) -> int:
+    # A new generation starts at the current time, not at 0: when the cache evicted the generation,
+    # pages cached under an older generation must not become reachable again.
+    return cache.get_or_set(_generation_key(hotel_id, checkin), time.time_ns(), timeout=None)
+
+
+def invalidate_arrivals(keys: Iterable[tuple[int, Optional[datetime.date]]]) -> None:
+    """
+    Drop the cached pages of the (hotel_id, checkin) keys once the current transaction commits,
+    so a page can't be cached again with the data from before the commit.
+    """
+    keys = {(hotel_id, checkin) for hotel_id, checkin in keys if checkin is not None}
+    if keys:
+        transaction.on_commit(lambda: _invalidate(keys))
+
+
+def _invalidate(keys: set) -> None:
+    for hotel_id, checkin in keys:
+        try:
+            cache.incr(_generation_key(hotel_id, checkin))
+        except ValueError:
+            # There is no generation, so there are no cached pages either
+            pass
+
+
+def arrivals_page(
+    hotel_id: int,
+    checkin: datetime.date,
+    statuses: Iterable[str] = (),
+    after: Optional[int] = None,
+    limit: int = 100,
+) -> dict:
+    """
+    Returns {"results": [stay, ...], "next_cursor": int or None}, the stays ordered by id.
+    Pass next_cursor as `after` to get the next page. Keyset pagination: a page is one range scan of
+    the (hotel, checkin, id) index that starts after the cursor, however deep the page. Statuses are
+    filtered on the Stay rows, which are read for the other columns anyway.
+    Raises Hotel.DoesNotExist for an unknown hotel.
+    """
+    statuses = sorted(set(statuses))
+    key = "arrivals:{}:{}:{}:{}:{}:{}".format(
+        hotel_id, checkin.isoformat(), _generation(hotel_id, checkin), ",".join(statuses), after or "", limit
+    )
+    page = cache.get(key)
+    if page is None:
+        page = _load_page(hotel_id, checkin, statuses, after, limit)
+        cache.set(key, page, settings.ARRIVALS_CACHE_TTL)
+    return page
+
+
+def _load_page(hotel_id: int, checkin: datetime.date, statuses: list[str], after: Optional[int], limit: int) -> dict:
+    stays = Stay.objects.filter(hotel_id=hotel_id, checkin=checkin)
+    if statuses:
+        stays = stays.filter(status__in=statuses)
+    if after is not None:
+        stays = stays.filter(id__gt=after)
+    # One row more than the page tells whether there is a next page
+    rows = list(stays.order_by("id").values_list(*STAY_FIELDS)[: limit + 1])
+
+    if not rows and after is None and not Hotel.objects.filter(pk=hotel_id).exists():
+        raise Hotel.DoesNotExist(hotel_id)
+
+    results = [
+        {
+            "id": stay_id,
+            "pms_reservation_id": pms_reservation_id,
+            "status": status,
+            "checkin": stay_checkin.isoformat() if stay_checkin else None,
+            "checkout": checkout.isoformat() if checkout else None,
+            "guest": {"name": name, "phone": phone, "language": language} if phone is not None else None,
+        }
+        for stay_id, pms_reservation_id, status, stay_checkin, checkout, name, phone, language in rows[:limit]
+    ]
+    return {"results": results, "next_cursor": results[-1]["id"] if len(rows) > limit else None}
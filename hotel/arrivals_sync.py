@@ -0,0 +1,163 @@
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+
+from django.db.models import Count
+from django.db.models.functions import Mod
+from django.utils import timezone
+
+from hotel import pms_systems
+from hotel.external_api import APIError
+from hotel.models import Hotel, SyncCheckpoint
+
+"""
+The nightly arrivals sync, one hotel at a time. The sync_arrivals management command runs these
+functions in a pool of processes. Every hotel gets a SyncCheckpoint, so a sync that is interrupted
+or partly failed can be run again and only syncs the hotels that are not done yet.
+
+Hotels are divided into shards by primary key, so multiple nodes can each sync their own shard.
+
+The sync can cover a window of checkin dates, so an API outage on one night is healed by the next.
+Every hotel fetches the next dates in threads while it saves the current date, and dates that
+were synced less than max_age seconds ago are skipped.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def window(checkin_date: datetime.date, days: int) -> list[datetime.date]:
+    return [checkin_date + datetime.timedelta(days=day) for day in range(days)]
+
+
+def recently_synced(pms_name: str, checkin_dates: Iterable[datetime.date], max_age: Optional[float] = None):
+    """
+    The DONE checkpoints of the dates that finished less than max_age seconds ago, or ever without max_age.
+    """
+    done = SyncCheckpoint.objects.filter(
+        pms_name=pms_name, checkin_date__in=list(checkin_dates), status=SyncCheckpoint.Status.DONE
+    )
+    if max_age is not None:
+        done = done.filter(finished_at__gte=timezone.now() - datetime.timedelta(seconds=max_age))
+    return done
+
+
+def hotels_to_sync(
+    pms_name: str,
+    checkin_date: datetime.date,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    hotel_ids: Optional[Iterable[int]] = None,
+    force: bool = False,
+    days: int = 1,
+    max_age: Optional[float] = None,
+) -> list[int]:
+    """
+    Returns the primary keys of the hotels in the shard that have a date in the window of `days` dates
+    from checkin_date that was not synced (in the last max_age seconds) yet.
+    With force, hotels that were synced already are included as well.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard {shard_index} doesn't exist, there are {shard_count} shards")
+
+    hotels = Hotel.objects.alias(shard=Mod("pk", shard_count)).filter(shard=shard_index)
+    if hotel_ids is not None:
+        hotels = hotels.filter(pk__in=list(hotel_ids))
+    if not force:
+        dates = window(checkin_date, days)
+        done = (
+            recently_synced(pms_name, dates, max_age)
+            .values("hotel")
+            .annotate(dates=Count("id"))
+            .filter(dates=len(dates))
+            .values("hotel")
+        )
+        hotels = hotels.exclude(pk__in=done)
+    return list(hotels.order_by("pk").values_list("pk", flat=True))
+
+
+def dates_to_sync(
+    pms_name: str, hotel_id: int, checkin_dates: Iterable[datetime.date], max_age: Optional[float] = None
+) -> list[datetime.date]:
+    """
+    The checkin_dates of the hotel that were not synced (in the last max_age seconds) yet, in order.
+    """
+    checkin_dates = list(checkin_dates)
+    done = set(
+        recently_synced(pms_name, checkin_dates, max_age)
+        .filter(hotel_id=hotel_id)
+        .values_list("checkin_date", flat=True)
+    )
+    return [checkin_date for checkin_date in checkin_dates if checkin_date not in done]
+
+
+def sync_hotel(pms_name: str, hotel_id: int, checkin_date: datetime.date) -> SyncCheckpoint:
+    """
+    Update the stays of one hotel checking in on checkin_date and record the result in its SyncCheckpoint.
+    Exceptions are recorded as well, a failing hotel doesn't affect the others.
+    """
+    pms = pms_systems.get_pms(pms_name)
+    hotel = Hotel.objects.get(pk=hotel_id)
+    return _record(pms, hotel, checkin_date, lambda: pms.update_stays(checkin_date, hotel))
+
+
+def sync_hotel_window(
+    pms_name: str, hotel_id: int, checkin_dates: Iterable[datetime.date], prefetch: int = 1
+) -> list[SyncCheckpoint]:
+    """
+    sync_hotel for every date, in order. A producer/consumer pipeline: while the stays of one date are
+    saved, up to `prefetch` next dates are fetched from the API in threads. Returns the checkpoints.
+    Up to prefetch + 1 responses are in memory at the same time, each with all arrivals of its date.
+    """
+    pms = pms_systems.get_pms(pms_name)
+    hotel = Hotel.objects.get(pk=hotel_id)
+    checkin_dates = list(checkin_dates)
+    checkpoints = []
+
+    # The threads only call the API, the database is only used by this thread
+    with ThreadPoolExecutor(max_workers=max(1, prefetch)) as executor:
+        fetches = []
+        for index, checkin_date in enumerate(checkin_dates):
+            for ahead in checkin_dates[len(fetches) : index + prefetch + 1]:
+                fetches.append(executor.submit(pms.fetch_arrivals, ahead, hotel))
+            fetch = fetches[index]
+
+            def save(checkin_date=checkin_date, fetch=fetch) -> bool:
+                return pms.save_arrivals(checkin_date, fetch.result(), hotel)
+
+            checkpoints.append(_record(pms, hotel, checkin_date, save))
+            # Don't keep the responses of the dates that are done
+            fetches[index] = None
+    return checkpoints
+
+
+def _record(
+    pms: pms_systems.PMS, hotel: Hotel, checkin_date: datetime.date, sync: Callable[[], bool]
+) -> SyncCheckpoint:
+    """
+    Run sync() and record the outcome in the SyncCheckpoint of the hotel and date.
+    """
+    checkpoint, _ = SyncCheckpoint.objects.get_or_create(pms_name=pms.name, hotel=hotel, checkin_date=checkin_date)
+    checkpoint.status = SyncCheckpoint.Status.RUNNING
+    checkpoint.attempts += 1
+    checkpoint.started_at = timezone.now()
+    checkpoint.finished_at = None
+    checkpoint.save(update_fields=["status", "attempts", "started_at", "finished_at", "updated_at"])
+
+    try:
+        success = sync()
+        error = "" if success else "The sync is incomplete, see the logs for the reservations that failed."
+    except APIError as e:
+        logger.warning("Could not fetch the reservations of hotel %s for %s: %s", hotel.pk, checkin_date, e)
+        success = False
+        error = f"{e.__class__.__name__}: {e}"
+    except Exception as e:
+        logger.exception("Sync of hotel %s for %s failed", hotel.pk, checkin_date)
+        success = False
+        error = f"{e.__class__.__name__}: {e}"
+
+    checkpoint.status = SyncCheckpoint.Status.DONE if success else SyncCheckpoint.Status.FAILED
+    checkpoint.last_error = error
+    checkpoint.finished_at = timezone.now()
+    checkpoint.save(update_fields=["status", "last_error", "finished_at", "updated_at"])
+    return checkpoint
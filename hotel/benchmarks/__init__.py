@@ -0,0 +1,3 @@
+"""
+Benchmarks of the integration code, run them with the management commands of the same name.
+"""
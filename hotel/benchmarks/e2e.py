@@ -0,0 +1,148 @@
+import datetime
+import json
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from hotel import external_api, webhook_archive
+from hotel.cache import get_guest_cache
+from hotel.coalescing import get_coalescer
+from hotel.models import Hotel
+from hotel.pms_systems import get_pms
+
+"""
+End-to-end benchmarks of the webhook endpoint and the nightly arrivals sync against a seeded mock API.
+Run them on a throwaway database, see the `benchmark` management command.
+"""
+
+
+class Measurement:
+    """
+    Measures wall time, database queries and peak Python memory of a block.
+    """
+
+    def __enter__(self):
+        self.queries = CaptureQueriesContext(connection)
+        self.queries.__enter__()
+        tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        self.peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.queries.__exit__(*exc_info)
+        self.query_count = len(self.queries.captured_queries)
+
+
+def reset_process_state(pms_name: str) -> None:
+    """
+    Start every scenario cold: no coalesced reservations and no cached guests.
+    """
+    get_coalescer(pms_name).clear()
+    get_guest_cache(pms_name).clear()
+
+
+def webhook_scenario(hotel: Hotel, webhooks: int, events_per_webhook: int, rng) -> dict:
+    client = Client()
+    payloads = [
+        json.dumps(
+            {
+                "HotelId": hotel.pms_hotel_id,
+                "IntegrationId": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                "Events": [
+                    {
+                        "Name": "ReservationUpdated",
+                        "Value": {"ReservationId": str(uuid.UUID(int=rng.getrandbits(128), version=4))},
+                    }
+                    for _ in range(events_per_webhook)
+                ],
+            }
+        )
+        for _ in range(webhooks)
+    ]
+
+    statuses = {}
+    with Measurement() as measurement:
+        for payload in payloads:
+            response = client.post("/webhook/mews/", payload, content_type="application/json")
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    events = webhooks * events_per_webhook
+    return {
+        "webhooks": webhooks,
+        "events": events,
+        "seconds": measurement.seconds,
+        "events_per_second": events / measurement.seconds,
+        "queries_per_event": measurement.query_count / events,
+        "peak_memory_bytes": measurement.peak_memory,
+        "responses": statuses,
+    }
+
+
+def sync_scenario(arrivals: int) -> dict:
+    external_api.backend.reservations_per_date = (arrivals, arrivals)
+    pms = get_pms("mews")
+    with Measurement() as measurement:
+        success = pms.update_tomorrows_stays()
+
+    return {
+        "reservations": arrivals,
+        "success": success,
+        "seconds": measurement.seconds,
+        "reservations_per_second": arrivals / measurement.seconds,
+        "queries_per_reservation": measurement.query_count / arrivals,
+        "peak_memory_bytes": measurement.peak_memory,
+    }
+
+
+def run(
+    seed: int = 0,
+    latency: float = 0.0,
+    error_rate: float = 1 / 11,
+    webhooks: int = 50,
+    events_per_webhook: int = 20,
+    arrivals: int = 2000,
+) -> dict:
+    """
+    Runs all scenarios against a mock API seeded with `seed`. Writes to the current database.
+    """
+    previous_backend = external_api.backend
+    backend = external_api.configure(seed=seed, latency=latency, error_rate=error_rate)
+    hotel, _ = Hotel.objects.get_or_create(
+        pms_hotel_id=backend.hotel_id, defaults={"name": "Benchmark Hotel", "city": "Utrecht"}
+    )
+    pms_name = get_pms("mews").name
+    get_pms("mews").api.seed(seed)
+
+    try:
+        results = {}
+        reset_process_state(pms_name)
+        # The webhooks are archived as usual, in a directory that is thrown away
+        with tempfile.TemporaryDirectory() as archive_dir, override_settings(WEBHOOK_ARCHIVE_DIR=archive_dir):
+            results["webhook"] = webhook_scenario(hotel, webhooks, events_per_webhook, backend.random)
+            webhook_archive.close()
+        reset_process_state(pms_name)
+        results["nightly_sync"] = sync_scenario(arrivals)
+        results["api"] = get_pms("mews").api.report()
+    finally:
+        external_api.backend = previous_backend
+
+    return {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "config": {
+            "seed": seed,
+            "latency": latency,
+            "error_rate": error_rate,
+            "webhooks": webhooks,
+            "events_per_webhook": events_per_webhook,
+            "arrivals": arrivals,
+        },
+        "results": results,
+    }
@@ -0,0 +1,118 @@
+import random
+import threading
+import time
+
+from django.db import connection, transaction
+
+from hotel.guests import resolve_guests
+from hotel.models import Guest, Language
+from hotel.pms_systems import PMS_Mews
+
+"""
+Parallel-writer benchmark of guest identity resolution. `writers` threads, each with its own connection,
+import batches of guests whose phones overlap, like webhook workers and syncs of hotels that share guests.
+hotel.guests.resolve_guests is compared with an update_or_create per guest.
+
+Run it on a throwaway file database, see the `benchmark` management command: the connections of an
+in-memory test database don't wait for each other's locks.
+"""
+
+# Every strategy imports its own phone numbers, so they all start without stored guests
+STRATEGY_PHONE_PREFIXES = {"resolve_guests": "+316100", "update_or_create": "+316200"}
+
+
+def sample_batches(writers: int, batches: int, batch_size: int, phones: int, seed: int) -> list:
+    """
+    Per writer, batches of (phone number, name, language). A phone always has the same name and language,
+    but they are missing in some of the records.
+    """
+    rng = random.Random(seed)
+    languages = Language.values
+    return [
+        [
+            [
+                (
+                    number,
+                    f"Guest {number}" if rng.random() < 0.8 else "",
+                    languages[number % len(languages)] if rng.random() < 0.7 else None,
+                )
+                for number in (rng.randrange(phones) for _ in range(batch_size))
+            ]
+            for _ in range(batches)
+        ]
+        for _ in range(writers)
+    ]
+
+
+def import_resolved(records: list) -> None:
+    with transaction.atomic():
+        resolve_guests(records)
+
+
+def import_one_by_one(records: list) -> None:
+    with transaction.atomic():
+        for record in records:
+            defaults = {"name": record.name} if record.name else {}
+            if record.language:
+                defaults["language"] = record.language
+            Guest.objects.update_or_create(phone=record.phone, defaults=defaults)
+
+
+STRATEGIES = {"resolve_guests": import_resolved, "update_or_create": import_one_by_one}
+
+
+def run_strategy(name: str, samples: list) -> dict:
+    record = PMS_Mews.GUEST.record
+    prefix = STRATEGY_PHONE_PREFIXES[name]
+    writer_batches = [
+        [[record(guest_name, f"{prefix}{number:07d}", language) for number, guest_name, language in batch]
+         for batch in batches]
+        for batches in samples
+    ]
+    import_batch = STRATEGIES[name]
+    barrier = threading.Barrier(len(writer_batches) + 1)
+    errors = []
+
+    def write(batches: list) -> None:
+        try:
+            barrier.wait()
+            for batch in batches:
+                try:
+                    import_batch(batch)
+                except Exception as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=write, args=(batches,)) for batches in writer_batches]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    records = sum(len(batch) for batches in writer_batches for batch in batches)
+    return {
+        "seconds": seconds,
+        "guests_per_second": records / seconds,
+        "failed_batches": len(errors),
+        "errors": sorted(set(errors))[:5],
+        "stored_guests": Guest.objects.filter(phone__startswith=prefix).count(),
+        "expected_guests": len({number for batches in samples for batch in batches for number, _, _ in batch}),
+    }
+
+
+def run(writers: int = 4, batches: int = 20, batch_size: int = 500, phones: int = 5_000, seed: int = 0) -> dict:
+    """
+    Runs every strategy with the same batches. Writes to the current database.
+    """
+    samples = sample_batches(writers, batches, batch_size, phones, seed)
+    results = {
+        "config": {"writers": writers, "batches": batches, "batch_size": batch_size, "phones": phones},
+    }
+    for name in STRATEGIES:
+        results[name] = run_strategy(name, samples)
+    results["speedup"] = results["update_or_create"]["seconds"] / results["resolve_guests"]["seconds"]
+    return results
@@ -0,0 +1,104 @@
+import datetime
+import random
+import time
+import uuid
+
+from hotel.models import Stay
+from hotel.pms_systems import PMS_Mews
+
+"""
+Micro-benchmark of the compiled reservation schema against naive per-field dict checking with
+exception-driven parsing, on a mix of valid and garbage reservations like the API returns.
+"""
+
+
+def naive_clean_reservation(data):
+    """
+    Hand-written cleaning of a reservation, the way it is done without the schema layer.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Reservation is not an object")
+
+    def clean_uuid(value):
+        try:
+            return str(uuid.UUID(value))
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+    def clean_date(value):
+        try:
+            return datetime.date.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+
+    reservation_id = clean_uuid(data.get("ReservationId"))
+    hotel_id = clean_uuid(data.get("HotelId"))
+    if reservation_id is None or hotel_id is None:
+        raise ValueError("Reservation without a valid ReservationId or HotelId")
+
+    breakfast = data.get("BreakfastIncluded")
+    room = data.get("RoomNumber")
+    return {
+        "ReservationId": reservation_id,
+        "HotelId": hotel_id,
+        "GuestId": clean_uuid(data.get("GuestId")),
+        "Status": PMS_Mews.STATUSES.get(data.get("Status"), Stay.Status.UNKNOWN),
+        "CheckInDate": clean_date(data.get("CheckInDate")),
+        "CheckOutDate": clean_date(data.get("CheckOutDate")),
+        "BreakfastIncluded": breakfast if isinstance(breakfast, bool) else None,
+        "RoomNumber": room if isinstance(room, int) and 1 <= room <= 99999 else None,
+    }
+
+
+def sample_reservations(count: int, garbage_rate: float, seed: int) -> list:
+    rng = random.Random(seed)
+    statuses = list(PMS_Mews.STATUSES) + ["unknown", None]
+    reservations = []
+    for _ in range(count):
+        reservation = {
+            "HotelId": str(uuid.UUID(int=rng.getrandbits(128))),
+            "ReservationId": str(uuid.UUID(int=rng.getrandbits(128))),
+            "GuestId": str(uuid.UUID(int=rng.getrandbits(128))),
+            "Status": rng.choice(statuses),
+            "CheckInDate": "2024-05-01",
+            "CheckOutDate": "2024-05-04",
+            "BreakfastIncluded": rng.choice([True, False]),
+            "RoomNumber": rng.randint(1, 100),
+        }
+        if rng.random() < garbage_rate:
+            key = rng.choice(list(reservation))
+            reservation[key] = rng.choice([None, "", "garbage", 12, "2024-02-30"])
+        reservations.append(reservation)
+    return reservations
+
+
+def run(count: int = 10_000, rounds: int = 5, garbage_rate: float = 0.2, seed: int = 0) -> dict:
+    """
+    Returns the best reservations/second of both implementations over a number of rounds.
+    """
+    reservations = sample_reservations(count, garbage_rate, seed)
+    schema_run = PMS_Mews.RESERVATION.run
+
+    def compiled():
+        for reservation in reservations:
+            schema_run(reservation)
+
+    def naive():
+        for reservation in reservations:
+            try:
+                naive_clean_reservation(reservation)
+            except ValueError:
+                pass
+
+    results = {}
+    for name, func in (("compiled_schema", compiled), ("naive_dict_checks", naive)):
+        best = min(_timed(func) for _ in range(rounds))
+        results[name] = {"seconds": best, "reservations_per_second": count / best}
+    results["speedup"] = results["naive_dict_checks"]["seconds"] / results["compiled_schema"]["seconds"]
+    return results
+
+
+def _timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
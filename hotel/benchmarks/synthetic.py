@@ -0,0 +1,316 @@
+import bisect
+import datetime
+import itertools
+import random
+import statistics
+import time
+import uuid
+from typing import Callable, Optional
+
+from django.db import connection, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from hotel.arrivals import STAY_FIELDS
+from hotel.models import Guest, Hotel, Language, Stay, WebhookEvent, fingerprint
+
+"""
+Synthetic Hotels, Guests, Stays and webhook events at production scale, to check the query plans and
+timings of the hot lookups on millions of rows, see the `generate_synthetic_data` management command.
+
+Rows are written with executemany in batches of one transaction each, without model instances.
+Synthetic rows are recognizable by PMS_HOTEL_ID_PREFIX, PHONE_PREFIX and PMS_NAME, every run replaces
+the synthetic rows of the previous run and leaves the other rows alone.
+"""
+
+PMS_HOTEL_ID_PREFIX = "synthetic-"
+# +31 97 is a Dutch range for machine-to-machine numbers, nobody answers these
+PHONE_PREFIX = "+3197"
+PMS_NAME = "synthetic"
+
+CITIES = ["Amsterdam", "Utrecht", "Rotterdam", "Berlin", "Lisbon", "Madrid", "Paris", "Rome", "Stockholm", "Copenhagen"]
+FIRST_NAMES = ["Anna", "Bram", "Chloé", "Daan", "Elena", "Finn", "Greta", "Hugo", "Iris", "Jonas", "Lucía", "Mateo"]
+LAST_NAMES = ["de Vries", "Jansen", "Müller", "Schmidt", "García", "Rossi", "Silva", "Dubois", "Andersson", "Nielsen"]
+
+DEFAULT_STATUS_MIX = {
+    Stay.Status.BEFORE: 55,
+    Stay.Status.INSTAY: 10,
+    Stay.Status.AFTER: 25,
+    Stay.Status.CANCEL: 8,
+    Stay.Status.UNKNOWN: 2,
+}
+
+
+def parse_status_mix(text: str) -> dict[str, float]:
+    """
+    Parses "before=55,instay=10,..." into {status: weight}. Statuses that are left out don't occur.
+    """
+    mix = {}
+    for part in text.split(","):
+        status, _, weight = part.partition("=")
+        status = status.strip()
+        if status not in Stay.Status.values:
+            raise ValueError(f"Unknown status {status!r}, use one of {', '.join(Stay.Status.values)}")
+        try:
+            mix[status] = float(weight)
+        except ValueError:
+            raise ValueError(f"Invalid weight for {status}: {weight!r}")
+    if not mix or min(mix.values()) < 0 or sum(mix.values()) <= 0:
+        raise ValueError("The status mix needs at least one positive weight and no negative weights")
+    return mix
+
+
+def zipf_cum_weights(count: int, skew: float) -> list[float]:
+    """
+    Cumulative weights of a Zipf distribution over `count` items, item i is picked with weight 1 / (i + 1) ** skew.
+    A skew of 0 is uniform, the larger the skew the more the first items dominate.
+    """
+    return list(itertools.accumulate(1 / (rank**skew) for rank in range(1, count + 1)))
+
+
+class Picker:
+    """
+    Picks indexes 0..n-1 according to cumulative weights, faster than random.choices for one item at a time.
+    """
+
+    def __init__(self, rng: random.Random, cum_weights: list[float]):
+        self.rng = rng
+        self.cum_weights = cum_weights
+        self.total = cum_weights[-1]
+
+    def __call__(self) -> int:
+        return bisect.bisect_right(self.cum_weights, self.rng.random() * self.total)
+
+
+def insert_rows(model, columns: list[str], rows: list[tuple]) -> None:
+    """
+    One INSERT with executemany for the rows, the values must be in the database format already.
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    names = ", ".join(connection.ops.quote_name(model._meta.get_field(column).column) for column in columns)
+    placeholders = ", ".join(["%s"] * len(columns))
+    with connection.cursor() as cursor:
+        cursor.executemany(f"INSERT INTO {table} ({names}) VALUES ({placeholders})", rows)
+
+
+def clear() -> dict[str, int]:
+    """
+    Delete the synthetic rows of a previous run. Raw deletes, the ORM would load millions of rows
+    to send the delete signals.
+    """
+    ops = connection.ops
+    hotels = ops.quote_name(Hotel._meta.db_table)
+    deleted = {}
+    with transaction.atomic(), connection.cursor() as cursor:
+        synthetic_hotels = f"SELECT id FROM {hotels} WHERE pms_hotel_id LIKE %s"
+        for model, where, params in (
+            (Stay, f"hotel_id IN ({synthetic_hotels})", [PMS_HOTEL_ID_PREFIX + "%"]),
+            (Guest, "phone LIKE %s", [PHONE_PREFIX + "%"]),
+            (WebhookEvent, "pms_name = %s", [PMS_NAME]),
+        ):
+            cursor.execute(f"DELETE FROM {ops.quote_name(model._meta.db_table)} WHERE {where}", params)
+            deleted[model.__name__] = cursor.rowcount
+        # Checkpoints reference the hotels, the ORM cascades to them
+        deleted["Hotel"] = Hotel.objects.filter(pms_hotel_id__startswith=PMS_HOTEL_ID_PREFIX).delete()[0]
+    return deleted
+
+
+def generate(
+    hotels: int,
+    guests: int,
+    stays: int,
+    events: int = 0,
+    seed: int = 0,
+    batch_size: int = 50_000,
+    hotel_skew: float = 1.0,
+    guest_skew: float = 1.1,
+    anonymous_rate: float = 0.05,
+    status_mix: Optional[dict[str, float]] = None,
+    days_back: int = 365,
+    days_ahead: int = 180,
+    progress: Optional[Callable[[str, int, int], None]] = None,
+) -> dict:
+    """
+    Replace the synthetic data with a new set. Stays pick their hotel and guest from Zipf distributions
+    (hotel_skew, guest_skew), so big hotels and returning guests share a phone across many stays,
+    anonymous_rate of the stays have no guest at all. Checkin dates are spread uniformly from days_back
+    before until days_ahead after today. Returns the number of rows and rows per second of each model.
+    """
+    rng = random.Random(seed)
+    status_mix = status_mix or DEFAULT_STATUS_MIX
+    progress = progress or (lambda model, done, total: None)
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    today = timezone.localdate()
+    report = {"deleted": clear()}
+
+    def timed(model, columns, total, make_row, sort_key=None):
+        start = time.perf_counter()
+        done = 0
+        while done < total:
+            count = min(batch_size, total - done)
+            rows = [make_row(done + i) for i in range(count)]
+            if sort_key is not None:
+                rows.sort(key=sort_key)
+            with transaction.atomic():
+                insert_rows(model, columns, rows)
+            done += count
+            progress(model.__name__, done, total)
+        seconds = time.perf_counter() - start
+        report[model.__name__] = {
+            "rows": total,
+            "seconds": seconds,
+            "rows_per_second": total / seconds if seconds else 0,
+        }
+
+    def hotel_row(i):
+        city = rng.choice(CITIES)
+        return (f"Synthetic {city} {i}", city, f"{PMS_HOTEL_ID_PREFIX}{uuid.UUID(int=rng.getrandbits(128))}", now, now)
+
+    timed(Hotel, ["name", "city", "pms_hotel_id", "created_at", "updated_at"], hotels, hotel_row)
+
+    languages = Language.values + [None]
+
+    def guest_row(i):
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+        language = rng.choice(languages)
+        return (name, f"{PHONE_PREFIX}{i:010d}", language, fingerprint(name, language), now, now)
+
+    timed(Guest, ["name", "phone", "language", "fingerprint", "created_at", "updated_at"], guests, guest_row)
+
+    # The ids in the order of the generated rows, phones are zero-padded so they sort like the numbers
+    hotel_ids = list(
+        Hotel.objects.filter(pms_hotel_id__startswith=PMS_HOTEL_ID_PREFIX).order_by("pk").values_list("pk", flat=True)
+    )
+    guest_ids = list(
+        Guest.objects.filter(phone__startswith=PHONE_PREFIX).order_by("phone").values_list("pk", flat=True)
+    )
+    pick_hotel = Picker(rng, zipf_cum_weights(len(hotel_ids), hotel_skew))
+    pick_guest = Picker(rng, zipf_cum_weights(len(guest_ids), guest_skew)) if guest_ids else None
+    pick_status = Picker(rng, list(itertools.accumulate(status_mix.values())))
+    statuses = list(status_mix)
+    first_checkin = today - datetime.timedelta(days=days_back)
+
+    def stay_row(i):
+        guest_id = pms_guest_id = None
+        if pick_guest is not None and rng.random() >= anonymous_rate:
+            guest_id = guest_ids[pick_guest()]
+            pms_guest_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        status = statuses[pick_status()]
+        checkin = first_checkin + datetime.timedelta(days=rng.randrange(days_back + days_ahead + 1))
+        checkout = checkin + datetime.timedelta(days=min(int(rng.expovariate(1 / 3)) + 1, 30))
+        return (
+            hotel_ids[pick_hotel()],
+            guest_id,
+            str(uuid.UUID(int=rng.getrandbits(128))),
+            pms_guest_id,
+            status,
+            checkin.isoformat(),
+            checkout.isoformat(),
+            fingerprint(guest_id, pms_guest_id, status, checkin, checkout),
+            now,
+            now,
+        )
+
+    def stay_key(row):
+        # Inserting in the order of the (hotel, pms_reservation_id) and (hotel, checkin, id) indexes
+        # touches far fewer index pages than random order
+        return row[0], row[2]
+
+    stay_columns = ["hotel", "guest", "pms_reservation_id", "pms_guest_id", "status", "checkin", "checkout"]
+    stay_columns += ["fingerprint", "created_at", "updated_at"]
+    timed(Stay, stay_columns, stays if hotel_ids else 0, stay_row, sort_key=stay_key)
+
+    # A queue of handled events, like the table looks after months of webhooks: the claim has to skip them
+    event_statuses = [WebhookEvent.Status.DONE] * 98 + [WebhookEvent.Status.FAILED] * 2
+    payload = '{"HotelId": "%s", "ReservationIds": ["%s"]}'
+
+    def event_row(i):
+        return (
+            PMS_NAME,
+            payload % (uuid.UUID(int=rng.getrandbits(128)), uuid.UUID(int=rng.getrandbits(128))),
+            rng.choice(event_statuses),
+            1,
+            now,
+            "",
+            now,
+            now,
+        )
+
+    event_columns = ["pms_name", "payload", "status", "attempts", "available_at", "last_error", "created_at"]
+    timed(WebhookEvent, event_columns + ["updated_at"], events, event_row)
+
+    with connection.cursor() as cursor:
+        # Fresh statistics for the query planner
+        cursor.execute("ANALYZE")
+    return report
+
+
+def hot_queries(sample_size: int = 500) -> dict:
+    """
+    The lookups the integration runs most, as the code runs them: {name: queryset}. The parameters are
+    taken from the synthetic data, the arrivals page is the one of the busiest hotel and date.
+    """
+    # The hotel with the most stays, its arrivals pages are the largest
+    busiest = (
+        Stay.objects.filter(hotel__pms_hotel_id__startswith=PMS_HOTEL_ID_PREFIX)
+        .values("hotel")
+        .annotate(stays=Count("id"))
+        .order_by("-stays")
+        .first()
+    )
+    if busiest is None:
+        raise ValueError("There is no synthetic data, generate it first")
+    hotel = Hotel.objects.get(pk=busiest["hotel"])
+    busiest = (
+        Stay.objects.filter(hotel=hotel).values("checkin").annotate(arrivals=Count("id")).order_by("-arrivals")[0]
+    )
+    reservations = list(
+        Stay.objects.filter(hotel=hotel).order_by("?").values_list("pms_reservation_id", flat=True)[:sample_size]
+    )
+    phones = list(
+        Guest.objects.filter(phone__startswith=PHONE_PREFIX).order_by("?").values_list("phone", flat=True)[:sample_size]
+    )
+    available = Q(status=WebhookEvent.Status.PENDING) | Q(status=WebhookEvent.Status.PROCESSING)
+
+    return {
+        # HotelResolver.load
+        "hotel by pms_hotel_id": Hotel.objects.filter(pms_hotel_id__in=[hotel.pms_hotel_id]).order_by("pk"),
+        # guests.lookup, for resolve_guests
+        "guests by phone": Guest.objects.filter(phone__in=phones).values_list(
+            "phone", "id", "name", "language", "fingerprint"
+        ),
+        # upsert_stays
+        "stays by reservation": Stay.objects.filter(
+            hotel_id__in=[hotel.pk], pms_reservation_id__in=reservations
+        ).values_list("hotel_id", "pms_reservation_id", "guest_id", "fingerprint", "checkin"),
+        # arrivals._load_page, the first page
+        "arrivals page": Stay.objects.filter(
+            hotel_id=hotel.pk, checkin=busiest["checkin"], status__in=[Stay.Status.BEFORE, Stay.Status.INSTAY]
+        )
+        .order_by("id")
+        .values_list(*STAY_FIELDS)[:101],
+        # webhook_queue.claim
+        "webhook queue claim": WebhookEvent.objects.filter(available, available_at__lte=timezone.now())
+        .order_by("available_at", "id")
+        .values_list("id", flat=True)[:50],
+    }
+
+
+def explain(repeat: int = 20, sample_size: int = 500) -> dict:
+    """
+    The query plan (EXPLAIN QUERY PLAN on SQLite) and the timings in milliseconds of every hot query.
+    """
+    report = {}
+    for name, queryset in hot_queries(sample_size).items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = len(list(queryset.all()))
+            timings.append((time.perf_counter() - start) * 1000)
+        report[name] = {
+            "plan": queryset.explain(),
+            "rows": rows,
+            "median_ms": statistics.median(timings),
+            "max_ms": max(timings),
+        }
+    return report
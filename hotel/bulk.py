@@ -0,0 +1,139 @@
+from typing import Iterable, NamedTuple, Optional
+
+from django.conf import settings
+from django.db import transaction
+
+from hotel import metrics
+from hotel.arrivals import invalidate_arrivals
+from hotel.guests import resolve_guests
+from hotel.models import Stay
+from hotel.schema import Record
+
+"""
+Batched writes of cleaned reservations. Instead of an update_or_create per Stay and Guest, every chunk
+of reservations is written with a few bulk queries inside one transaction.
+
+Most syncs return what is stored already. Rows whose fingerprint (see FingerprintedModel) matches
+the stored one are not written at all, so they don't take the write lock or bump updated_at.
+"""
+
+STAY_UPDATE_FIELDS = ["pms_guest_id", "status", "checkin", "checkout", "fingerprint", "updated_at"]
+
+BULK_ROWS = metrics.registry.counter(
+    "hotel_bulk_rows_total", "Rows of bulk upserts, written or skipped because they didn't change.", ("model", "result")
+)
+
+
+def count_rows(model: str, written: int, skipped: int) -> None:
+    if settings.METRICS_ENABLED:
+        BULK_ROWS.labels(model, "written").inc(written)
+        BULK_ROWS.labels(model, "skipped").inc(skipped)
+
+
+class ReservationRow(NamedTuple):
+    """
+    A cleaned reservation record (see PMS_Mews.RESERVATION) with the cleaned guest record (PMS_Mews.GUEST).
+    Guest is None when the guest details are unknown, the current guest of the Stay is kept then.
+    """
+
+    hotel_id: int
+    reservation: Record
+    guest: Optional[Record]
+
+
+def chunked(items: Iterable, size: int):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def upsert_reservations(rows: Iterable[ReservationRow], chunk_size: Optional[int] = None) -> int:
+    """
+    Update or create the Stays and Guests of the rows. Returns the number of written Stays,
+    Stays that didn't change are not counted.
+    """
+    written = 0
+    for chunk in chunked(rows, chunk_size or settings.BULK_UPSERT_CHUNK_SIZE):
+        with transaction.atomic():
+            guest_ids = upsert_guests(row.guest for row in chunk if row.guest is not None)
+            written += upsert_stays(chunk, guest_ids)
+    return written
+
+
+def upsert_guests(guests: Iterable[Record]) -> dict[str, int]:
+    """
+    Update or create guests by phone, see hotel.guests.resolve_guests. Guests without a phone can't be
+    identified and are skipped. Returns a mapping of phone to Guest id.
+    """
+    resolution = resolve_guests(guests)
+    count_rows("guest", resolution.written, resolution.skipped)
+    return resolution.guest_ids
+
+
+def upsert_stays(rows: Iterable[ReservationRow], guest_ids: dict[str, int]) -> int:
+    """
+    Update or create the Stays of the rows, linked to the guests in guest_ids (phone -> Guest id).
+    Returns the number of written Stays, Stays that didn't change are skipped.
+    """
+    # The last row wins when a reservation occurs more than once
+    stays = {}
+    for row in rows:
+        reservation = row.reservation
+        phone = row.guest.phone if row.guest is not None else None
+        stays[(row.hotel_id, reservation.reservation_id)] = Stay(
+            hotel_id=row.hotel_id,
+            guest_id=guest_ids.get(phone),
+            pms_reservation_id=reservation.reservation_id,
+            pms_guest_id=reservation.guest_id,
+            status=reservation.status,
+            checkin=reservation.checkin,
+            checkout=reservation.checkout,
+        )
+
+    if not stays:
+        return 0
+
+    # (hotel_id, pms_reservation_id) -> (guest_id, fingerprint, checkin) of the stored Stays
+    existing = {
+        (hotel_id, reservation_id): (guest_id, stored_fingerprint, checkin)
+        for hotel_id, reservation_id, guest_id, stored_fingerprint, checkin in Stay.objects.filter(
+            hotel_id__in={hotel_id for hotel_id, _ in stays},
+            pms_reservation_id__in={reservation_id for _, reservation_id in stays},
+        ).values_list("hotel_id", "pms_reservation_id", "guest_id", "fingerprint", "checkin")
+    }
+
+    changed = []
+    keeps_guest = set()
+    for key, stay in stays.items():
+        stored_guest_id, stored_fingerprint, _ = existing.get(key, (None, None, None))
+        if stay.guest_id is None:
+            # Without a known guest the current guest is kept, so it is part of the new fingerprint as well
+            keeps_guest.add(key)
+            stay.guest_id = stored_guest_id
+        stay.fingerprint = stay.compute_fingerprint()
+        if stay.fingerprint != stored_fingerprint:
+            changed.append((key, stay))
+
+    # Stays without a known guest keep their current guest, so they need their own update_fields
+    with_guest = [stay for key, stay in changed if key not in keeps_guest]
+    without_guest = [stay for key, stay in changed if key in keeps_guest]
+    for objects, update_fields in ((with_guest, ["guest"] + STAY_UPDATE_FIELDS), (without_guest, STAY_UPDATE_FIELDS)):
+        if objects:
+            Stay.objects.bulk_create(
+                objects,
+                update_conflicts=True,
+                unique_fields=["hotel", "pms_reservation_id"],
+                update_fields=update_fields,
+            )
+    count_rows("stay", len(changed), len(stays) - len(changed))
+
+    # Bulk writes don't send signals. A Stay that moved to another date leaves the arrivals of both dates.
+    arrival_keys = {(stay.hotel_id, stay.checkin) for _, stay in changed}
+    arrival_keys.update((key[0], existing[key][2]) for key, _ in changed if key in existing)
+    invalidate_arrivals(arrival_keys)
+    return len(changed)
@@ -0,0 +1,268 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from django.conf import settings
+
+from hotel import metrics
+from hotel.schema import record_from_json, record_to_json
+
+"""
+In-process caches with a time to live, used in front of external API calls.
+A TieredCache can be backed by a SQLiteCache, so multiple worker processes share their hits.
+"""
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    A thread-safe, bounded cache. Entries expire after `ttl` seconds, and when the cache is full
+    the least recently used entry is evicted.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (expires_at, value), least recently used first
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class SQLiteCache:
+    """
+    A cache in a local SQLite file, shared by all processes on this machine.
+    Values must be JSON serializable, schema records and dates are supported as well.
+    Expired entries are removed when they are read, and all expired entries of the file are purged
+    by a write at most every `purge_interval` seconds (per process), so keys that are never read again
+    don't make the file grow forever.
+    """
+
+    def __init__(self, path, namespace: str, ttl: float, purge_interval: float = 60):
+        self.path = str(path)
+        self.namespace = namespace
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._local = threading.local()
+        self._purged_at = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+            self._local.connection = connection
+        return connection
+
+    def _key(self, key) -> str:
+        return f"{self.namespace}:{key}"
+
+    def get(self, key, default=MISSING):
+        value, _ = self.get_with_ttl(key)
+        return default if value is MISSING else value
+
+    def get_with_ttl(self, key) -> tuple[Any, float]:
+        """
+        The value and the seconds it has left, (MISSING, 0) when it isn't cached.
+        """
+        row = self._connection().execute(
+            "SELECT value, expires_at FROM cache WHERE key = ?", (self._key(key),)
+        ).fetchone()
+        if row is None:
+            return MISSING, 0
+        ttl = row[1] - time.time()
+        if ttl <= 0:
+            self.delete(key)
+            return MISSING, 0
+        return json.loads(row[0], object_hook=record_from_json), ttl
+
+    def set(self, key, value, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (self._key(key), json.dumps(value, default=record_to_json), now + (self.ttl if ttl is None else ttl)),
+        )
+        if now - self._purged_at >= self.purge_interval:
+            self._purged_at = now
+            self.purge(connection, now)
+
+    def purge(self, connection: Optional[sqlite3.Connection] = None, now: Optional[float] = None) -> int:
+        """
+        Delete the expired entries of all namespaces, returns how many.
+        """
+        connection = connection or self._connection()
+        return connection.execute(
+            "DELETE FROM cache WHERE expires_at <= ?", (time.time() if now is None else now,)
+        ).rowcount
+
+    def delete(self, key) -> None:
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (self._key(key),))
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM cache WHERE key LIKE ?", (f"{self.namespace}:%",))
+
+
+class TieredCache:
+    """
+    A TTLCache in front of an optional shared cache. Hits in the shared cache are copied to the local cache
+    for the time they have left in the shared cache, so a value never outlives its TTL.
+    """
+
+    def __init__(self, local: TTLCache, shared: Optional[SQLiteCache] = None):
+        self.local = local
+        self.shared = shared
+        self.shared_hits = 0
+        self.invalidations = 0
+
+    def get_or_fetch(self, key, fetch: Callable[[], Any]):
+        """
+        Return the cached value, or call fetch() and cache its result.
+        Exceptions raised by fetch() are not cached, they propagate to the caller.
+        """
+        value = self.local.get(key)
+        if value is MISSING and self.shared is not None:
+            value = self._get_shared(key)
+        if value is MISSING:
+            value = fetch()
+            self.set(key, value)
+        return value
+
+    async def aget_or_fetch(self, key, fetch: Callable[[], Awaitable]):
+        """
+        get_or_fetch with a coroutine function. The shared cache may wait for the lock of another
+        process, so it is read and written in a thread.
+        """
+        value = self.local.get(key)
+        if value is MISSING and self.shared is not None:
+            value = await asyncio.to_thread(self._get_shared, key)
+        if value is MISSING:
+            value = await fetch()
+            if self.shared is None:
+                self.local.set(key, value)
+            else:
+                await asyncio.to_thread(self.set, key, value)
+        return value
+
+    def _get_shared(self, key):
+        """
+        Look the key up in the shared cache, hits are copied to the local cache.
+        """
+        value, ttl = self.shared.get_with_ttl(key)
+        if value is not MISSING:
+            self.shared_hits += 1
+            self.local.set(key, value, ttl=min(ttl, self.local.ttl))
+        return value
+
+    def set(self, key, value) -> None:
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def invalidate(self, key) -> None:
+        self.invalidations += 1
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def clear(self) -> None:
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        # A miss of the local cache that was found in the shared cache is still a hit
+        stats["shared_hits"] = self.shared_hits
+        stats["hits"] += self.shared_hits
+        stats["misses"] -= self.shared_hits
+        stats["invalidations"] = self.invalidations
+        return stats
+
+
+_guest_caches = {}
+_guest_caches_lock = threading.Lock()
+
+
+def get_guest_cache(pms_name: str) -> TieredCache:
+    """
+    Returns the cache of cleaned guest details by PMS GuestId, shared by all instances of that PMS in this process.
+    """
+    with _guest_caches_lock:
+        if pms_name not in _guest_caches:
+            shared = None
+            if settings.GUEST_CACHE_SHARED_PATH:
+                shared = SQLiteCache(settings.GUEST_CACHE_SHARED_PATH, f"guest:{pms_name}", settings.GUEST_CACHE_TTL)
+            _guest_caches[pms_name] = TieredCache(
+                TTLCache(settings.GUEST_CACHE_MAXSIZE, settings.GUEST_CACHE_TTL), shared
+            )
+        return _guest_caches[pms_name]
+
+
+def collect_metrics() -> list:
+    with _guest_caches_lock:
+        caches = dict(_guest_caches)
+    return metrics.collect_stats(
+        "hotel_guest_cache",
+        "Guest details cache",
+        [({"pms": name}, cache.stats()) for name, cache in caches.items()],
+        gauges=("size",),
+    )
+
+
+metrics.registry.register_collector(collect_metrics)
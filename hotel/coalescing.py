@@ -0,0 +1,179 @@
+import threading
+from typing import Iterable
+
+from hotel import metrics
+
+"""
+Webhook events only tell us that a reservation changed, the details are always fetched from the API.
+Multiple events for the same reservation that arrive before its fetch starts therefore result in the same fetch.
+The coalescer merges those events, within one payload and across payloads of the same hotel.
+
+An event that arrives while a fetch of its reservation is running describes a change that fetch may have
+missed. It is not dropped: the reservation is marked dirty, and the running fetch is repeated once it finishes.
+
+The coalescer only sees the payloads a process handles at the same time. Queued payloads of a hotel that
+arrive seconds apart are merged before they are handled, within WEBHOOK_COALESCE_WINDOW (see hotel.webhook_queue).
+"""
+
+
+class EventCoalescer:
+    """
+    Keeps track of the reservations that are being fetched, per hotel. coalesce() returns the reservations
+    a handler should fetch, and the handler calls finish() when the fetches are done (or failed).
+    An event for a reservation that is being fetched marks it dirty instead of starting a second fetch,
+    and finish() returns the dirty reservations to fetch again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (hotel_id, reservation_id) -> True when an event arrived during the fetch
+        self._in_flight = {}
+        self.events_received = 0
+        self.duplicates_in_payload = 0
+        self.duplicates_across_payloads = 0
+        self.refetches = 0
+
+    @property
+    def fetches_saved(self) -> int:
+        return self.duplicates_in_payload + self.duplicates_across_payloads - self.refetches
+
+    def coalesce(self, hotel_id: str, reservation_ids: Iterable[str], force: bool = False) -> list[str]:
+        """
+        Return the reservation IDs that should be fetched, in order of first appearance, and mark them as
+        being fetched. Reservations that are being fetched already are marked dirty and left out, unless
+        force is True: a retried webhook can't rely on another fetch, whose writes may fail as well.
+        Call finish() with the returned IDs when the fetches are done.
+        """
+        reservation_ids = list(reservation_ids)
+        unique_ids = list(dict.fromkeys(reservation_ids))
+        to_fetch = []
+
+        with self._lock:
+            for reservation_id in unique_ids:
+                key = (hotel_id, reservation_id)
+                if key in self._in_flight:
+                    self._in_flight[key] = True
+                    if not force:
+                        self.duplicates_across_payloads += 1
+                        continue
+                else:
+                    self._in_flight[key] = False
+                to_fetch.append(reservation_id)
+
+            self.events_received += len(reservation_ids)
+            self.duplicates_in_payload += len(reservation_ids) - len(unique_ids)
+
+        return to_fetch
+
+    def finish(self, hotel_id: str, reservation_ids: Iterable[str]) -> list[str]:
+        """
+        Mark the fetches of the reservations as done. Returns the reservations that got an event while
+        they were being fetched: they are still marked as being fetched, fetch them again and call
+        finish() for those as well.
+        """
+        refetch = []
+        with self._lock:
+            for reservation_id in reservation_ids:
+                key = (hotel_id, reservation_id)
+                if self._in_flight.get(key):
+                    self._in_flight[key] = False
+                    refetch.append(reservation_id)
+                else:
+                    self._in_flight.pop(key, None)
+            self.refetches += len(refetch)
+        return refetch
+
+    def release(self, hotel_id: str, reservation_ids: Iterable[str]) -> None:
+        """
+        Forget the fetches of the reservations, dirty or not. For handlers that give up: their webhook fails
+        and is retried, which fetches the reservations again.
+        """
+        with self._lock:
+            for reservation_id in reservation_ids:
+                self._in_flight.pop((hotel_id, reservation_id), None)
+
+    def fetching(self, hotel_id: str, reservation_ids: Iterable[str], force: bool = False) -> "CoalescedFetch":
+        """
+        coalesce(), finish() and release() for a handler, see CoalescedFetch.
+        """
+        return CoalescedFetch(self, hotel_id, self.coalesce(hotel_id, reservation_ids, force))
+
+    def clear(self) -> None:
+        """
+        Forget all fetches, the next event of every reservation is fetched.
+        """
+        with self._lock:
+            self._in_flight.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "events_received": self.events_received,
+                "duplicates_in_payload": self.duplicates_in_payload,
+                "duplicates_across_payloads": self.duplicates_across_payloads,
+                "refetches": self.refetches,
+                "fetches_saved": self.fetches_saved,
+            }
+
+
+class CoalescedFetch:
+    """
+    The fetches of one webhook, shared by the sync and async handlers. Fetch the `pending` reservations
+    until there are none left, reporting the outcomes of every round with done():
+
+        with coalescer.fetching(hotel_id, reservation_ids) as fetch:
+            while fetch.pending:
+                fetch.done(run_concurrently(fetch_reservation, fetch.pending))
+
+    Reservations that got another event during a round are pending again. When the handler gives up
+    (an exception leaves the block), its pending fetches are released.
+    """
+
+    def __init__(self, coalescer: EventCoalescer, hotel_id: str, pending: list[str]):
+        self.coalescer = coalescer
+        self.hotel_id = hotel_id
+        self.pending = pending
+        # reservation_id -> Outcome of its last fetch
+        self._outcomes = {}
+
+    @property
+    def outcomes(self) -> list:
+        return list(self._outcomes.values())
+
+    def done(self, outcomes: Iterable) -> None:
+        self._outcomes.update((outcome.item, outcome) for outcome in outcomes)
+        self.pending = self.coalescer.finish(self.hotel_id, self.pending)
+
+    def __enter__(self) -> "CoalescedFetch":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        if exc_type is not None:
+            self.coalescer.release(self.hotel_id, self.pending)
+
+
+_coalescers = {}
+_coalescers_lock = threading.Lock()
+
+
+def get_coalescer(pms_name: str) -> EventCoalescer:
+    """
+    Returns the coalescer of a PMS, shared by all instances of that PMS in this process.
+    """
+    with _coalescers_lock:
+        if pms_name not in _coalescers:
+            _coalescers[pms_name] = EventCoalescer()
+        return _coalescers[pms_name]
+
+
+def collect_metrics() -> list:
+    with _coalescers_lock:
+        coalescers = dict(_coalescers)
+    return metrics.collect_stats(
+        "hotel_coalescer",
+        "Webhook events seen by the coalescer",
+        [({"pms": name}, coalescer.stats()) for name, coalescer in coalescers.items()],
+    )
+
+
+metrics.registry.register_collector(collect_metrics)
@@ -0,0 +1,139 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, NamedTuple, Optional
+
+"""
+Helpers to run blocking calls (like the external API) concurrently, and to avoid running the same call twice.
+"""
+
+
+class Outcome(NamedTuple):
+    item: Any
+    result: Any
+    error: Optional[Exception]
+
+
+def run_concurrently(func: Callable, items: Iterable, max_workers: int) -> list[Outcome]:
+    """
+    Call func(item) for every item, with at most max_workers calls running at the same time.
+    Returns an Outcome per item, in the order of the items. An exception raised for one item
+    is stored in its Outcome and doesn't affect the other items.
+    Only use this for calls that don't touch the database, Django connections are per thread.
+    """
+    items = list(items)
+
+    def call(item) -> Outcome:
+        try:
+            return Outcome(item, func(item), None)
+        except Exception as e:
+            return Outcome(item, None, e)
+
+    if len(items) <= 1 or max_workers <= 1:
+        return [call(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(call, items))
+
+
+async def gather_concurrently(func: Callable, items: Iterable, max_concurrency: int) -> list[Outcome]:
+    """
+    run_concurrently for a coroutine function: await func(item) for every item, with at most
+    max_concurrency calls in flight at the same time. Returns an Outcome per item, in the order of the items.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def call(item) -> Outcome:
+        async with semaphore:
+            try:
+                return Outcome(item, await func(item), None)
+            except Exception as e:
+                return Outcome(item, None, e)
+
+    return list(await asyncio.gather(*(call(item) for item in items)))
+
+
+class SingleFlight:
+    """
+    Makes concurrent calls for the same key share one execution: the first caller runs the function,
+    callers arriving while it runs wait for its result (or exception).
+    Results can be reused for a short time: do(key, func, max_age=2) returns a result that finished
+    less than 2 seconds ago without calling func. None results are never reused, None means unknown.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, max_age_limit: float = 60):
+        # Results older than max_age_limit are dropped, whatever max_age callers ask for
+        self.max_age_limit = max_age_limit
+        self._lock = threading.Lock()
+        self._calls = {}
+        # key -> (finished_at, result), oldest first
+        self._results = OrderedDict()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func: Callable, max_age: float = 0):
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if max_age > 0 and key in self._results:
+                finished_at, result = self._results[key]
+                if now - finished_at <= max_age:
+                    self.shared += 1
+                    return result
+
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None and call.result is not None:
+                    self._results.pop(key, None)
+                    self._results[key] = (time.monotonic(), call.result)
+            call.done.set()
+        return call.result
+
+    def _expire(self, now: float) -> None:
+        while self._results:
+            key, (finished_at, _) = next(iter(self._results.items()))
+            if now - finished_at <= self.max_age_limit:
+                break
+            del self._results[key]
+
+
+_single_flights = {}
+_single_flights_lock = threading.Lock()
+
+
+def get_single_flight(name: str) -> SingleFlight:
+    """
+    Returns the SingleFlight with the given name, shared by the whole process.
+    """
+    with _single_flights_lock:
+        if name not in _single_flights:
+            _single_flights[name] = SingleFlight()
+        return _single_flights[name]
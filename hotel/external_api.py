@@ -1,12 +1,23 @@
+import asyncio
 import json
 import random
+import threading
+import time
 import uuid
 import datetime
+from collections import Counter
+from typing import Optional
 
 """
 This document simulates the external API that our system uses to communicate with the
 booking systems from hotels (Property Management Systems). Use the below functions to
 simulate the communication with the external API.
+
+The functions use a MockBackend. By default it behaves like a real, unpredictable API. Use configure()
+to make it deterministic (seed) and to tune latency, error rate and payload sizes, e.g. for benchmarks.
+
+Every function has an async counterpart (prefixed with "a") that waits for the latency without blocking
+the event loop, like an async HTTP client would.
 """
 
 
@@ -24,37 +35,150 @@ reservation_statuses = [
 ]
 
 
-def get_reservations_for_given_checkin_date(checkin_date: str) -> str:
+class MockBackend:
+    """
+    Generates the API responses. With a seed, the randomness of a call comes from a random.Random seeded with
+    the seed, the endpoint, the argument and the number of earlier calls with that argument. The latency and
+    errors of a call don't depend on the order in which concurrent threads call the API, and a response
+    only depends on the seed and the argument, so a seeded backend is reproducible.
+    latency: seconds per call, a number or a callable that gets the Random of the call and returns seconds,
+        e.g. lambda rng: rng.lognormvariate(-3, 0.5)
+    error_rate: the chance that a call raises APIError
+    reservations_per_date: (min, max) number of reservations returned per checkin date
+    """
+
+    def __init__(
+        self,
+        seed: Optional[int] = None,
+        latency=0.0,
+        error_rate: float = 1 / 11,
+        reservations_per_date: tuple[int, int] = (1, 10),
+        hotel_id: str = "851df8c8-90f2-4c4a-8e01-a4fc46b25178",
+    ):
+        self.seed = seed
+        # For callers that generate test data, e.g. webhook payloads, from the seed
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reservations_per_date = reservations_per_date
+        self.hotel_id = hotel_id
+        self._lock = threading.Lock()
+        self._calls = Counter()
+
+    def rng(self, *key) -> random.Random:
+        return random.Random(":".join(map(str, (self.seed, *key)))) if self.seed is not None else random.Random()
+
+    def call_rng(self, endpoint: str, arg) -> random.Random:
+        """
+        The Random for the latency and errors of a call, every call with the same argument gets the next one.
+        Without a seed the calls are random anyway: they are not counted, so the counts don't grow forever.
+        """
+        if self.seed is None:
+            return random.Random()
+        with self._lock:
+            n = self._calls[(endpoint, arg)]
+            self._calls[(endpoint, arg)] += 1
+        return self.rng(endpoint, arg, n)
+
+    def call(self, endpoint: str, arg) -> None:
+        """
+        Simulate the network latency and the random failures of a call.
+        """
+        rng = self.call_rng(endpoint, arg)
+        latency = self.next_latency(rng)
+        if latency > 0:
+            time.sleep(latency)
+        self.maybe_fail(rng)
+
+    async def acall(self, endpoint: str, arg) -> None:
+        rng = self.call_rng(endpoint, arg)
+        latency = self.next_latency(rng)
+        if latency > 0:
+            await asyncio.sleep(latency)
+        self.maybe_fail(rng)
+
+    def next_latency(self, rng: random.Random) -> float:
+        return self.latency(rng) if callable(self.latency) else self.latency
+
+    def maybe_fail(self, rng: random.Random) -> None:
+        # This API call can fail randomly, just to simulate a real API.
+        if rng.random() < self.error_rate:
+            raise APIError("The API is not available.")
+
+    @staticmethod
+    def uuid(rng: random.Random) -> str:
+        return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+    @staticmethod
+    def choice(rng: random.Random, options: list):
+        return options[rng.randint(0, len(options) - 1)]
+
+    def reservation(
+        self,
+        rng: random.Random,
+        reservation_id: str,
+        checkin_date: datetime.date,
+        checkout_date: datetime.date,
+        hotel_id: Optional[str] = None,
+    ) -> dict:
+        return {
+            "HotelId": hotel_id or self.hotel_id,
+            "ReservationId": reservation_id,
+            "GuestId": self.uuid(rng),
+            "Status": self.choice(rng, reservation_statuses),
+            "CheckInDate": checkin_date.strftime("%Y-%m-%d"),
+            "CheckOutDate": checkout_date.strftime("%Y-%m-%d"),
+            "BreakfastIncluded": self.choice(rng, [True, False]),
+            "RoomNumber": rng.randint(1, 100),
+        }
+
+
+backend = MockBackend()
+
+
+def configure(**kwargs) -> MockBackend:
+    """
+    Replace the backend of the API functions, see MockBackend for the arguments. Returns the new backend.
+    """
+    global backend
+    backend = MockBackend(**kwargs)
+    return backend
+
+
+def get_reservations_for_given_checkin_date(checkin_date: str, hotel_id: Optional[str] = None) -> str:
     """
     Returns reservations for a given checkin date.
     The reservations are returned as a JSON string.
     Note, the checkin date is a string in the format YYYY-MM-DD.
+    With a hotel_id, only the reservations of that hotel are returned.
     This is just to simulate the external API.
     """
 
+    check_checkin_date(checkin_date)
+    backend.call("reservations", (checkin_date, hotel_id))
+    return reservations_response(checkin_date, hotel_id)
+
+
+async def aget_reservations_for_given_checkin_date(checkin_date: str, hotel_id: Optional[str] = None) -> str:
+    check_checkin_date(checkin_date)
+    await backend.acall("reservations", (checkin_date, hotel_id))
+    return reservations_response(checkin_date, hotel_id)
+
+
+def check_checkin_date(checkin_date: str) -> None:
     assert isinstance(checkin_date, str), "checkin_date should be a string."
     assert datetime.datetime.strptime(checkin_date, "%Y-%m-%d"), "checkin_date should have the format: YYYY-MM-DD."
 
-    # This API call can fail randomly, just to simulate a real API.
-    if random.randint(0, 10) == 0:
-        raise APIError("The API is not available.")
 
+def reservations_response(checkin_date: str, hotel_id: Optional[str]) -> str:
+    checkin = datetime.datetime.strptime(checkin_date, "%Y-%m-%d").date()
+    rng = backend.rng("reservations", checkin_date, hotel_id)
     return json.dumps(
         [
-            {
-                "HotelId": "851df8c8-90f2-4c4a-8e01-a4fc46b25178",
-                "ReservationId": str(uuid.uuid4()),
-                "GuestId": str(uuid.uuid4()),
-                "Status": reservation_statuses[random.randint(0, len(reservation_statuses) - 1)],
-                "CheckInDate": checkin_date,
-                "CheckOutDate": (
-                    datetime.datetime.strptime(checkin_date, "%Y-%m-%d")
-                    + datetime.timedelta(days=random.randint(1, 10))
-                ).strftime("%Y-%m-%d"),
-                "BreakfastIncluded": random.choice([True, False]),
-                "RoomNumber": random.randint(1, 100),
-            }
-            for _ in range(random.randint(1, 10))
+            backend.reservation(
+                rng, backend.uuid(rng), checkin, checkin + datetime.timedelta(days=rng.randint(1, 10)), hotel_id
+            )
+            for _ in range(rng.randint(*backend.reservations_per_date))
         ]
     )
 
@@ -65,25 +189,25 @@ def get_reservation_details(reservation_id: str) -> str:
     The reservation details are returned as a JSON string.
     """
 
-    # This API call can fail randomly, just to simulate a real API.
-    if random.randint(0, 10) == 0:
-        raise APIError("The API is not available.")
+    backend.call("reservation_details", reservation_id)
+    return reservation_details_response(reservation_id)
 
+
+async def aget_reservation_details(reservation_id: str) -> str:
+    await backend.acall("reservation_details", reservation_id)
+    return reservation_details_response(reservation_id)
+
+
+def reservation_details_response(reservation_id: str) -> str:
+    today = datetime.date.today()
+    rng = backend.rng("reservation_details", reservation_id)
     return json.dumps(
-        {
-            "HotelId": "851df8c8-90f2-4c4a-8e01-a4fc46b25178",
-            "ReservationId": reservation_id,
-            "GuestId": str(uuid.uuid4()),
-            "Status": reservation_statuses[random.randint(0, len(reservation_statuses) - 1)],
-            "CheckInDate": (datetime.date.today() - datetime.timedelta(days=random.randint(0, 10))).strftime(
-                "%Y-%m-%d"
-            ),
-            "CheckOutDate": (datetime.date.today() + datetime.timedelta(days=random.randint(1, 10))).strftime(
-                "%Y-%m-%d"
-            ),
-            "BreakfastIncluded": random.choice([True, False]),
-            "RoomNumber": random.randint(1, 100),
-        }
+        backend.reservation(
+            rng,
+            reservation_id,
+            today - datetime.timedelta(days=rng.randint(0, 10)),
+            today + datetime.timedelta(days=rng.randint(1, 10)),
+        )
     )
 
 
@@ -93,10 +217,16 @@ def get_guest_details(guest_id: str) -> str:
     The guest details are returned as a JSON string.
     """
 
-    # This API call can fail randomly, just to simulate a real API.
-    if random.randint(0, 10) == 0:
-        raise APIError("The API is not available.")
+    backend.call("guest_details", guest_id)
+    return guest_details_response(guest_id)
+
+
+async def aget_guest_details(guest_id: str) -> str:
+    await backend.acall("guest_details", guest_id)
+    return guest_details_response(guest_id)
+
 
+def guest_details_response(guest_id: str) -> str:
     countries = ["NL", "DE", "GG", "GB", "", "CA", "BR", "CN", None, "AU"]
     names = [
         "John Doe",
@@ -123,11 +253,12 @@ def get_guest_details(guest_id: str) -> str:
         "+61491570156",
     ]
 
+    rng = backend.rng("guest_details", guest_id)
     return json.dumps(
         {
             "GuestId": guest_id,
-            "Name": names[random.randint(0, len(names) - 1)],
-            "Phone": phones[random.randint(0, len(phones) - 1)],
-            "Country": countries[random.randint(0, len(countries) - 1)],
+            "Name": backend.choice(rng, names),
+            "Phone": backend.choice(rng, phones),
+            "Country": backend.choice(rng, countries),
         }
     )
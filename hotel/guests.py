@@ -0,0 +1,158 @@
+import logging
+from typing import Iterable, NamedTuple, Optional
+
+from django.conf import settings
+
+from hotel import metrics
+from hotel.models import Guest
+from hotel.normalization import normalize_phone
+from hotel.schema import Record
+
+"""
+Guest identity resolution for bulk imports: a guest is identified by the E.164 form of their phone number.
+
+Every batch takes three queries in the common case: one lookup of the phones of the batch, one conflict-tolerant
+insert of the new guests and one lookup of their ids. Writers that import the same guests at the same time
+(webhook workers, syncs of other hotels) don't fail on the unique phone. When another writer inserted a phone
+first, its row is kept, and the phone is resolved again against that row: names and languages are merged like
+for any known guest, instead of one import overwriting the other with missing values.
+"""
+
+logger = logging.getLogger(__name__)
+
+GUEST_UPDATE_FIELDS = ["name", "language", "fingerprint", "updated_at"]
+
+GUEST_CONFLICTS = metrics.registry.counter(
+    "hotel_guest_conflicts_total", "New guests that another writer inserted first, resolved again.", ()
+)
+
+
+class Resolution(NamedTuple):
+    guest_ids: dict[str, int]  # phone as given in the records -> Guest id
+    written: int
+    skipped: int
+
+
+class StoredGuest(NamedTuple):
+    id: int
+    name: str
+    language: Optional[str]
+    fingerprint: str
+
+
+def merge_records(guests: Iterable[Record], default_region: Optional[str] = None) -> tuple[dict, dict]:
+    """
+    Merge the guest records by normalized phone. Returns (values, aliases): the name and language per phone,
+    and the normalized phone per phone of the records. Guests without a usable phone are skipped.
+    """
+    values = {}
+    aliases = {}
+    for guest in guests:
+        phone = aliases.get(guest.phone) or normalize_phone(guest.phone, default_region)
+        if phone is None:
+            continue
+        aliases[guest.phone] = phone
+        current = values.get(phone, {})
+        values[phone] = {
+            "name": guest.name or current.get("name", ""),
+            "language": guest.language or current.get("language"),
+        }
+    return values, aliases
+
+
+def lookup(phones: Iterable[str]) -> dict[str, StoredGuest]:
+    """
+    The stored guests of the phones, in one query.
+    """
+    return {
+        phone: StoredGuest(*row)
+        for phone, *row in Guest.objects.filter(phone__in=list(phones)).values_list(
+            "phone", "id", "name", "language", "fingerprint"
+        )
+    }
+
+
+def build_guest(phone: str, values: dict, stored: Optional[StoredGuest]) -> Guest:
+    """
+    The Guest to store: known names and languages are never overwritten with missing values.
+    """
+    guest = Guest(
+        phone=phone,
+        name=values["name"] or (stored.name if stored else ""),
+        language=values["language"] or (stored.language if stored else None),
+    )
+    guest.fingerprint = guest.compute_fingerprint()
+    return guest
+
+
+def resolve_guests(
+    guests: Iterable[Record], default_region: Optional[str] = None, attempts: Optional[int] = None
+) -> Resolution:
+    """
+    Update or create guests by phone and map the phones (as given in the records) to Guest ids.
+    Guests that don't change are not written. Run it inside a transaction to write a batch atomically.
+
+    New guests are inserted with ON CONFLICT DO NOTHING. A phone that another writer inserted between the
+    lookup and the insert is looked up and merged again, up to `attempts` times (GUEST_RESOLVE_ATTEMPTS);
+    after that it is linked to the stored guest as it is, the import doesn't fail on it.
+    """
+    values, aliases = merge_records(guests, default_region)
+    if not values:
+        return Resolution({}, 0, 0)
+    attempts = attempts or settings.GUEST_RESOLVE_ATTEMPTS
+
+    guest_ids = {}
+    written = 0
+    pending = values
+    stored = lookup(pending)
+    for attempt in range(1, attempts + 1):
+        new = []
+        changed = []
+        for phone, guest_values in pending.items():
+            known = stored.get(phone)
+            guest = build_guest(phone, guest_values, known)
+            if known is None:
+                new.append(guest)
+            elif known.fingerprint != guest.fingerprint:
+                changed.append(guest)
+                guest_ids[phone] = known.id
+            else:
+                guest_ids[phone] = known.id
+
+        if changed:
+            Guest.objects.bulk_create(
+                changed, update_conflicts=True, unique_fields=["phone"], update_fields=GUEST_UPDATE_FIELDS
+            )
+            written += len(changed)
+        if not new:
+            break
+
+        Guest.objects.bulk_create(new, ignore_conflicts=True)
+        # SQLite doesn't return the ids of inserted rows, and doesn't tell which rows were ignored
+        stored = lookup(guest.phone for guest in new)
+        pending = {}
+        for guest in new:
+            row = stored.get(guest.phone)
+            if row is not None and row.fingerprint == guest.fingerprint:
+                guest_ids[guest.phone] = row.id
+                written += 1
+            else:
+                # Another writer inserted it first (with other values), or deleted it again
+                pending[guest.phone] = values[guest.phone]
+        if not pending:
+            break
+        if settings.METRICS_ENABLED:
+            GUEST_CONFLICTS.labels().inc(len(pending))
+        logger.debug("%s new guests were inserted by another writer, attempt %s", len(pending), attempt)
+    else:
+        unresolved = 0
+        for phone in pending:
+            if phone in stored:
+                guest_ids[phone] = stored[phone].id
+            else:
+                unresolved += 1
+        if unresolved:
+            logger.warning("Could not resolve %s guests after %s attempts, they are left out", unresolved, attempts)
+
+    guest_ids = {given: guest_ids[phone] for given, phone in aliases.items() if phone in guest_ids}
+    return Resolution(guest_ids, written, len(values) - written)
@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+
+from hotel.benchmarks import e2e, guests, schema
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the webhook endpoint and the nightly sync against a seeded mock API, on a throwaway "
+        "test database. Save the results with --output to compare them across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds of latency per API call")
+        parser.add_argument("--error-rate", type=float, default=1 / 11, help="Chance that an API call fails")
+        parser.add_argument("--webhooks", type=int, default=50)
+        parser.add_argument("--events-per-webhook", type=int, default=20)
+        parser.add_argument("--arrivals", type=int, default=2000, help="Reservations in the nightly sync")
+        parser.add_argument("--schema", action="store_true", help="Also run the schema micro-benchmark")
+        parser.add_argument(
+            "--guest-writers",
+            type=int,
+            default=0,
+            help="Also run the guest import benchmark with this many parallel writers, on a throwaway file database",
+        )
+        parser.add_argument("--output", help="Write the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+        try:
+            report = e2e.run(
+                seed=options["seed"],
+                latency=options["latency"],
+                error_rate=options["error_rate"],
+                webhooks=options["webhooks"],
+                events_per_webhook=options["events_per_webhook"],
+                arrivals=options["arrivals"],
+            )
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        if options["schema"]:
+            report["results"]["schema"] = schema.run(seed=options["seed"])
+        if options["guest_writers"]:
+            report["results"]["guests"] = self.run_guests(options["guest_writers"], options["seed"])
+        report["commit"] = current_commit()
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        self.stdout.write(output)
+
+    def run_guests(self, writers: int, seed: int) -> dict:
+        # The writers need their own connections to one database, an in-memory test database can't do that
+        test_settings = connection.settings_dict["TEST"]
+        previous_name = test_settings["NAME"]
+        with tempfile.TemporaryDirectory() as tmp:
+            test_settings["NAME"] = os.path.join(tmp, "benchmark.sqlite3")
+            old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+            try:
+                return guests.run(writers=writers, seed=seed)
+            finally:
+                teardown_databases(old_config, verbosity=0)
+                test_settings["NAME"] = previous_name
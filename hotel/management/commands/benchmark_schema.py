@@ -0,0 +1,19 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from hotel.benchmarks import schema
+
+
+class Command(BaseCommand):
+    help = "Compare the compiled reservation schema with naive dict checking."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=10_000, help="Reservations per round")
+        parser.add_argument("--rounds", type=int, default=5)
+        parser.add_argument("--garbage-rate", type=float, default=0.2, help="Fraction of reservations with a bad field")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        results = schema.run(options["count"], options["rounds"], options["garbage_rate"], options["seed"])
+        self.stdout.write(json.dumps(results, indent=2))
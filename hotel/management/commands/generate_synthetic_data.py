@@ -0,0 +1,106 @@
+import json
+from pathlib import Path
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from hotel.benchmarks import synthetic
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with synthetic hotels, guests, stays and webhook events, then report the query plans "
+        "and timings of the hot lookups. Synthetic rows of an earlier run are replaced, other rows are kept. "
+        "Writes to a separate SQLite file (--database), or to the configured database with --force."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hotels", type=int, default=1_000)
+        parser.add_argument("--guests", type=int, default=300_000)
+        parser.add_argument("--stays", type=int, default=1_000_000)
+        parser.add_argument("--events", type=int, default=100_000, help="Handled webhook events in the queue")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=50_000, help="Rows per insert transaction")
+        parser.add_argument("--hotel-skew", type=float, default=1.0, help="Zipf skew of stays per hotel, 0 is uniform")
+        parser.add_argument(
+            "--guest-skew", type=float, default=1.1, help="Zipf skew of stays per guest (phone), 0 is uniform"
+        )
+        parser.add_argument("--anonymous-rate", type=float, default=0.05, help="Fraction of stays without a guest")
+        parser.add_argument(
+            "--status-mix",
+            type=synthetic.parse_status_mix,
+            help="Weights of the stay statuses, e.g. before=55,instay=10,after=25,cancel=8,unknown=2",
+        )
+        parser.add_argument("--days-back", type=int, default=365, help="Earliest checkin, in days before today")
+        parser.add_argument("--days-ahead", type=int, default=180, help="Latest checkin, in days after today")
+        parser.add_argument("--repeat", type=int, default=20, help="Runs of every hot query")
+        parser.add_argument("--report-only", action="store_true", help="Don't generate, report on the current data")
+        parser.add_argument("--clear", action="store_true", help="Only delete the synthetic data")
+        parser.add_argument("--output", help="Write the results as JSON to this file")
+        parser.add_argument(
+            "--database", help="Use this SQLite file instead of the configured database, migrated when needed"
+        )
+        parser.add_argument(
+            "--force", action="store_true", help="Write millions of rows to the configured database"
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options["verbosity"]
+        if options["database"]:
+            self.use_database(options["database"])
+        elif not (options["force"] or options["report_only"]):
+            raise CommandError(
+                f"This writes millions of rows to {connection.settings_dict['NAME']}. "
+                "Pass --database <file> to use a separate SQLite file, or --force to write there anyway."
+            )
+        if options["clear"]:
+            self.stdout.write(json.dumps({"deleted": synthetic.clear()}, indent=2))
+            return
+
+        report = {}
+        if not options["report_only"]:
+            report["generated"] = synthetic.generate(
+                hotels=options["hotels"],
+                guests=options["guests"],
+                stays=options["stays"],
+                events=options["events"],
+                seed=options["seed"],
+                batch_size=options["batch_size"],
+                hotel_skew=options["hotel_skew"],
+                guest_skew=options["guest_skew"],
+                anonymous_rate=options["anonymous_rate"],
+                status_mix=options["status_mix"],
+                days_back=options["days_back"],
+                days_ahead=options["days_ahead"],
+                progress=self.progress,
+            )
+        try:
+            report["queries"] = synthetic.explain(repeat=options["repeat"])
+        except ValueError as e:
+            raise CommandError(e)
+
+        for name, result in report["queries"].items():
+            self.stdout.write(
+                f"{name}: {result['median_ms']:.2f} ms median, {result['max_ms']:.2f} ms max, {result['rows']} rows"
+            )
+            self.stdout.write(self.style.SQL_KEYWORD(result["plan"]))
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def use_database(self, path: str) -> None:
+        if connection.vendor != "sqlite":
+            raise CommandError("--database needs a SQLite database, use --force to write to the configured one")
+        connections.close_all()
+        connection.settings_dict["NAME"] = str(Path(path).resolve())
+        call_command("migrate", verbosity=0, interactive=False)
+
+    def progress(self, model: str, done: int, total: int) -> None:
+        # Every batch with --verbosity 2, otherwise when a model is done
+        if done == total or self.verbosity > 1:
+            self.stdout.write(f"{model}: {done}/{total}")
@@ -0,0 +1,100 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from hotel import webhook_queue
+
+logger = logging.getLogger(__name__)
+
+# The workers are forked, so they start with the apps and settings of this process. Under "spawn" or
+# "forkserver" (the macOS and Python 3.14 defaults) they would import this module before Django is set up.
+mp_context = multiprocessing.get_context("fork")
+
+
+def _worker(options):
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda *args: stopping.append(True))
+
+    webhook_queue.run_worker(
+        batch_size=options["batch_size"],
+        lease_seconds=options["lease"],
+        poll_interval=options["poll_interval"],
+        once=options["once"],
+        should_stop=lambda: bool(stopping),
+    )
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        "Start a pool of workers that process the queued webhook events. "
+        "Workers that die or exit with an error are restarted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="Number of worker processes")
+        parser.add_argument("--batch-size", type=int, default=10, help="Events claimed per query")
+        parser.add_argument("--lease", type=int, default=60, help="Seconds before a claimed event is retried")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument("--once", action="store_true", help="Stop the workers when the queue is empty")
+        parser.add_argument("--max-restarts", type=int, default=10, help="Give up after this many worker restarts")
+        parser.add_argument("--restart-delay", type=float, default=1.0, help="Seconds before restarting a worker")
+
+    def handle(self, *args, **options):
+        worker_options = {key: options[key] for key in ("batch_size", "lease", "poll_interval", "once")}
+        stopping = []
+        previous_handler = signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+
+        processes = [self.start(worker_options) for _ in range(options["workers"])]
+        self.stdout.write(f"Started {len(processes)} webhook workers.")
+
+        restarts = 0
+        try:
+            while processes and not stopping:
+                multiprocessing.connection.wait([process.sentinel for process in processes], timeout=1)
+                for i, process in enumerate(processes):
+                    if process.is_alive():
+                        continue
+                    process.join()
+                    if process.exitcode == 0:
+                        # Only happens with --once, when the queue is empty
+                        processes[i] = None
+                        continue
+                    restarts += 1
+                    logger.error("Webhook worker %s exited with code %s", process.pid, process.exitcode)
+                    if restarts > options["max_restarts"]:
+                        raise CommandError(
+                            f"Webhook workers exited with an error {restarts} times, see the logs. Giving up."
+                        )
+                    time.sleep(options["restart_delay"])
+                    processes[i] = self.start(worker_options)
+                processes = [process for process in processes if process is not None]
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+            self.stop(processes)
+
+        self.stdout.write(f"Webhook workers stopped, {restarts} restarts.")
+
+    def start(self, worker_options: dict) -> multiprocessing.Process:
+        # Forked processes must not share the database connection of the parent
+        connections.close_all()
+        process = mp_context.Process(target=_worker, args=(worker_options,), daemon=True)
+        process.start()
+        return process
+
+    def stop(self, processes: list) -> None:
+        # The workers finish their current batch
+        processes = [process for process in processes if process is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from hotel import webhook_archive
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the archived webhooks of all PMSes that are older than WEBHOOK_ARCHIVE_RETENTION_DAYS, "
+        "a day directory at a time. Run it daily."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, help="Keep this many days instead of WEBHOOK_ARCHIVE_RETENTION_DAYS")
+        parser.add_argument("--archive-dir", help="Prune this archive instead of WEBHOOK_ARCHIVE_DIR")
+        parser.add_argument("--dry-run", action="store_true", help="Only list the directories that would be deleted")
+
+    def handle(self, *args, **options):
+        if options["archive_dir"] is None and not settings.WEBHOOK_ARCHIVE_DIR:
+            raise CommandError("The webhook archive is disabled, set WEBHOOK_ARCHIVE_DIR or pass --archive-dir")
+        days = options["days"] if options["days"] is not None else settings.WEBHOOK_ARCHIVE_RETENTION_DAYS
+        if days is None:
+            self.stdout.write("WEBHOOK_ARCHIVE_RETENTION_DAYS is None, the archive is kept.")
+            return
+
+        try:
+            pruned = webhook_archive.prune(days, root=options["archive_dir"], dry_run=options["dry_run"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options["verbosity"] > 1 or options["dry_run"]:
+            for path in pruned:
+                self.stdout.write(str(path))
+        action = "Would delete" if options["dry_run"] else "Deleted"
+        self.stdout.write(f"{action} {len(pruned)} day directories older than {days} days.")
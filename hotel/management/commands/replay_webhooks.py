@@ -0,0 +1,69 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from hotel import pms_systems, webhook_archive
+
+
+def timestamp(value: str) -> float:
+    """
+    A date (YYYY-MM-DD, midnight) or a datetime in ISO format, in the current time zone when it has none.
+    """
+    moment = datetime.datetime.fromisoformat(value)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment.timestamp()
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay archived webhooks of a PMS: the raw bodies are cleaned and handled again, in parallel batches. "
+        "Webhooks with the same cleaned payload are only handled once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("pms_name", help="The PMS of the webhooks, e.g. mews")
+        parser.add_argument("--since", type=timestamp, help="Received at or after, YYYY-MM-DD[THH:MM[:SS]]")
+        parser.add_argument("--until", type=timestamp, help="Received at or before, YYYY-MM-DD[THH:MM[:SS]]")
+        parser.add_argument("--hotel", action="append", dest="hotel_ids", help="Only the webhooks of this PMS hotel ID")
+        parser.add_argument("--workers", type=int, default=4, help="Number of threads handling batches")
+        parser.add_argument("--batch-size", type=int, default=100, help="Webhooks written per transaction")
+        parser.add_argument("--archive-dir", help="Read this archive instead of WEBHOOK_ARCHIVE_DIR")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the webhooks that would be replayed")
+
+    def handle(self, *args, **options):
+        self.verbosity = options["verbosity"]
+        try:
+            pms = pms_systems.get_pms(options["pms_name"])
+        except pms_systems.UnknownPMS:
+            raise CommandError(f"Unknown PMS: {options['pms_name']}")
+        if options["archive_dir"] is None and not settings.WEBHOOK_ARCHIVE_DIR:
+            raise CommandError("The webhook archive is disabled, set WEBHOOK_ARCHIVE_DIR or pass --archive-dir")
+
+        webhooks = webhook_archive.read(
+            pms.name, options["since"], options["until"], options["hotel_ids"], root=options["archive_dir"]
+        )
+        start = time.monotonic()
+        counts = webhook_archive.replay(
+            pms,
+            webhooks,
+            workers=options["workers"],
+            batch_size=options["batch_size"],
+            dry_run=options["dry_run"],
+            progress=self.progress,
+        )
+        seconds = time.monotonic() - start
+
+        summary = ", ".join(f"{counts[key]} {key}" for key in ("read", "invalid", "duplicate", "handled", "failed"))
+        self.stdout.write(f"{summary} in {seconds:.1f}s.")
+        if counts["failed"]:
+            raise CommandError(
+                f"{counts['failed']} webhooks failed or are incomplete, see the logs. Replaying again is safe."
+            )
+
+    def progress(self, counts) -> None:
+        if self.verbosity > 1:
+            self.stdout.write(f"{counts['read']} read, {counts['handled']} handled, {counts['failed']} failed")
@@ -0,0 +1,133 @@
+import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from hotel import arrivals_sync, pms_systems
+from hotel.models import SyncCheckpoint
+
+# Forked workers start with the apps and settings of this process, see process_webhooks
+mp_context = multiprocessing.get_context("fork")
+
+
+def _sync(args) -> tuple[int, str, str]:
+    pms_name, hotel_id, checkin_dates, max_age, prefetch = args
+    if max_age is not None:
+        checkin_dates = arrivals_sync.dates_to_sync(pms_name, hotel_id, checkin_dates, max_age)
+    checkpoints = arrivals_sync.sync_hotel_window(pms_name, hotel_id, checkin_dates, prefetch)
+    failed = [checkpoint for checkpoint in checkpoints if checkpoint.status != SyncCheckpoint.Status.DONE]
+    if not failed:
+        return hotel_id, SyncCheckpoint.Status.DONE, ""
+    return hotel_id, SyncCheckpoint.Status.FAILED, "; ".join(f"{c.checkin_date}: {c.last_error}" for c in failed)
+
+
+class Command(BaseCommand):
+    help = (
+        "Update the stays of all hotels checking in on a date (tomorrow by default), or on the dates of a window "
+        "with --days. Hotels are synced in parallel. Dates that were synced recently are skipped, "
+        "so a failed or interrupted sync can be run again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("pms_name", help="The PMS to sync the hotels with, e.g. mews")
+        parser.add_argument("--date", type=datetime.date.fromisoformat, help="Checkin date, YYYY-MM-DD")
+        parser.add_argument("--days", type=int, default=1, help="Sync this many checkin dates from --date on")
+        parser.add_argument(
+            "--max-age",
+            type=float,
+            default=settings.ARRIVALS_SYNC_MAX_AGE,
+            help="Skip the dates of a hotel that were synced less than this many seconds ago",
+        )
+        parser.add_argument(
+            "--prefetch",
+            type=int,
+            default=2,
+            help="Dates fetched ahead while the current date is being saved, their responses are kept in memory",
+        )
+        parser.add_argument("--workers", type=int, default=4, help="Number of worker processes")
+        parser.add_argument("--shard-index", type=int, default=0, help="The shard of hotels this node syncs")
+        parser.add_argument("--shard-count", type=int, default=1, help="The number of nodes that share the sync")
+        parser.add_argument("--hotel", type=int, action="append", dest="hotel_ids", help="Only sync these hotels")
+        parser.add_argument("--force", action="store_true", help="Also sync the dates that were synced recently")
+
+    def handle(self, *args, **options):
+        try:
+            pms = pms_systems.get_pms(options["pms_name"])
+        except pms_systems.UnknownPMS:
+            raise CommandError(f"Unknown PMS: {options['pms_name']}")
+
+        checkin_date = options["date"] or timezone.localdate() + datetime.timedelta(days=1)
+        if options["days"] < 1:
+            raise CommandError("--days should be at least 1")
+        max_age = None if options["force"] else options["max_age"]
+        try:
+            hotel_ids = arrivals_sync.hotels_to_sync(
+                pms.name,
+                checkin_date,
+                shard_index=options["shard_index"],
+                shard_count=options["shard_count"],
+                hotel_ids=options["hotel_ids"],
+                force=options["force"],
+                days=options["days"],
+                max_age=max_age,
+            )
+        except ValueError as e:
+            raise CommandError(e)
+
+        checkin_dates = arrivals_sync.window(checkin_date, options["days"])
+        dates = f"{checkin_date}" if len(checkin_dates) == 1 else f"{checkin_date} to {checkin_dates[-1]}"
+        self.stdout.write(
+            f"Syncing {len(hotel_ids)} hotels for {dates} "
+            f"(shard {options['shard_index'] + 1} of {options['shard_count']})."
+        )
+        tasks = [(pms.name, hotel_id, checkin_dates, max_age, options["prefetch"]) for hotel_id in hotel_ids]
+
+        if options["workers"] > 1 and len(tasks) > 1:
+            # Forked processes must not share the database connection of the parent
+            connections.close_all()
+            # Unlike a multiprocessing.Pool, the executor fails the hotels of a worker that died instead of hanging
+            with ProcessPoolExecutor(min(options["workers"], len(tasks)), mp_context=mp_context) as executor:
+                futures = {executor.submit(_sync, task): task[1] for task in tasks}
+                results = (self.result(future, futures[future]) for future in as_completed(futures))
+                failed = self.report(results, len(tasks))
+        else:
+            failed = self.report((self.run(task) for task in tasks), len(tasks))
+
+        if failed:
+            raise CommandError(
+                f"{len(failed)} of {len(tasks)} hotels failed, run the command again to retry them: "
+                + " ".join(f"--hotel {hotel_id}" for hotel_id in failed)
+            )
+        self.stdout.write(self.style.SUCCESS(f"Synced {len(tasks)} hotels for {dates}."))
+
+    def result(self, future, hotel_id: int) -> tuple[int, str, str]:
+        try:
+            return future.result()
+        except Exception as e:
+            return hotel_id, SyncCheckpoint.Status.FAILED, f"{e.__class__.__name__}: {e}"
+
+    def run(self, task) -> tuple[int, str, str]:
+        """
+        _sync in this process. Like in a worker process, an exception only fails the hotel of the task.
+        """
+        try:
+            return _sync(task)
+        except Exception as e:
+            return task[1], SyncCheckpoint.Status.FAILED, f"{e.__class__.__name__}: {e}"
+
+    def report(self, results, total: int) -> list[int]:
+        """
+        Print the progress while the results come in, returns the hotels that failed.
+        """
+        failed = []
+        for done, (hotel_id, status, error) in enumerate(results, start=1):
+            if status == SyncCheckpoint.Status.DONE:
+                self.stdout.write(f"[{done}/{total}] Hotel {hotel_id}: done")
+            else:
+                failed.append(hotel_id)
+                self.stdout.write(self.style.ERROR(f"[{done}/{total}] Hotel {hotel_id}: {error}"))
+        return failed
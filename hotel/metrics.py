@@ -0,0 +1,296 @@
+import cProfile
+import functools
+import inspect
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterable, NamedTuple
+
+from django.conf import settings
+
+"""
+Lightweight counters and histograms for the hot paths, rendered in the Prometheus text format at /metrics.
+Recording a value is a lock and a few additions, cheap enough to leave on in production.
+Metrics live in the process: with multiple worker processes, every process reports its own values.
+
+Statistics that other modules already keep (caches, coalescers, API clients) are not recorded twice,
+they are read when /metrics is scraped by the collectors registered with register_collector.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a fast cache hit to a slow sync
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # The last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Family:
+    """
+    A metric with a fixed set of label names, and a Counter or Histogram per combination of label values.
+    """
+
+    def __init__(self, name: str, kind: str, help: str, label_names: tuple, factory: Callable):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.label_names = label_names
+        self._factory = factory
+        self._lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} has labels {self.label_names}, got {values}")
+            with self._lock:
+                child = self.children.setdefault(values, self._factory())
+        return child
+
+
+class CollectedMetric(NamedTuple):
+    """
+    A metric read by a collector: samples is a list of (labels, value).
+    """
+
+    name: str
+    kind: str
+    help: str
+    samples: list[tuple[dict, float]]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.families = {}
+        self.collectors = []
+
+    def counter(self, name: str, help: str, label_names: tuple = ()) -> Family:
+        return self._register(Family(name, "counter", help, label_names, Counter))
+
+    def histogram(self, name: str, help: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Family:
+        return self._register(Family(name, "histogram", help, label_names, lambda: Histogram(buckets)))
+
+    def _register(self, family: Family) -> Family:
+        with self._lock:
+            if family.name in self.families:
+                raise ValueError(f"A metric named {family.name} already exists")
+            self.families[family.name] = family
+        return family
+
+    def register_collector(self, collector: Callable[[], Iterable[CollectedMetric]]) -> None:
+        with self._lock:
+            self.collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+        with self._lock:
+            families = list(self.families.values())
+            collectors = list(self.collectors)
+
+        for family in families:
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for values, child in list(family.children.items()):
+                labels = dict(zip(family.label_names, values))
+                if family.kind == "counter":
+                    lines.append(_sample(family.name, labels, child.value))
+                    continue
+                with child._lock:
+                    counts, total, count = list(child.counts), child.sum, child.count
+                cumulative = 0
+                for bound, bucket_count in zip(child.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(_sample(f"{family.name}_bucket", {**labels, "le": _number(bound)}, cumulative))
+                lines.append(_sample(f"{family.name}_bucket", {**labels, "le": "+Inf"}, count))
+                lines.append(_sample(f"{family.name}_sum", labels, total))
+                lines.append(_sample(f"{family.name}_count", labels, count))
+
+        for collector in collectors:
+            try:
+                collected = list(collector())
+            except Exception:
+                logger.exception("Metrics collector %s failed", collector.__name__)
+                continue
+            for metric in collected:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                for labels, value in metric.samples:
+                    lines.append(_sample(metric.name, labels, value))
+
+        return "\n".join(lines) + "\n"
+
+
+def _number(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _sample(name: str, labels: dict, value) -> str:
+    # Empty label values are the same as a missing label in Prometheus, leave them out
+    labels = ",".join(
+        '{}="{}"'.format(key, str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, label in labels.items()
+        if label != ""
+    )
+    return f"{name}{{{labels}}} {_number(value)}" if labels else f"{name} {_number(value)}"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "hotel_stage_seconds", "Time spent in a stage of webhook handling or the sync.", ("stage", "pms", "hotel")
+)
+STAGE_ERRORS = registry.counter(
+    "hotel_stage_errors_total", "Stages that ended with an exception.", ("stage", "pms", "hotel")
+)
+WEBHOOK_REQUESTS = registry.counter(
+    "hotel_webhook_requests_total", "Webhook requests by response status.", ("pms", "status")
+)
+WEBHOOK_EVENTS = registry.counter(
+    "hotel_webhook_events_total", "Reservation events received by webhook.", ("pms", "hotel")
+)
+
+
+def hotel_label(pms_hotel_id) -> str:
+    """
+    The hotel label of a metric. A label per hotel multiplies the number of series,
+    so it is empty unless METRICS_HOTEL_LABELS is set.
+    """
+    return str(pms_hotel_id) if settings.METRICS_HOTEL_LABELS and pms_hotel_id else ""
+
+
+class stage:
+    """
+    Times a block as a stage: with metrics.stage("db_write", pms="mews", hotel=hotel_id): ...
+    Exceptions are counted in hotel_stage_errors_total and propagate.
+    """
+
+    __slots__ = ("labels", "start")
+
+    def __init__(self, name: str, pms: str = "", hotel: str = ""):
+        self.labels = (name, pms, hotel)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not settings.METRICS_ENABLED:
+            return
+        STAGE_SECONDS.labels(*self.labels).observe(time.perf_counter() - self.start)
+        if exc_type is not None:
+            STAGE_ERRORS.labels(*self.labels).inc()
+
+
+def timed_method(name: str) -> Callable:
+    """
+    Decorator for methods of a PMS: times every call as the stage `name`, labeled with the PMS.
+    Async methods are timed until their coroutine finishes.
+    """
+
+    def decorator(method: Callable) -> Callable:
+        if inspect.iscoroutinefunction(method):
+
+            @functools.wraps(method)
+            async def async_wrapper(self, *args, **kwargs):
+                with stage(name, self.name):
+                    return await method(self, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with stage(name, self.name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+_profile_lock = threading.Lock()
+_profile_random = random.Random()
+
+
+@contextmanager
+def sampled_profile(name: str):
+    """
+    Profiles a fraction (METRICS_PROFILE_SAMPLE_RATE) of the blocks with cProfile, and logs the profile
+    when the block took longer than METRICS_PROFILE_SLOW_SECONDS. At most one block is profiled at a time.
+    Only the calling thread is profiled, time spent in worker threads shows up as waiting.
+    """
+    rate = settings.METRICS_PROFILE_SAMPLE_RATE
+    if not rate or _profile_random.random() >= rate or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        profiler.enable()
+        yield
+    finally:
+        profiler.disable()
+        _profile_lock.release()
+        seconds = time.perf_counter() - start
+        if seconds >= settings.METRICS_PROFILE_SLOW_SECONDS:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(30)
+            logger.warning("Slow %s took %.3fs, profile:\n%s", name, seconds, stream.getvalue())
+
+
+def collect_stats(name_prefix: str, help: str, stats: list[tuple[dict, dict]], gauges: tuple = ()) -> list:
+    """
+    Turns stats() dicts of objects into metrics for a collector: a counter {name_prefix}_{key}_total
+    per numeric key, or a gauge {name_prefix}_{key} for the keys in `gauges`.
+    stats is a list of (labels, stats dict), e.g. [({"pms": "mews"}, coalescer.stats())].
+    """
+    metrics = {}
+    for labels, values in stats:
+        for key, value in values.items():
+            if not isinstance(value, (int, float)):
+                continue
+            if key in gauges:
+                metric_name, kind = f"{name_prefix}_{key}", "gauge"
+            else:
+                metric_name, kind = f"{name_prefix}_{key}_total", "counter"
+            if metric_name not in metrics:
+                metrics[metric_name] = CollectedMetric(metric_name, kind, f"{help} ({key})", [])
+            metrics[metric_name].samples.append((labels, value))
+    return list(metrics.values())
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.2 on 2026-10-17 04:04
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pms_name', models.CharField(max_length=50)),
+                ('payload', models.JSONField(help_text='The output of PMS.clean_webhook_payload')),
+                ('status', models.CharField(choices=[('pending', 'The event is waiting to be processed'), ('processing', 'The event is claimed by a worker'), ('done', 'The event was processed successfully'), ('failed', 'The event failed too many times and will not be retried')], default='pending', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, help_text='The event is not picked up by a worker before this moment.\n        Used for the lease of a claimed event and for the backoff between retries.')),
+                ('claim_token', models.CharField(blank=True, max_length=32, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'available_at'], name='hotel_webho_status_28a4e9_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-17 04:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0002_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='hotel',
+            name='pms_hotel_id',
+            field=models.CharField(db_index=True, help_text='The hotel ID from the Property Management System', max_length=200),
+        ),
+    ]
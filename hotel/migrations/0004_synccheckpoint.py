@@ -0,0 +1,33 @@
+# Generated by Django 4.2.2 on 2026-10-17 04:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0003_hotel_pms_hotel_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pms_name', models.CharField(max_length=50)),
+                ('checkin_date', models.DateField()),
+                ('status', models.CharField(choices=[('running', 'The hotel is being synced'), ('done', 'All stays of the hotel were synced'), ('failed', 'The sync failed or is incomplete and should be retried')], default='running', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('hotel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_checkpoints', to='hotel.hotel')),
+            ],
+            options={
+                'unique_together': {('pms_name', 'hotel', 'checkin_date')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.2 on 2026-10-17 04:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0004_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='guest',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', editable=False, help_text='Hash of the synced fields, empty when unknown', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='stay',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', editable=False, help_text='Hash of the synced fields, empty when unknown', max_length=32),
+        ),
+    ]
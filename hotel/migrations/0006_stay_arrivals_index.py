@@ -0,0 +1,17 @@
+# Generated by Django 4.2.2 on 2026-10-17 04:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0005_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stay',
+            index=models.Index(fields=['hotel', 'checkin', 'status'], name='stay_arrivals_idx'),
+        ),
+    ]
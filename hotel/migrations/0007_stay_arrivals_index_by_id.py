@@ -0,0 +1,21 @@
+# Generated by Django 4.2.2 on 2026-10-17 05:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0006_stay_arrivals_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='stay',
+            name='stay_arrivals_idx',
+        ),
+        migrations.AddIndex(
+            model_name='stay',
+            index=models.Index(fields=['hotel', 'checkin', 'id'], name='stay_arrivals_idx'),
+        ),
+    ]
@@ -1,4 +1,7 @@
+import hashlib
+
 from django.db import models
+from django.utils import timezone
 
 
 class Language(models.TextChoices):
@@ -16,7 +19,11 @@ class Language(models.TextChoices):
 class Hotel(models.Model):
     name = models.CharField(max_length=200)
     city = models.CharField(max_length=200, blank=False, null=False)
-    pms_hotel_id = models.CharField(max_length=200)
+    pms_hotel_id = models.CharField(
+        max_length=200,
+        db_index=True,
+        help_text="The hotel ID from the Property Management System",
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -24,11 +31,51 @@ class Hotel(models.Model):
         return f"{self.city} - {self.name}"
 
 
-class Guest(models.Model):
+def fingerprint(*values) -> str:
+    """
+    A short hash of the values, e.g. of a model and of the same model loaded from the database.
+    Values are compared by their string, so Stay.Status.BEFORE and "before" are the same.
+    """
+    key = repr(tuple(None if value is None else str(value) for value in values))
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+class FingerprintedModel(models.Model):
+    """
+    Stores a fingerprint of the FINGERPRINT_FIELDS, so bulk writes can skip rows that wouldn't change
+    by comparing one column (see hotel.bulk). Bulk writes set the fingerprint themselves, save() updates it.
+    """
+
+    FINGERPRINT_FIELDS = ()
+
+    fingerprint = models.CharField(
+        max_length=32,
+        blank=True,
+        default="",
+        editable=False,
+        help_text="Hash of the synced fields, empty when unknown",
+    )
+
+    class Meta:
+        abstract = True
+
+    def compute_fingerprint(self) -> str:
+        return fingerprint(*(getattr(self, field) for field in self.FINGERPRINT_FIELDS))
+
+    def save(self, *args, **kwargs):
+        self.fingerprint = self.compute_fingerprint()
+        if kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "fingerprint"}
+        super().save(*args, **kwargs)
+
+
+class Guest(FingerprintedModel):
     """
     Guests are identified by their phone number.
     """
 
+    FINGERPRINT_FIELDS = ("name", "language")
+
     name = models.CharField(max_length=200)
     phone = models.CharField(
         max_length=200,
@@ -41,13 +88,15 @@ class Guest(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
 
-class Stay(models.Model):
+class Stay(FingerprintedModel):
     """
     One guest can stay in multiple hotels.
     One hotel can have multiple guests and multiple stays.
     Stays are unique by hotel and pms_reservation_id.
     """
 
+    FINGERPRINT_FIELDS = ("guest_id", "pms_guest_id", "status", "checkin", "checkout")
+
     class Status(models.TextChoices):
         CANCEL = "cancel", "The guest has cancelled the reservation"
         BEFORE = "before", "The guest has not checked in yet"
@@ -83,3 +132,72 @@ class Stay(models.Model):
 
     class Meta:
         unique_together = ("hotel", "pms_reservation_id")
+        indexes = [models.Index(fields=["hotel", "checkin", "id"], name="stay_arrivals_idx")]
+
+
+class WebhookEvent(models.Model):
+    """
+    A cleaned webhook payload waiting to be handled by a background worker.
+    Events are delivered at least once: a worker claims an event for a limited time (lease)
+    and when it dies before finishing, the event becomes available again after the lease.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "The event is waiting to be processed"
+        PROCESSING = "processing", "The event is claimed by a worker"
+        DONE = "done", "The event was processed successfully"
+        FAILED = "failed", "The event failed too many times and will not be retried"
+
+    pms_name = models.CharField(max_length=50)
+    payload = models.JSONField(help_text="The output of PMS.clean_webhook_payload")
+    status = models.CharField(
+        choices=Status.choices, default=Status.PENDING, max_length=20
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(
+        default=timezone.now,
+        help_text="""The event is not picked up by a worker before this moment.
+        Used for the lease of a claimed event and for the backoff between retries.""",
+    )
+    claim_token = models.CharField(max_length=32, blank=True, null=True)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "available_at"])]
+
+    def __str__(self):
+        return f"{self.pms_name} webhook {self.pk} ({self.status})"
+
+
+class SyncCheckpoint(models.Model):
+    """
+    Progress of the arrivals sync of one hotel for one checkin date (see the sync_arrivals command).
+    An interrupted sync continues with the hotels that are not done, and a failed hotel can be
+    retried without syncing the others again.
+    """
+
+    class Status(models.TextChoices):
+        RUNNING = "running", "The hotel is being synced"
+        DONE = "done", "All stays of the hotel were synced"
+        FAILED = "failed", "The sync failed or is incomplete and should be retried"
+
+    pms_name = models.CharField(max_length=50)
+    hotel = models.ForeignKey(Hotel, on_delete=models.CASCADE, related_name="sync_checkpoints")
+    checkin_date = models.DateField()
+    status = models.CharField(
+        choices=Status.choices, default=Status.RUNNING, max_length=20
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("pms_name", "hotel", "checkin_date")
+
+    def __str__(self):
+        return f"{self.pms_name} sync of {self.hotel_id} for {self.checkin_date} ({self.status})"
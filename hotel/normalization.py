@@ -0,0 +1,153 @@
+import re
+from functools import lru_cache
+from typing import Iterable, Optional
+
+from hotel.models import Language
+
+"""
+Normalization of guest contact data from the PMS APIs: phone numbers to E.164 and countries to a Language.
+Both are memoized with a bounded cache, bulk imports see the same values over and over.
+"""
+
+CACHE_SIZE = 65_536
+
+# E.164: a + followed by the country code and subscriber number, at most 15 digits.
+# Shorter than 8 digits is not a real international number ("+123").
+E164_RE = re.compile(r"\+[1-9]\d{7,14}")
+PHONE_SEPARATORS_RE = re.compile(r"[\s\-./()]")
+
+# Country calling codes, to turn national numbers (0612345678) into E.164 when the region is known
+CALLING_CODES = {
+    "AT": "43",
+    "BE": "32",
+    "CH": "41",
+    "DE": "49",
+    "DK": "45",
+    "ES": "34",
+    "FR": "33",
+    "GB": "44",
+    "GG": "44",
+    "IE": "353",
+    "IT": "39",
+    "LU": "352",
+    "NL": "31",
+    "PT": "351",
+    "SE": "46",
+}
+
+# The languages spoken in a country that we support, the most common first.
+# Countries that aren't listed get DEFAULT_LANGUAGE.
+COUNTRY_LANGUAGES = {
+    "AD": (Language.SPANISH_SPAIN, Language.FRENCH),
+    "AO": (Language.PORTUGUESE_PORTUGAL,),
+    "AR": (Language.SPANISH_SPAIN,),
+    "AT": (Language.GERMAN,),
+    "AU": (Language.BRITISH_ENGLISH,),
+    "BE": (Language.DUTCH, Language.FRENCH, Language.GERMAN),
+    "BR": (Language.PORTUGUESE_PORTUGAL,),
+    "CA": (Language.BRITISH_ENGLISH, Language.FRENCH),
+    "CH": (Language.GERMAN, Language.FRENCH, Language.ITALIAN),
+    "CL": (Language.SPANISH_SPAIN,),
+    "CO": (Language.SPANISH_SPAIN,),
+    "DE": (Language.GERMAN,),
+    "DK": (Language.DANISH,),
+    "ES": (Language.SPANISH_SPAIN,),
+    # Finnish isn't supported and most Finns don't speak Swedish, guests who prefer it get Swedish
+    "FI": (Language.BRITISH_ENGLISH, Language.SWEDISH),
+    "FO": (Language.DANISH,),
+    "FR": (Language.FRENCH,),
+    "GB": (Language.BRITISH_ENGLISH,),
+    "GG": (Language.BRITISH_ENGLISH, Language.FRENCH),
+    "GL": (Language.DANISH,),
+    "IE": (Language.BRITISH_ENGLISH,),
+    "IM": (Language.BRITISH_ENGLISH,),
+    "IT": (Language.ITALIAN,),
+    "JE": (Language.BRITISH_ENGLISH, Language.FRENCH),
+    "LI": (Language.GERMAN,),
+    "LU": (Language.FRENCH, Language.GERMAN),
+    "MC": (Language.FRENCH, Language.ITALIAN),
+    "MX": (Language.SPANISH_SPAIN,),
+    "MZ": (Language.PORTUGUESE_PORTUGAL,),
+    "NL": (Language.DUTCH,),
+    "NZ": (Language.BRITISH_ENGLISH,),
+    "PE": (Language.SPANISH_SPAIN,),
+    "PT": (Language.PORTUGUESE_PORTUGAL,),
+    "SE": (Language.SWEDISH,),
+    "SM": (Language.ITALIAN,),
+    "SR": (Language.DUTCH,),
+    "US": (Language.BRITISH_ENGLISH, Language.SPANISH_SPAIN),
+    "VA": (Language.ITALIAN,),
+    "ZA": (Language.BRITISH_ENGLISH,),
+}
+
+# English is the best guess for guests from countries whose languages we don't support
+DEFAULT_LANGUAGE = Language.BRITISH_ENGLISH
+COUNTRY_RE = re.compile(r"[A-Z]{2}")
+
+
+def normalize_phone(value, default_region: Optional[str] = None) -> Optional[str]:
+    """
+    Return the phone number in E.164 format (+31612345678), or None if it is not usable.
+    National numbers (starting with a single 0) are only accepted when default_region is given.
+    """
+    if not isinstance(value, str):
+        return None
+    return _normalize_phone(value, default_region)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _normalize_phone(value: str, default_region: Optional[str]) -> Optional[str]:
+    phone = PHONE_SEPARATORS_RE.sub("", value)
+    if phone.startswith("00"):
+        phone = "+" + phone[2:]
+    elif phone.startswith("0") and default_region in CALLING_CODES:
+        phone = "+" + CALLING_CODES[default_region] + phone[1:]
+    return phone if E164_RE.fullmatch(phone) else None
+
+
+def normalize_phones(values: Iterable, default_region: Optional[str] = None) -> list[Optional[str]]:
+    """
+    normalize_phone for a whole list, every distinct value is normalized once.
+    """
+    values = list(values)
+    normalized = {}
+    for value in values:
+        if isinstance(value, str) and value not in normalized:
+            normalized[value] = _normalize_phone(value, default_region)
+    return [normalized.get(value) if isinstance(value, str) else None for value in values]
+
+
+def language_for_country(country, preferred: Optional[str] = None) -> Optional[str]:
+    """
+    Return the Language for an ISO 3166-1 alpha-2 country code, or None if the code is missing or invalid.
+    For multilingual countries the preferred language is used when it is spoken there,
+    otherwise the most common one.
+    """
+    if not isinstance(country, str):
+        return None
+    return _language_for_country(country, preferred)
+
+
+@lru_cache(maxsize=1024)
+def _language_for_country(country: str, preferred: Optional[str]) -> Optional[str]:
+    country = country.strip().upper()
+    if not COUNTRY_RE.fullmatch(country):
+        return None
+    languages = COUNTRY_LANGUAGES.get(country)
+    if languages is None:
+        return DEFAULT_LANGUAGE
+    return preferred if preferred in languages else languages[0]
+
+
+def languages_for_countries(countries: Iterable, preferred: Optional[str] = None) -> list[Optional[str]]:
+    """
+    language_for_country for a whole list.
+    """
+    return [language_for_country(country, preferred) for country in countries]
+
+
+def cache_info() -> dict:
+    return {
+        "phones": _normalize_phone.cache_info()._asdict(),
+        "countries": _language_for_country.cache_info()._asdict(),
+    }
@@ -1,17 +1,54 @@
 from abc import ABC, abstractmethod
-import inspect
-import sys
+import datetime
+from importlib.metadata import entry_points
+import json
+import logging
+import threading
 
-from typing import Optional
+from typing import Iterable, Iterator, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
 
 from hotel.external_api import (
     get_reservations_for_given_checkin_date,
     get_reservation_details,
     get_guest_details,
+    aget_reservations_for_given_checkin_date,
+    aget_reservation_details,
+    aget_guest_details,
     APIError,
 )
 
-from hotel.models import Stay, Guest, Hotel
+from hotel import metrics
+from hotel.api_client import ResilientClient, get_api_client
+from hotel.bulk import ReservationRow, chunked, upsert_reservations
+from hotel.cache import TieredCache, get_guest_cache
+from hotel.coalescing import EventCoalescer, get_coalescer
+from hotel.concurrency import Outcome, gather_concurrently, get_single_flight, run_concurrently
+from hotel.models import Stay, Hotel
+from hotel.normalization import language_for_country, normalize_phone
+from hotel.resolvers import hotel_resolver
+from hotel.schema import (
+    INVALID,
+    Field,
+    Record,
+    Schema,
+    choice,
+    const,
+    int_range,
+    list_of,
+    optional,
+    parse_bool,
+    parse_date,
+    parse_str,
+    parse_uuid,
+)
+from hotel.streaming import iter_json_array
+from hotel.write_buffer import write_reservations
+
+logger = logging.getLogger(__name__)
 
 
 class PMS(ABC):
@@ -19,14 +56,59 @@ class PMS(ABC):
     Abstract class for Property Management Systems.
     """
 
-    def __init__(self):
-        pass
+    # The functions of the external API of the PMS by name, called through self.api
+    api_endpoints = {}
+    # Coroutine functions of the same endpoints, called with self.api.acall. Endpoints without one
+    # are called in a thread.
+    async_api_endpoints = {}
+
+    # Methods that subclasses implement, every call is timed as a stage of its own (see hotel.metrics)
+    TIMED_METHODS = (
+        "clean_webhook_payload",
+        "handle_webhook",
+        "update_tomorrows_stays",
+        "update_stays",
+        "fetch_arrivals",
+        "save_arrivals",
+        "stay_has_breakfast",
+        "save_reservations",
+        "fetch_reservation",
+        "fetch_guest",
+        "ahandle_webhook",
+        "aupdate_stays",
+        "astay_has_breakfast",
+        "asave_reservations",
+        "afetch_reservation",
+        "afetch_guest",
+    )
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for method_name in PMS.TIMED_METHODS:
+            if method_name in cls.__dict__:
+                setattr(cls, method_name, metrics.timed_method(method_name)(cls.__dict__[method_name]))
+
+    def __init__(self, max_concurrency: Optional[int] = None):
+        # The maximum number of external API calls this PMS makes at the same time
+        self.max_concurrency = max_concurrency or settings.PMS_MAX_CONCURRENCY
 
     @property
     def name(self):
         longname = self.__class__.__name__
         return longname[4:]
 
+    @property
+    def api(self) -> ResilientClient:
+        return get_api_client(self.name, self.api_endpoints, self.async_api_endpoints)
+
+    @property
+    def coalescer(self) -> EventCoalescer:
+        return get_coalescer(self.name)
+
+    @property
+    def guest_cache(self) -> TieredCache:
+        return get_guest_cache(self.name)
+
     @abstractmethod
     def clean_webhook_payload(self, payload: str) -> dict:
         """
@@ -36,10 +118,11 @@ class PMS(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def handle_webhook(self, webhook_data: dict) -> bool:
+    def handle_webhook(self, webhook_data: dict, retry: bool = False) -> bool:
         """
         This method is called when we receive a webhook from the PMS.
         Handle webhook handles the events and updates relevant models in the database.
+        retry is True when an earlier attempt failed, its writes may be lost: don't skip any work.
         Requirements:
             - Now that the PMS has notified you about an update of a reservation, you need to
                 get more details of this reservation. For this, you can use the mock API
@@ -62,6 +145,28 @@ class PMS(ABC):
         """
         raise NotImplementedError
 
+    def update_stays(self, checkin_date: datetime.date, hotel: Optional[Hotel] = None) -> bool:
+        """
+        Update or create the Stays checking in on checkin_date, like update_tomorrows_stays.
+        With a hotel, only the stays of that hotel are updated: the sync_arrivals management command
+        syncs every hotel separately, so hotels can be synced in parallel and retried on their own.
+        """
+        raise NotImplementedError
+
+    def fetch_arrivals(self, checkin_date: datetime.date, hotel: Optional[Hotel] = None):
+        """
+        The first half of update_stays: fetch the reservations checking in on checkin_date from the PMS API.
+        With a hotel, only the reservations of that hotel are fetched.
+        """
+        raise NotImplementedError
+
+    def save_arrivals(self, checkin_date: datetime.date, data, hotel: Optional[Hotel] = None) -> bool:
+        """
+        The second half of update_stays: update or create the Stays of the response of fetch_arrivals.
+        The multi-day sync (see hotel.arrivals_sync) fetches the next dates while it saves the current one.
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def stay_has_breakfast(self, stay: Stay) -> Optional[bool]:
         """
@@ -71,31 +176,511 @@ class PMS(ABC):
         """
         raise NotImplementedError
 
+    # Async counterparts for async views and tasks. These run the sync methods in a thread,
+    # a PMS can override them with implementations that don't hold a thread while waiting for the API.
+
+    async def ahandle_webhook(self, webhook_data: dict, retry: bool = False) -> bool:
+        return await sync_to_async(self.handle_webhook)(webhook_data, retry)
+
+    async def aupdate_tomorrows_stays(self) -> bool:
+        tomorrow = timezone.localdate() + datetime.timedelta(days=1)
+        return await self.aupdate_stays(tomorrow)
+
+    async def aupdate_stays(self, checkin_date: datetime.date, hotel: Optional[Hotel] = None) -> bool:
+        return await sync_to_async(self.update_stays)(checkin_date, hotel)
+
+    async def afetch_arrivals(self, checkin_date: datetime.date, hotel: Optional[Hotel] = None):
+        return await sync_to_async(self.fetch_arrivals)(checkin_date, hotel)
+
+    async def astay_has_breakfast(self, stay: Stay) -> Optional[bool]:
+        return await sync_to_async(self.stay_has_breakfast)(stay)
+
+    def stay_has_breakfast_many(self, stays: Iterable[Stay], max_age: float = 0) -> dict[int, Optional[bool]]:
+        """
+        Returns {stay.pk: stay_has_breakfast(stay)} for all stays, with the lookups running concurrently.
+        Concurrent lookups of the same reservation, also from other threads, share one call to the PMS.
+        With max_age > 0, an answer from at most max_age seconds ago may be returned instead of calling
+        the PMS. Keep it to a few seconds: we want real time data.
+        """
+        flight = get_single_flight(f"{self.name}:breakfast")
+        stays = list(stays)
+
+        def key(stay: Stay) -> tuple:
+            return stay.hotel_id, stay.pms_reservation_id
+
+        def lookup(stay: Stay) -> Optional[bool]:
+            return flight.do(key(stay), lambda: self.stay_has_breakfast(stay), max_age)
+
+        unique_stays = {key(stay): stay for stay in stays}
+        outcomes = run_concurrently(lookup, unique_stays.values(), self.max_concurrency)
+        answers = {key(outcome.item): outcome.result for outcome in outcomes}
+        return {stay.pk: answers[key(stay)] for stay in stays}
 
+
+class ArrivalsOutcome:
+    """
+    Whether all arrivals of a date were saved, for the sync and async paths of a PMS. The API error or
+    the response that turns out not to be a list that ends a sync is logged, and the sync has failed:
+    batches saved before the invalid part of a response are kept.
+    """
+
+    def __init__(self, checkin_date: datetime.date):
+        self.checkin_date = checkin_date
+        self.success = True
+
+    def __enter__(self) -> "ArrivalsOutcome":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        if exc_type is None:
+            return False
+        if issubclass(exc_type, APIError):
+            logger.warning("Could not fetch the reservations checking in on %s: %s", self.checkin_date, exc)
+        elif issubclass(exc_type, ValueError):
+            logger.warning("Reservations checking in on %s are not a valid list: %s", self.checkin_date, exc)
+        else:
+            return False
+        self.success = False
+        return True
+
+
+class UnknownPMS(LookupError):
+    pass
+
+
+# PMS classes by lowercase name, e.g. "mews"
+PMS_CLASSES = {}
+ENTRY_POINT_GROUP = "integrations.pms"
+_instances = {}
+_instances_lock = threading.Lock()
+_entry_points_loaded = False
+
+
+def register_pms(cls: type[PMS]) -> type[PMS]:
+    """
+    Class decorator that makes a PMS available to get_pms. The class name should be PMS_<Name>.
+    """
+    if not cls.__name__.startswith("PMS_"):
+        raise ValueError(f"PMS class {cls.__name__} should be named PMS_<Name>")
+    PMS_CLASSES[cls.__name__[4:].lower()] = cls
+    return cls
+
+
+@register_pms
 class PMS_Mews(PMS):
+    # Mews reservation states mapped onto our Stay statuses
+    STATUSES = {
+        "booked": Stay.Status.BEFORE,
+        "not_confirmed": Stay.Status.BEFORE,
+        "in_house": Stay.Status.INSTAY,
+        "checked_out": Stay.Status.AFTER,
+        "cancelled": Stay.Status.CANCEL,
+        # The guest never showed up, for us that is the same as a cancellation
+        "no_show": Stay.Status.CANCEL,
+    }
+
+    WEBHOOK_EVENT = Schema(
+        "MewsWebhookEvent",
+        [
+            Field("name", "Name", const("ReservationUpdated"), required=True),
+            Field("reservation_id", "Value.ReservationId", parse_uuid, required=True),
+        ],
+    )
+    WEBHOOK = Schema(
+        "MewsWebhook",
+        [
+            Field("hotel_id", "HotelId", parse_uuid, required=True),
+            # Events we don't handle and events without a valid ReservationId are left out
+            Field("events", "Events", list_of(WEBHOOK_EVENT), required=True),
+        ],
+    )
+    RESERVATION = Schema(
+        "MewsReservation",
+        [
+            Field("reservation_id", "ReservationId", parse_uuid, required=True),
+            Field("hotel_id", "HotelId", parse_uuid, required=True),
+            Field("guest_id", "GuestId", parse_uuid),
+            Field("status", "Status", choice(STATUSES), default=Stay.Status.UNKNOWN),
+            Field("checkin", "CheckInDate", parse_date),
+            Field("checkout", "CheckOutDate", parse_date),
+            Field("breakfast_included", "BreakfastIncluded", parse_bool),
+            Field("room_number", "RoomNumber", int_range(1, 99999)),
+        ],
+    )
+    GUEST = Schema(
+        "MewsGuest",
+        [
+            Field("name", "Name", parse_str, default=""),
+            # Guests are identified by their phone, guests without a usable phone can't be stored
+            Field("phone", "Phone", optional(normalize_phone)),
+            Field("language", "Country", optional(language_for_country)),
+        ],
+    )
+
+    api_endpoints = {
+        "get_reservations_for_given_checkin_date": get_reservations_for_given_checkin_date,
+        "get_reservation_details": get_reservation_details,
+        "get_guest_details": get_guest_details,
+    }
+    async_api_endpoints = {
+        "get_reservations_for_given_checkin_date": aget_reservations_for_given_checkin_date,
+        "get_reservation_details": aget_reservation_details,
+        "get_guest_details": aget_guest_details,
+    }
+
     def clean_webhook_payload(self, payload: str) -> dict:
-        # TODO: Implement the method
-        return {}
+        """
+        Returns {"HotelId": str, "ReservationIds": [str, ...]}, or an empty dict when the payload is unusable.
+        """
+        try:
+            data = json.loads(payload)
+        except (TypeError, ValueError):
+            return {}
 
-    def handle_webhook(self, webhook_data: dict) -> bool:
-        # TODO: Implement the method
-        return True
+        webhook, errors = self.WEBHOOK.run(data)
+        if errors is not None:
+            logger.warning("Invalid webhook payload: %s", errors)
+            return {}
+        return {"HotelId": webhook.hotel_id, "ReservationIds": [event.reservation_id for event in webhook.events]}
+
+    def handle_webhook(self, webhook_data: dict, retry: bool = False) -> bool:
+        """
+        Fetches the details of all updated reservations concurrently, then saves them in bulk.
+        Reservations that are being fetched for another webhook are not fetched twice, see hotel.coalescing,
+        unless this is a retry.
+        The webhook workers buffer the writes of many webhooks, see hotel.write_buffer.
+        A failing reservation doesn't stop the others, but makes the webhook fail so the PMS retries it.
+        """
+        if not webhook_data:
+            return False
+
+        with metrics.stage("hotel_lookup", self.name):
+            hotel = hotel_resolver.resolve(webhook_data["HotelId"])
+        hotel_label = self.webhook_hotel_label(webhook_data, hotel)
+        if hotel_label is None:
+            return False
+
+        with metrics.stage("api_fetch", self.name, hotel_label), self.coalescer.fetching(
+            hotel.pms_hotel_id, webhook_data["ReservationIds"], force=retry
+        ) as fetch:
+            while fetch.pending:
+                fetch.done(run_concurrently(self.fetch_reservation, fetch.pending, self.max_concurrency))
+        rows, success = self.webhook_rows(hotel, fetch.outcomes)
+
+        with metrics.stage("db_write", self.name, hotel_label):
+            write_reservations(rows)
+        return success
+
+    async def ahandle_webhook(self, webhook_data: dict, retry: bool = False) -> bool:
+        """
+        handle_webhook without holding a thread while waiting for the API. The writes need a transaction,
+        which the async ORM doesn't support, so they run in a thread.
+        """
+        if not webhook_data:
+            return False
+
+        with metrics.stage("hotel_lookup", self.name):
+            hotel = await hotel_resolver.aresolve(webhook_data["HotelId"])
+        hotel_label = self.webhook_hotel_label(webhook_data, hotel)
+        if hotel_label is None:
+            return False
+
+        with metrics.stage("api_fetch", self.name, hotel_label), self.coalescer.fetching(
+            hotel.pms_hotel_id, webhook_data["ReservationIds"], force=retry
+        ) as fetch:
+            while fetch.pending:
+                fetch.done(await gather_concurrently(self.afetch_reservation, fetch.pending, self.max_concurrency))
+        rows, success = self.webhook_rows(hotel, fetch.outcomes)
+
+        with metrics.stage("db_write", self.name, hotel_label):
+            await sync_to_async(write_reservations)(rows)
+        return success
+
+    def webhook_hotel_label(self, webhook_data: dict, hotel: Optional[Hotel]) -> Optional[str]:
+        """
+        The metrics label of the hotel of a webhook, and its events counted. None for an unknown hotel.
+        """
+        if hotel is None:
+            logger.warning("Webhook for unknown hotel %s", webhook_data["HotelId"])
+            return None
+
+        hotel_label = metrics.hotel_label(hotel.pms_hotel_id)
+        if settings.METRICS_ENABLED:
+            metrics.WEBHOOK_EVENTS.labels(self.name, hotel_label).inc(len(webhook_data["ReservationIds"]))
+        return hotel_label
+
+    def webhook_rows(self, hotel: Hotel, outcomes: list[Outcome]) -> tuple[list[ReservationRow], bool]:
+        """
+        The rows to write for the fetched reservations of a webhook, and whether all fetches succeeded.
+        """
+        success = True
+        rows = []
+        for outcome in outcomes:
+            if outcome.error is not None:
+                logger.warning("Could not fetch reservation %s: %s", outcome.item, outcome.error)
+                success = False
+                continue
+
+            reservation, guest = outcome.result
+            if reservation.hotel_id != hotel.pms_hotel_id:
+                logger.warning("Reservation %s doesn't belong to hotel %s", outcome.item, hotel.pms_hotel_id)
+                continue
+            rows.append(ReservationRow(hotel.pk, reservation, guest))
+        return rows, success
 
     def update_tomorrows_stays(self) -> bool:
-        # TODO: Implement the method
-        return True
+        tomorrow = timezone.localdate() + datetime.timedelta(days=1)
+        return self.update_stays(tomorrow)
+
+    def update_stays(self, checkin_date: datetime.date, hotel: Optional[Hotel] = None) -> bool:
+        """
+        The reservations are parsed one at a time and saved in batches, so only one batch of decoded
+        reservations is kept. The response text itself is held until the sync is done: memory still grows
+        with the number of arrivals of the date. Reservations that can't be used are skipped. When guest details can't be
+        fetched, the Stay is saved without updating its guest, and False is returned so the caller knows
+        the sync is incomplete.
+        """
+        with ArrivalsOutcome(checkin_date) as outcome:
+            data = self.fetch_arrivals(checkin_date, hotel)
+            outcome.success = self.save_arrivals(checkin_date, data, hotel)
+        return outcome.success
+
+    async def aupdate_stays(self, checkin_date: datetime.date, hotel: Optional[Hotel] = None) -> bool:
+        with ArrivalsOutcome(checkin_date) as outcome:
+            data = await self.afetch_arrivals(checkin_date, hotel)
+            outcome.success = await self.asave_arrivals(checkin_date, data, hotel)
+        return outcome.success
+
+    def fetch_arrivals(self, checkin_date: datetime.date, hotel: Optional[Hotel] = None):
+        return self.api.call("get_reservations_for_given_checkin_date", *self.arrivals_arguments(checkin_date, hotel))
+
+    async def afetch_arrivals(self, checkin_date: datetime.date, hotel: Optional[Hotel] = None):
+        return await self.api.acall(
+            "get_reservations_for_given_checkin_date", *self.arrivals_arguments(checkin_date, hotel)
+        )
+
+    def arrivals_arguments(self, checkin_date: datetime.date, hotel: Optional[Hotel]) -> tuple:
+        return (checkin_date.isoformat(),) if hotel is None else (checkin_date.isoformat(), hotel.pms_hotel_id)
+
+    def save_arrivals(self, checkin_date: datetime.date, data, hotel: Optional[Hotel] = None) -> bool:
+        with ArrivalsOutcome(checkin_date) as outcome:
+            for batch in self.arrival_batches(data, hotel):
+                outcome.success &= self.save_reservations(batch)
+        return outcome.success
+
+    async def asave_arrivals(self, checkin_date: datetime.date, data, hotel: Optional[Hotel] = None) -> bool:
+        with ArrivalsOutcome(checkin_date) as outcome:
+            for batch in self.arrival_batches(data, hotel):
+                outcome.success &= await self.asave_reservations(batch)
+        return outcome.success
+
+    def arrival_batches(self, data, hotel: Optional[Hotel]) -> Iterator[list[Record]]:
+        return chunked(self.arrivals(data, hotel), settings.BULK_UPSERT_CHUNK_SIZE)
+
+    def arrivals(self, data, hotel: Optional[Hotel]) -> Iterator[Record]:
+        """
+        The cleaned reservations of a response of get_reservations_for_given_checkin_date, of the hotel if given.
+        Raises ValueError when the response turns out not to be a list.
+        """
+        reservations = self.clean_reservations(iter_json_array(data))
+        if hotel is None:
+            return reservations
+        return (reservation for reservation in reservations if reservation.hotel_id == hotel.pms_hotel_id)
+
+    def clean_reservations(self, items: Iterable) -> Iterator[Record]:
+        """
+        Yield the cleaned reservations, skipping the ones that can't be used.
+        """
+        for item in items:
+            reservation, errors = self.RESERVATION.run(item)
+            if errors is not None:
+                logger.warning("Skipping reservation: %s", errors)
+                continue
+            yield self.fix_reservation(reservation)
+
+    def save_reservations(self, reservations: list[Record]) -> bool:
+        """
+        Fetch the guest details of the cleaned reservations concurrently, then save everything in bulk.
+        Returns False if not all guest details could be fetched.
+        """
+        with metrics.stage("hotel_lookup", self.name):
+            hotels = hotel_resolver.resolve_many(reservation.hotel_id for reservation in reservations)
+
+        with metrics.stage("api_fetch", self.name):
+            outcomes = run_concurrently(self.fetch_guest, self.guest_ids(reservations), self.max_concurrency)
+        rows, success = self.arrival_rows(reservations, hotels, outcomes)
+
+        with metrics.stage("db_write", self.name):
+            upsert_reservations(rows)
+        return success
+
+    async def asave_reservations(self, reservations: list[Record]) -> bool:
+        with metrics.stage("hotel_lookup", self.name):
+            hotels = await hotel_resolver.aresolve_many(reservation.hotel_id for reservation in reservations)
+
+        with metrics.stage("api_fetch", self.name):
+            outcomes = await gather_concurrently(self.afetch_guest, self.guest_ids(reservations), self.max_concurrency)
+        rows, success = self.arrival_rows(reservations, hotels, outcomes)
+
+        with metrics.stage("db_write", self.name):
+            await sync_to_async(upsert_reservations)(rows)
+        return success
+
+    def guest_ids(self, reservations: list[Record]) -> set[str]:
+        return {reservation.guest_id for reservation in reservations if reservation.guest_id is not None}
+
+    def arrival_rows(
+        self, reservations: list[Record], hotels: dict[str, Hotel], guest_outcomes: list[Outcome]
+    ) -> tuple[list[ReservationRow], bool]:
+        """
+        The rows to write for the reservations, and whether the details of all guests were fetched.
+        """
+        success = True
+        guests = {}
+        for outcome in guest_outcomes:
+            if outcome.error is not None:
+                logger.warning("Could not fetch guest %s: %s", outcome.item, outcome.error)
+                success = False
+            else:
+                guests[outcome.item] = outcome.result
+
+        rows = []
+        for reservation in reservations:
+            if reservation.hotel_id not in hotels:
+                logger.warning("Reservation %s for unknown hotel %s", reservation.reservation_id, reservation.hotel_id)
+                continue
+            hotel = hotels[reservation.hotel_id]
+            rows.append(ReservationRow(hotel.pk, reservation, guests.get(reservation.guest_id)))
+        return rows, success
 
     def stay_has_breakfast(self, stay: Stay) -> Optional[bool]:
-        # TODO: Implement the method
+        """
+        Asks the PMS for the current reservation details. Doesn't touch the database,
+        so stay_has_breakfast_many can call it from multiple threads.
+        """
+        reservation_id = parse_uuid(stay.pms_reservation_id)
+        if reservation_id is INVALID:
+            return None
+
+        try:
+            data = self.api.get_reservation_details(reservation_id)
+        except APIError as e:
+            return self.breakfast_unknown(reservation_id, e)
+        return self.breakfast_included(reservation_id, data)
+
+    async def astay_has_breakfast(self, stay: Stay) -> Optional[bool]:
+        reservation_id = parse_uuid(stay.pms_reservation_id)
+        if reservation_id is INVALID:
+            return None
+
+        try:
+            data = await self.api.acall("get_reservation_details", reservation_id)
+        except APIError as e:
+            return self.breakfast_unknown(reservation_id, e)
+        return self.breakfast_included(reservation_id, data)
+
+    def breakfast_included(self, reservation_id: str, data: str) -> Optional[bool]:
+        try:
+            return self.checked_reservation(reservation_id, data).breakfast_included
+        except ValueError as e:
+            return self.breakfast_unknown(reservation_id, e)
+
+    def breakfast_unknown(self, reservation_id: str, error: Exception) -> None:
+        logger.warning("Could not fetch reservation %s: %s", reservation_id, error)
         return None
 
+    def fetch_reservation(self, reservation_id: str) -> tuple[Record, Optional[Record]]:
+        """
+        Get the cleaned reservation and guest details from the API.
+        Doesn't touch the database, so it is safe to call from multiple threads.
+        Raises APIError when the API fails, ValueError when it returns unusable data.
+        """
+        reservation = self.checked_reservation(reservation_id, self.api.get_reservation_details(reservation_id))
+        guest = None
+        if reservation.guest_id is not None:
+            guest = self.fetch_guest(reservation.guest_id)
+        return reservation, guest
 
-def get_pms(name):
-    fullname = "PMS_" + name.capitalize()
-    # find all class names in this module
-    # from https://stackoverflow.com/questions/1796180/
-    current_module = sys.modules[__name__]
-    clsnames = [x[0] for x in inspect.getmembers(current_module, inspect.isclass)]
+    async def afetch_reservation(self, reservation_id: str) -> tuple[Record, Optional[Record]]:
+        data = await self.api.acall("get_reservation_details", reservation_id)
+        reservation = self.checked_reservation(reservation_id, data)
+        guest = None
+        if reservation.guest_id is not None:
+            guest = await self.afetch_guest(reservation.guest_id)
+        return reservation, guest
 
-    # if we have a PMS class for the given name, return an instance of it
-    return getattr(current_module, fullname)() if fullname in clsnames else False
+    def fetch_guest(self, guest_id: str) -> Record:
+        """
+        Get the cleaned guest details from the cache or the API. Safe to call from multiple threads.
+        Guest details rarely change, see GUEST_CACHE_TTL. Failed calls are not cached.
+        """
+        return self.guest_cache.get_or_fetch(guest_id, lambda: self.clean_guest(self.api.get_guest_details(guest_id)))
+
+    async def afetch_guest(self, guest_id: str) -> Record:
+        async def fetch() -> Record:
+            return self.clean_guest(await self.api.acall("get_guest_details", guest_id))
+
+        return await self.guest_cache.aget_or_fetch(guest_id, fetch)
+
+    def checked_reservation(self, reservation_id: str, data: str) -> Record:
+        """
+        The cleaned reservation of a get_reservation_details response, which must be the requested one.
+        Raises ValueError otherwise.
+        """
+        reservation = self.clean_reservation(json.loads(data))
+        if reservation.reservation_id != reservation_id:
+            raise ValueError(f"Got details of reservation {reservation.reservation_id}")
+        return reservation
+
+    def clean_guest(self, data: str) -> Record:
+        return self.GUEST.validate(json.loads(data))
+
+    def clean_reservation(self, data) -> Record:
+        """
+        Clean a decoded reservation from the API. Raises SchemaError (a ValueError) if it can't be identified.
+        """
+        return self.fix_reservation(self.RESERVATION.validate(data))
+
+    def fix_reservation(self, reservation: Record) -> Record:
+        """
+        Checks that involve more than one field: a checkout before the checkin can't be right.
+        """
+        if reservation.checkin and reservation.checkout and reservation.checkout < reservation.checkin:
+            reservation.checkout = None
+        return reservation
+
+
+def get_pms(name: str) -> PMS:
+    """
+    Returns the instance of the PMS with the given name (case insensitive), shared by the whole process.
+    Raises UnknownPMS if there is no such PMS.
+    """
+    if not _entry_points_loaded:
+        load_entry_points()
+
+    key = name.lower()
+    instance = _instances.get(key)
+    if instance is None:
+        if key not in PMS_CLASSES:
+            raise UnknownPMS(name)
+        with _instances_lock:
+            instance = _instances.get(key) or PMS_CLASSES[key]()
+            _instances[key] = instance
+    return instance
+
+
+def load_entry_points() -> None:
+    """
+    Register the PMS classes of installed packages. A package adds a PMS with an entry point in the
+    group "integrations.pms" that points to a PMS subclass, named PMS_<Name> like the classes in this module.
+    """
+    global _entry_points_loaded
+    with _instances_lock:
+        if _entry_points_loaded:
+            return
+        for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+            try:
+                register_pms(entry_point.load())
+            except Exception:
+                logger.exception("Could not load PMS entry point %s", entry_point.name)
+        _entry_points_loaded = True
@@ -0,0 +1,93 @@
+from typing import Iterable, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from hotel import metrics
+from hotel.cache import MISSING, TTLCache
+from hotel.models import Hotel
+
+"""
+Every webhook and sync maps the HotelId of the PMS to a Hotel. Hotels hardly ever change,
+so they are cached in the process. Saving or deleting a Hotel clears the cache (see hotel.signals),
+the TTL limits how long other processes can use a changed Hotel.
+
+Unknown IDs are only cached for a few seconds (HOTEL_CACHE_MISS_TTL): a hotel that is created while
+its webhooks are already coming in must not be rejected by other processes for the full TTL.
+"""
+
+
+class HotelResolver:
+    def __init__(self, maxsize: int, ttl: float, miss_ttl: float):
+        # pms_hotel_id -> Hotel, or None for IDs we don't know
+        self.cache = TTLCache(maxsize, ttl)
+        self.miss_ttl = miss_ttl
+
+    def store(self, pms_hotel_id: str, hotel: Optional[Hotel]) -> None:
+        if hotel is not None:
+            self.cache.set(pms_hotel_id, hotel)
+        elif self.miss_ttl > 0:
+            self.cache.set(pms_hotel_id, None, ttl=self.miss_ttl)
+
+    def resolve(self, pms_hotel_id: str) -> Optional[Hotel]:
+        return self.resolve_many([pms_hotel_id]).get(pms_hotel_id)
+
+    async def aresolve(self, pms_hotel_id: str) -> Optional[Hotel]:
+        return (await self.aresolve_many([pms_hotel_id])).get(pms_hotel_id)
+
+    def resolve_many(self, pms_hotel_ids: Iterable[str]) -> dict[str, Hotel]:
+        """
+        Returns the known hotels by pms_hotel_id, with one query for all IDs that are not cached.
+        """
+        hotels, missing = self.cached(pms_hotel_ids)
+        if missing:
+            hotels.update(self.load(missing))
+        return hotels
+
+    async def aresolve_many(self, pms_hotel_ids: Iterable[str]) -> dict[str, Hotel]:
+        hotels, missing = self.cached(pms_hotel_ids)
+        if missing:
+            hotels.update(await sync_to_async(self.load)(missing))
+        return hotels
+
+    def cached(self, pms_hotel_ids: Iterable[str]) -> tuple[dict[str, Hotel], set[str]]:
+        """
+        The cached hotels by pms_hotel_id, and the IDs that are not cached.
+        """
+        hotels = {}
+        missing = set()
+        for pms_hotel_id in set(pms_hotel_ids):
+            hotel = self.cache.get(pms_hotel_id)
+            if hotel is MISSING:
+                missing.add(pms_hotel_id)
+            elif hotel is not None:
+                hotels[pms_hotel_id] = hotel
+        return hotels, missing
+
+    def load(self, pms_hotel_ids: set[str]) -> dict[str, Hotel]:
+        """
+        Query and cache the hotels, unknown IDs are cached as well (see HOTEL_CACHE_MISS_TTL).
+        """
+        found = {}
+        for hotel in Hotel.objects.filter(pms_hotel_id__in=pms_hotel_ids).order_by("pk"):
+            found.setdefault(hotel.pms_hotel_id, hotel)
+        for pms_hotel_id in pms_hotel_ids:
+            self.store(pms_hotel_id, found.get(pms_hotel_id))
+        return found
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+
+hotel_resolver = HotelResolver(
+    settings.HOTEL_CACHE_MAXSIZE, settings.HOTEL_CACHE_TTL, settings.HOTEL_CACHE_MISS_TTL
+)
+
+
+def collect_metrics() -> list:
+    return metrics.collect_stats(
+        "hotel_resolver_cache", "Hotels by pms_hotel_id", [({}, hotel_resolver.cache.stats())], gauges=("size",)
+    )
+
+
+metrics.registry.register_collector(collect_metrics)
@@ -0,0 +1,251 @@
+import calendar
+import datetime
+import logging
+import re
+from typing import Any, Callable, NamedTuple
+
+"""
+A small declarative schema layer for the payloads of the PMS APIs.
+A Schema is compiled once into a validator function that maps a decoded JSON object onto a record
+class with __slots__, and collects all errors of the object in one pass.
+
+Parsers are plain functions that return the cleaned value, or INVALID. They don't raise exceptions,
+so garbage data doesn't cost an exception per field.
+"""
+
+logger = logging.getLogger(__name__)
+
+INVALID = object()
+
+
+class SchemaError(ValueError):
+    def __init__(self, schema_name: str, errors: list[tuple[str, str]]):
+        self.errors = errors
+        super().__init__(f"Invalid {schema_name}: " + "; ".join(f"{path}: {message}" for path, message in errors))
+
+
+UUID_RE = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+DATE_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+
+
+def parse_uuid(value):
+    """
+    A UUID in the canonical 8-4-4-4-12 format, returned in lowercase.
+    """
+    if type(value) is str and UUID_RE.fullmatch(value):
+        return value.lower()
+    return INVALID
+
+
+def parse_date(value):
+    """
+    A date in the format YYYY-MM-DD.
+    """
+    match = DATE_RE.fullmatch(value) if type(value) is str else None
+    if match is None:
+        return INVALID
+    year, month, day = int(match[1]), int(match[2]), int(match[3])
+    if year < 1 or not 1 <= month <= 12 or not 1 <= day <= calendar.monthrange(year, month)[1]:
+        return INVALID
+    return datetime.date(year, month, day)
+
+
+def parse_str(value):
+    """
+    A string without surrounding whitespace.
+    """
+    return value.strip() if type(value) is str else INVALID
+
+
+def parse_bool(value):
+    return value if type(value) is bool else INVALID
+
+
+def int_range(minimum: int, maximum: int) -> Callable:
+    def parse(value):
+        return value if type(value) is int and minimum <= value <= maximum else INVALID
+
+    return parse
+
+
+def choice(mapping: dict) -> Callable:
+    """
+    A string that is mapped onto another value, e.g. a status of the PMS onto our Stay.Status.
+    """
+
+    def parse(value):
+        return mapping.get(value, INVALID) if type(value) is str else INVALID
+
+    return parse
+
+
+def const(expected) -> Callable:
+    def parse(value):
+        return value if value == expected else INVALID
+
+    return parse
+
+
+def optional(parse: Callable) -> Callable:
+    """
+    Adapts a function that returns None for unusable values into a parser.
+    """
+
+    def parser(value):
+        result = parse(value)
+        return INVALID if result is None else result
+
+    return parser
+
+
+def list_of(schema: "Schema") -> Callable:
+    """
+    A list of objects of the schema. Invalid items are left out, their errors are logged as a warning
+    with the index of the item.
+    """
+    run = schema.run
+
+    def parse(value):
+        if type(value) is not list:
+            return INVALID
+        records = []
+        dropped = []
+        for index, item in enumerate(value):
+            record, errors = run(item)
+            if errors is None:
+                records.append(record)
+            else:
+                dropped.append((index, errors))
+        if dropped:
+            logger.warning("Left out %d invalid %s items: %s", len(dropped), schema.name, dropped)
+        return records
+
+    return parse
+
+
+class Field(NamedTuple):
+    """
+    attr: the attribute of the record
+    path: the key in the JSON object, use dots for nested objects ("Value.ReservationId")
+    parse: a parser, see above
+    required: if the value is missing or invalid, the object is invalid. Otherwise the default is used.
+    """
+
+    attr: str
+    path: str
+    parse: Callable
+    required: bool = False
+    default: Any = None
+
+
+class Record:
+    """
+    Base class of the records created by schemas.
+    """
+
+    __slots__ = ()
+
+    def as_dict(self) -> dict:
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        values = ", ".join(f"{attr}={getattr(self, attr)!r}" for attr in self.__slots__)
+        return f"{self.__class__.__name__}({values})"
+
+
+# Record classes by name, to rebuild records from JSON (see record_from_json)
+RECORDS = {}
+
+
+def make_record(name: str, attrs: list[str]) -> type:
+    if name in RECORDS:
+        raise ValueError(f"A record named {name} already exists")
+    source = "def __init__(self, {args}):\n{body}".format(
+        args=", ".join(attrs),
+        body="\n".join(f"    self.{attr} = {attr}" for attr in attrs) or "    pass",
+    )
+    namespace = {}
+    exec(source, namespace)
+    cls = type(name, (Record,), {"__slots__": tuple(attrs), "__init__": namespace["__init__"]})
+    RECORDS[name] = cls
+    return cls
+
+
+class Schema:
+    """
+    Schema("Guest", [Field("name", "Name", parse_str, default=""), ...]) creates the record class
+    Guest(name, ...) and compiles a validator for it.
+    schema.validate(data) returns a record or raises SchemaError with all errors.
+    schema.run(data) returns (record, None) or (None, errors), without raising.
+    """
+
+    def __init__(self, name: str, fields: list[Field]):
+        self.name = name
+        self.fields = fields
+        self.record = make_record(name, [field.attr for field in fields])
+        self.run = self._compile()
+
+    def validate(self, data) -> Record:
+        record, errors = self.run(data)
+        if errors is not None:
+            raise SchemaError(self.name, errors)
+        return record
+
+    def _compile(self) -> Callable:
+        # Generate a function with the checks of every field inlined, e.g. for a required field:
+        #     v = data.get("HotelId")
+        #     f0 = INVALID if v is None else p0(v)
+        #     if f0 is INVALID:
+        #         errors.append(("HotelId", "missing" if v is None else "invalid"))
+        namespace = {"INVALID": INVALID, "Record": self.record}
+        lines = [
+            "def run(data):",
+            "    if type(data) is not dict:",
+            "        return None, [('', 'not an object')]",
+            "    errors = []",
+        ]
+        for i, field in enumerate(self.fields):
+            namespace[f"p{i}"] = field.parse
+            namespace[f"d{i}"] = field.default
+            keys = field.path.split(".")
+            lines.append(f"    v = data.get({keys[0]!r})")
+            for key in keys[1:]:
+                lines.append(f"    v = v.get({key!r}) if type(v) is dict else None")
+            lines.append(f"    f{i} = INVALID if v is None else p{i}(v)")
+            lines.append(f"    if f{i} is INVALID:")
+            if field.required:
+                lines.append(f"        errors.append(({field.path!r}, 'missing' if v is None else 'invalid'))")
+            else:
+                lines.append(f"        f{i} = d{i}")
+        lines.append("    if errors:")
+        lines.append("        return None, errors")
+        lines.append("    return Record({}), None".format(", ".join(f"f{i}" for i in range(len(self.fields)))))
+
+        exec("\n".join(lines), namespace)
+        return namespace["run"]
+
+
+def record_to_json(value) -> dict:
+    """
+    json.dumps(value, default=record_to_json) encodes records and dates.
+    """
+    if isinstance(value, Record):
+        return {"__record__": value.__class__.__name__, **value.as_dict()}
+    if isinstance(value, datetime.date):
+        return {"__date__": value.isoformat()}
+    raise TypeError(f"{value.__class__.__name__} is not JSON serializable")
+
+
+def record_from_json(data: dict):
+    """
+    json.loads(text, object_hook=record_from_json) decodes what record_to_json encoded.
+    """
+    if "__record__" in data:
+        cls = RECORDS[data.pop("__record__")]
+        return cls(**data)
+    if "__date__" in data:
+        return datetime.date.fromisoformat(data["__date__"])
+    return data
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from hotel.arrivals import invalidate_arrivals
+from hotel.models import Hotel, Stay
+from hotel.resolvers import hotel_resolver
+
+
+@receiver(post_save, sender=Hotel)
+@receiver(post_delete, sender=Hotel)
+def clear_hotel_resolver(sender, **kwargs):
+    hotel_resolver.clear()
+
+
+@receiver(pre_save, sender=Stay)
+def remember_stored_arrival(sender, instance, update_fields=None, **kwargs):
+    # A Stay that moves to another hotel or date leaves the arrivals of the stored one
+    instance._stored_arrival = None
+    if instance.pk is not None and (update_fields is None or {"hotel", "checkin"} & set(update_fields)):
+        instance._stored_arrival = Stay.objects.filter(pk=instance.pk).values_list("hotel_id", "checkin").first()
+
+
+@receiver(post_save, sender=Stay)
+@receiver(post_delete, sender=Stay)
+def invalidate_stay_arrivals(sender, instance, **kwargs):
+    keys = [(instance.hotel_id, instance.checkin)]
+    stored = getattr(instance, "_stored_arrival", None)
+    if stored is not None:
+        keys.append(stored)
+    invalidate_arrivals(keys)
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
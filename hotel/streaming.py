@@ -0,0 +1,83 @@
+import json
+from typing import Iterable, Iterator, Union
+
+"""
+Incremental parsing of large JSON arrays, so the items can be processed one by one
+instead of holding the whole decoded list in memory. The text is only released as it is parsed
+when it comes in chunks: a response that is one string is kept until its last item.
+"""
+
+_decoder = json.JSONDecoder()
+WHITESPACE = " \t\n\r"
+SEPARATORS = WHITESPACE + ",]"
+
+
+def iter_json_array(data: Union[str, bytes, Iterable[str]]) -> Iterator:
+    """
+    Yield the items of a JSON array one at a time. data is the JSON text, or an iterable of text chunks
+    (e.g. from a streamed response). Raises ValueError when data is not a JSON array.
+    Items are yielded as they are parsed, so a ValueError can follow after some items were yielded,
+    also for anything but whitespace after the array.
+    """
+    if isinstance(data, bytes):
+        data = data.decode()
+    chunks = iter([data] if isinstance(data, str) else data)
+    buffer = ""
+    position = 0
+    exhausted = False
+
+    def read_more() -> bool:
+        nonlocal buffer, position, exhausted
+        if exhausted:
+            return False
+        for chunk in chunks:
+            if chunk:
+                # Drop what has been parsed already, so the buffer never holds more than a few items
+                buffer = buffer[position:] + chunk
+                position = 0
+                return True
+        exhausted = True
+        return False
+
+    def next_char() -> str:
+        """
+        Skip whitespace and return the next character without consuming it, "" at the end of the data.
+        """
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+            if position < len(buffer) or not read_more():
+                return buffer[position:position + 1]
+
+    if next_char() != "[":
+        raise ValueError("Expected a JSON array")
+    position += 1
+    empty = next_char() == "]"
+    if empty:
+        position += 1
+
+    while not empty:
+        next_char()
+        while True:
+            try:
+                item, end = _decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if read_more():
+                    continue
+                raise ValueError("Invalid JSON array item")
+            # A number that isn't followed by a separator may continue in the next chunk ("1." of "1.5")
+            if (end < len(buffer) and buffer[end] in SEPARATORS) or not read_more():
+                break
+        position = end
+        yield item
+
+        separator = next_char()
+        position += 1
+        if separator == "]":
+            break
+        if separator != ",":
+            raise ValueError("Expected ',' or ']' in JSON array")
+
+    if next_char():
+        raise ValueError("Extra data after the JSON array")
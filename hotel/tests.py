@@ -1,3 +1,1162 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.management import CommandError, call_command
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from hotel import (
+    arrivals,
+    arrivals_sync,
+    bulk,
+    external_api,
+    guests,
+    metrics,
+    normalization,
+    pms_systems,
+    webhook_archive,
+    webhook_queue,
+)
+from hotel.api_client import AdaptiveLimit, CircuitBreaker, ResilientClient, RetryBudget, TokenBucket
+from hotel.cache import MISSING, SQLiteCache, TieredCache, TTLCache
+from hotel.coalescing import EventCoalescer
+from hotel.concurrency import Outcome, SingleFlight
+from hotel.models import Guest, Hotel, Language, Stay, SyncCheckpoint, WebhookEvent
+from hotel.pms_systems import PMS_Mews, get_pms
+from hotel.resolvers import HotelResolver
+from hotel.streaming import iter_json_array
+
+
+class MockAPITestCase(TestCase):
+    """
+    A Mews hotel with a seeded mock API that doesn't fail.
+    """
+
+    def setUp(self):
+        previous_backend = external_api.backend
+        self.addCleanup(setattr, external_api, "backend", previous_backend)
+        self.backend = external_api.configure(seed=0, error_rate=0)
+        self.hotel = Hotel.objects.create(pms_hotel_id=self.backend.hotel_id, name="Hotel", city="Utrecht")
+        self.pms = get_pms("mews")
+        self.pms.coalescer.clear()
+        self.addCleanup(self.pms.coalescer.clear)
+
+
+class EventCoalescerTests(SimpleTestCase):
+    def test_duplicates_in_payload_are_fetched_once(self):
+        coalescer = EventCoalescer()
+        self.assertEqual(coalescer.coalesce("h1", ["r1", "r2", "r1"]), ["r1", "r2"])
+        self.assertEqual(coalescer.stats()["duplicates_in_payload"], 1)
+
+    def test_payload_before_the_fetch_starts_is_merged(self):
+        coalescer = EventCoalescer()
+        self.assertEqual(coalescer.coalesce("h1", ["r1"]), ["r1"])
+        # Another payload while r1 is being fetched: no second fetch now, but one after the first fetch
+        self.assertEqual(coalescer.coalesce("h1", ["r1", "r2"]), ["r2"])
+        self.assertEqual(coalescer.coalesce("h1", ["r1"]), [])
+        self.assertEqual(coalescer.finish("h1", ["r2"]), [])
+        self.assertEqual(coalescer.finish("h1", ["r1"]), ["r1"])
+        self.assertEqual(coalescer.finish("h1", ["r1"]), [])
+        self.assertEqual(coalescer.stats()["duplicates_across_payloads"], 2)
+        self.assertEqual(coalescer.stats()["refetches"], 1)
+
+    def test_events_after_the_fetch_are_fetched_again(self):
+        coalescer = EventCoalescer()
+        coalescer.coalesce("h1", ["r1"])
+        self.assertEqual(coalescer.finish("h1", ["r1"]), [])
+        self.assertEqual(coalescer.coalesce("h1", ["r1"]), ["r1"])
+
+    def test_hotels_are_separate(self):
+        coalescer = EventCoalescer()
+        coalescer.coalesce("h1", ["r1"])
+        self.assertEqual(coalescer.coalesce("h2", ["r1"]), ["r1"])
+
+    def test_release_forgets_dirty_fetches(self):
+        coalescer = EventCoalescer()
+        coalescer.coalesce("h1", ["r1"])
+        coalescer.coalesce("h1", ["r1"])
+        coalescer.release("h1", ["r1"])
+        self.assertEqual(coalescer.finish("h1", ["r1"]), [])
+        self.assertEqual(coalescer.coalesce("h1", ["r1"]), ["r1"])
+
+
+class HandleWebhookCoalescingTests(TestCase):
+    def setUp(self):
+        self.hotel = Hotel.objects.create(pms_hotel_id="hotel-1", name="Hotel", city="Utrecht")
+        self.pms = PMS_Mews()
+        self.pms.coalescer.clear()
+        self.addCleanup(self.pms.coalescer.clear)
+
+    def test_event_during_the_fetch_fetches_again(self):
+        fetched = []
+
+        def fetch_reservation(reservation_id):
+            fetched.append(reservation_id)
+            if len(fetched) == 1:
+                # A webhook for the same reservation arrives while it is being fetched
+                self.assertEqual(self.pms.coalescer.coalesce("hotel-1", [reservation_id]), [])
+            raise ValueError("no details")
+
+        with mock.patch.object(self.pms, "fetch_reservation", fetch_reservation), self.assertLogs("hotel"):
+            self.assertFalse(self.pms.handle_webhook({"HotelId": "hotel-1", "ReservationIds": ["r1", "r1"]}))
+        self.assertEqual(fetched, ["r1", "r1"])
+        self.assertEqual(self.pms.coalescer.coalesce("hotel-1", ["r1"]), ["r1"])
+
+    def test_only_the_last_outcome_counts(self):
+        outcomes = []
+        calls = []
+
+        def webhook_rows(hotel, fetched):
+            outcomes.extend(fetched)
+            return [], True
+
+        def fetch_reservation(reservation_id):
+            calls.append(reservation_id)
+            if len(calls) == 1:
+                self.pms.coalescer.coalesce("hotel-1", [reservation_id])
+                raise ValueError("stale")
+            return "reservation", None
+
+        with mock.patch.object(self.pms, "fetch_reservation", fetch_reservation), mock.patch.object(
+            self.pms, "webhook_rows", webhook_rows
+        ):
+            self.pms.handle_webhook({"HotelId": "hotel-1", "ReservationIds": ["r1"]})
+        self.assertEqual(outcomes, [Outcome("r1", ("reservation", None), None)])
+
+
+class HandleWebhookFanOutTests(MockAPITestCase):
+    reservation_ids = [f"6f1c3f5e-1d2b-4c3a-9e8f-0a1b2c3d4e5{i}" for i in range(3)]
+
+    def test_failing_reservation_doesnt_stop_the_others(self):
+        fetch_reservation = self.pms.fetch_reservation
+        broken = self.reservation_ids[1]
+
+        def flaky_fetch_reservation(reservation_id):
+            if reservation_id == broken:
+                raise external_api.APIError("The API is not available.")
+            return fetch_reservation(reservation_id)
+
+        payload = {"HotelId": self.hotel.pms_hotel_id, "ReservationIds": self.reservation_ids}
+        with mock.patch.object(self.pms, "fetch_reservation", flaky_fetch_reservation), self.assertLogs(
+            "hotel.pms_systems", "WARNING"
+        ) as logs:
+            self.assertFalse(self.pms.handle_webhook(payload))
+        self.assertIn(f"Could not fetch reservation {broken}", "\n".join(logs.output))
+        self.assertEqual(
+            set(Stay.objects.values_list("pms_reservation_id", flat=True)),
+            {reservation_id for reservation_id in self.reservation_ids if reservation_id != broken},
+        )
+
+
+class StayHasBreakfastManyTests(SimpleTestCase):
+    def setUp(self):
+        self.pms = PMS_Mews()
+        self.flight = SingleFlight()
+        patcher = mock.patch("hotel.pms_systems.get_single_flight", return_value=self.flight)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stay = Stay(pk=1, hotel_id=1, pms_reservation_id="r1")
+        self.lookups = []
+
+    def stay_has_breakfast(self, stay):
+        self.lookups.append(stay.pms_reservation_id)
+        return True
+
+    def test_concurrent_lookups_of_a_stay_share_one_call(self):
+        release = threading.Event()
+
+        def slow_stay_has_breakfast(stay):
+            release.wait(5)
+            return self.stay_has_breakfast(stay)
+
+        results = []
+        with mock.patch.object(self.pms, "stay_has_breakfast", slow_stay_has_breakfast):
+            threads = [
+                threading.Thread(target=lambda: results.append(self.pms.stay_has_breakfast_many([self.stay])))
+                for _ in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            # Wait until the second lookup waits for the first one
+            deadline = time.monotonic() + 5
+            while self.flight.shared < 1 and time.monotonic() < deadline:
+                time.sleep(0.001)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(results, [{1: True}, {1: True}])
+        self.assertEqual(self.lookups, ["r1"])
+
+    def test_same_stay_in_one_batch_is_looked_up_once(self):
+        other = Stay(pk=2, hotel_id=1, pms_reservation_id="r2")
+        with mock.patch.object(self.pms, "stay_has_breakfast", self.stay_has_breakfast):
+            answers = self.pms.stay_has_breakfast_many([self.stay, other, self.stay])
+        self.assertEqual(answers, {1: True, 2: True})
+        self.assertEqual(sorted(self.lookups), ["r1", "r2"])
+
+    def test_answers_are_reused_up_to_max_age(self):
+        with mock.patch.object(self.pms, "stay_has_breakfast", self.stay_has_breakfast):
+            for moment, max_age in ((100, 5), (104, 5), (104, 0), (110, 5)):
+                with mock.patch("hotel.concurrency.time.monotonic", return_value=moment):
+                    self.pms.stay_has_breakfast_many([self.stay], max_age=max_age)
+        # Reused at 104 within max_age, looked up again without max_age and after it expired
+        self.assertEqual(self.lookups, ["r1", "r1", "r1"])
+
+
+@override_settings(WEBHOOK_COALESCE_WINDOW=0)
+class WebhookQueueRetryTests(MockAPITestCase):
+    reservation_id = "6f1c3f5e-1d2b-4c3a-9e8f-0a1b2c3d4e5f"
+
+    def test_failed_flush_is_written_on_retry(self):
+        event = webhook_queue.enqueue(
+            self.pms.name, {"HotelId": self.hotel.pms_hotel_id, "ReservationIds": [self.reservation_id]}
+        )
+        calls = []
+
+        def upsert_reservations(rows):
+            calls.append(rows)
+            if len(calls) == 1:
+                raise RuntimeError("disk full")
+            return bulk.upsert_reservations(rows)
+
+        with mock.patch("hotel.write_buffer.upsert_reservations", upsert_reservations):
+            with self.assertLogs("hotel.webhook_queue", "ERROR"):
+                webhook_queue.run_worker(once=True)
+            event.refresh_from_db()
+            self.assertEqual(event.status, WebhookEvent.Status.PENDING)
+            self.assertFalse(Stay.objects.exists())
+
+            # Another webhook is fetching the reservation when the event is retried
+            self.pms.coalescer.coalesce(self.hotel.pms_hotel_id, [self.reservation_id])
+            WebhookEvent.objects.filter(pk=event.pk).update(available_at=timezone.now())
+            webhook_queue.run_worker(once=True)
+
+        event.refresh_from_db()
+        self.assertEqual(event.status, WebhookEvent.Status.DONE)
+        self.assertTrue(Stay.objects.filter(hotel=self.hotel, pms_reservation_id=self.reservation_id).exists())
+
+    def test_open_circuit_reschedules_without_using_an_attempt(self):
+        event = webhook_queue.enqueue(
+            self.pms.name, {"HotelId": self.hotel.pms_hotel_id, "ReservationIds": [self.reservation_id]}
+        )
+        breaker = self.pms.api.breaker
+        self.addCleanup(breaker.record_success)
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+
+        with self.assertLogs("hotel.pms_systems", "WARNING"):
+            webhook_queue.run_worker(once=True)
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), (WebhookEvent.Status.PENDING, 0))
+        self.assertIn("handle_webhook returned False", event.last_error)
+        wait = (event.available_at - timezone.now()).total_seconds()
+        self.assertAlmostEqual(wait, breaker.reset_timeout, delta=1)
+        self.assertFalse(Stay.objects.exists())
+
+
+@override_settings(WEBHOOK_COALESCE_WINDOW=5)
+class WebhookQueueCoalescingTests(TestCase):
+    def enqueue(self, hotel_id: str, *reservation_ids: str) -> WebhookEvent:
+        return webhook_queue.enqueue("Mews", {"HotelId": hotel_id, "ReservationIds": list(reservation_ids)})
+
+    def claim_after_window(self) -> list:
+        later = timezone.now() + datetime.timedelta(seconds=6)
+        with mock.patch("hotel.webhook_queue.timezone.now", return_value=later):
+            return webhook_queue.claim(10, lease_seconds=60)
+
+    def test_events_of_a_hotel_within_the_window_are_merged(self):
+        first = self.enqueue("h1", "r1", "r2")
+        self.assertEqual(self.enqueue("h1", "r2", "r3").pk, first.pk)
+        self.assertEqual(self.enqueue("h1", "r1").pk, first.pk)
+        other_hotel = self.enqueue("h2", "r1")
+        self.assertNotEqual(other_hotel.pk, first.pk)
+
+        self.assertEqual(webhook_queue.claim(10, lease_seconds=60), [])
+        claimed = {event.payload["HotelId"]: event.payload["ReservationIds"] for event in self.claim_after_window()}
+        self.assertEqual(claimed, {"h1": ["r1", "r2", "r3"], "h2": ["r1"]})
+
+    def test_claimed_and_retried_events_are_not_merged_into(self):
+        first = self.enqueue("h1", "r1")
+        self.claim_after_window()
+        # The worker may have fetched r1 already
+        second = self.enqueue("h1", "r1")
+        self.assertNotEqual(second.pk, first.pk)
+
+        # A retried event waits for its backoff, but was handled before: new events don't join it
+        WebhookEvent.objects.filter(pk=first.pk).update(
+            status=WebhookEvent.Status.PENDING, available_at=timezone.now() + datetime.timedelta(seconds=60)
+        )
+        self.assertEqual(self.enqueue("h1", "r2").pk, second.pk)
+        self.assertEqual(WebhookEvent.objects.get(pk=first.pk).payload["ReservationIds"], ["r1"])
+
+    @override_settings(WEBHOOK_COALESCE_WINDOW=0)
+    def test_no_window(self):
+        self.assertNotEqual(self.enqueue("h1", "r1").pk, self.enqueue("h1", "r1").pk)
+        self.assertEqual(len(webhook_queue.claim(10, lease_seconds=60)), 2)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def make_client(self, breaker: CircuitBreaker, endpoint) -> ResilientClient:
+        return ResilientClient(
+            "Test",
+            {"get": lambda: None},
+            max_attempts=1,
+            base_delay=0,
+            max_delay=0,
+            budget=RetryBudget(0),
+            breaker=breaker,
+            async_endpoints={"get": endpoint},
+        )
+
+    def test_cancelled_trial_is_released(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+
+        async def hang():
+            await asyncio.sleep(10)
+
+        client = self.make_client(breaker, hang)
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(client.acall("get"), timeout=0.01))
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(breaker.allow(), CircuitBreaker.TRIAL)
+
+    def test_one_trial_at_a_time(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertEqual(breaker.allow(), CircuitBreaker.TRIAL)
+        self.assertIsNone(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.allow(), CircuitBreaker.CALL)
+
+    def test_retry_after(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        self.assertEqual(breaker.retry_after(), 0)
+        with mock.patch("hotel.api_client.time.monotonic", return_value=100):
+            breaker.record_failure()
+        with mock.patch("hotel.api_client.time.monotonic", return_value=110):
+            self.assertIsNone(breaker.allow())
+            self.assertEqual(breaker.retry_after(), 20)
+        self.assertEqual(breaker.rejected, 1)
+
+
+class MockBackendTests(SimpleTestCase):
+    def setUp(self):
+        previous_backend = external_api.backend
+        self.addCleanup(setattr, external_api, "backend", previous_backend)
+
+    def outcomes(self, reservation_ids: list) -> dict:
+        external_api.configure(seed=1, error_rate=0.5)
+        outcomes = {}
+        for reservation_id in reservation_ids:
+            try:
+                outcomes[reservation_id] = external_api.get_reservation_details(reservation_id)
+            except external_api.APIError:
+                outcomes[reservation_id] = None
+        return outcomes
+
+    def test_seeded_calls_dont_depend_on_the_order(self):
+        reservation_ids = [f"r{i}" for i in range(20)]
+        self.assertEqual(self.outcomes(reservation_ids), self.outcomes(reservation_ids[::-1]))
+
+    def test_retries_get_new_errors(self):
+        external_api.configure(seed=1, error_rate=0.5)
+        outcomes = set()
+        for _ in range(20):
+            try:
+                outcomes.add(external_api.get_reservation_details("r1"))
+            except external_api.APIError:
+                outcomes.add(None)
+        self.assertEqual(len(outcomes), 2)
+
+    def test_unseeded_calls_are_not_counted(self):
+        backend = external_api.configure(error_rate=0)
+        for i in range(5):
+            external_api.get_reservation_details(f"r{i}")
+        self.assertEqual(len(backend._calls), 0)
+
+
+class PMSRegistryTests(TestCase):
+    def setUp(self):
+        for patcher in (
+            mock.patch.dict(pms_systems.PMS_CLASSES),
+            mock.patch.dict(pms_systems._instances),
+            mock.patch.object(pms_systems, "_entry_points_loaded", False),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def entry_point(self, name: str, load) -> mock.Mock:
+        entry_point = mock.Mock(load=load)
+        entry_point.name = name
+        return entry_point
+
+    def test_lookup_is_case_insensitive(self):
+        pms = get_pms("mews")
+        self.assertIsInstance(pms, PMS_Mews)
+        self.assertIs(get_pms("Mews"), pms)
+        self.assertIs(get_pms("MEWS"), pms)
+
+    def test_unknown_pms(self):
+        with self.assertRaises(pms_systems.UnknownPMS):
+            get_pms("opera")
+        response = self.client.post("/webhook/opera/", data="{}", content_type="application/json")
+        self.assertEqual(response.status_code, 404)
+
+    def test_entry_points_are_registered(self):
+        class PMS_Acme(PMS_Mews):
+            pass
+
+        def broken():
+            raise ImportError("No module named 'acme'")
+
+        entry_points = [self.entry_point("broken", broken), self.entry_point("acme", lambda: PMS_Acme)]
+        with mock.patch("hotel.pms_systems.entry_points", return_value=entry_points) as found, self.assertLogs(
+            "hotel.pms_systems", "ERROR"
+        ) as logs:
+            self.assertIsInstance(get_pms("acme"), PMS_Acme)
+            # The entry points are only loaded once
+            get_pms("mews")
+        found.assert_called_once_with(group="integrations.pms")
+        self.assertIn("Could not load PMS entry point broken", logs.output[0])
+
+
+class NormalizationTests(SimpleTestCase):
+    def test_normalize_phone(self):
+        cases = [
+            ("+31 6 1234 5678", None, "+31612345678"),
+            ("0031 (6) 12.34.56.78", None, "+31612345678"),
+            # National numbers need a region
+            ("06-12345678", None, None),
+            ("06-12345678", "NL", "+31612345678"),
+            ("06-12345678", "XX", None),
+            ("+123", None, None),
+            ("not a phone", None, None),
+            (612345678, None, None),
+            (None, None, None),
+        ]
+        for value, default_region, expected in cases:
+            with self.subTest(value=value, default_region=default_region):
+                self.assertEqual(normalization.normalize_phone(value, default_region), expected)
+
+    def test_normalize_phones(self):
+        self.assertEqual(
+            normalization.normalize_phones(["0612345678", None, "+31612345678", "0612345678"], "NL"),
+            ["+31612345678", None, "+31612345678", "+31612345678"],
+        )
+
+    def test_country_languages_are_supported_languages(self):
+        for country, languages in normalization.COUNTRY_LANGUAGES.items():
+            with self.subTest(country=country):
+                self.assertRegex(country, r"^[A-Z]{2}$")
+                self.assertTrue(languages)
+                self.assertTrue(set(languages) <= set(Language))
+
+    def test_language_for_country(self):
+        cases = [
+            ("NL", None, Language.DUTCH),
+            (" be ", None, Language.DUTCH),
+            ("BE", Language.FRENCH, Language.FRENCH),
+            ("NL", Language.FRENCH, Language.DUTCH),
+            ("FI", None, Language.BRITISH_ENGLISH),
+            ("FI", Language.SWEDISH, Language.SWEDISH),
+            # Countries whose languages we don't support
+            ("JP", None, Language.BRITISH_ENGLISH),
+            ("Netherlands", None, None),
+            (None, None, None),
+        ]
+        for country, preferred, expected in cases:
+            with self.subTest(country=country, preferred=preferred):
+                self.assertEqual(normalization.language_for_country(country, preferred), expected)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_render_exposition_format(self):
+        registry = metrics.Registry()
+        requests = registry.counter("requests_total", "Requests.", ("pms", "status"))
+        latency = registry.histogram("latency_seconds", "Latency.", ("pms",), buckets=(0.1, 1))
+        requests.labels("mews", "200").inc(2)
+        requests.labels('say "hi"', "").inc()
+        latency.labels("mews").observe(0.05)
+        latency.labels("mews").observe(5)
+
+        def collect():
+            stats = {"hits": 3, "size": 7, "name": "guests"}
+            return metrics.collect_stats("cache", "Cache statistics", [({"cache": "guests"}, stats)], ("size",))
+
+        def broken():
+            raise RuntimeError("collector bug")
+
+        registry.register_collector(broken)
+        registry.register_collector(collect)
+        with self.assertLogs("hotel.metrics", "ERROR"):
+            rendered = registry.render()
+        self.assertEqual(
+            rendered,
+            "# HELP requests_total Requests.\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{pms="mews",status="200"} 2\n'
+            'requests_total{pms="say \\"hi\\""} 1\n'
+            "# HELP latency_seconds Latency.\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{pms="mews",le="0.1"} 1\n'
+            'latency_seconds_bucket{pms="mews",le="1"} 1\n'
+            'latency_seconds_bucket{pms="mews",le="+Inf"} 2\n'
+            'latency_seconds_sum{pms="mews"} 5.05\n'
+            'latency_seconds_count{pms="mews"} 2\n'
+            "# HELP cache_hits_total Cache statistics (hits)\n"
+            "# TYPE cache_hits_total counter\n"
+            'cache_hits_total{cache="guests"} 3\n'
+            "# HELP cache_size Cache statistics (size)\n"
+            "# TYPE cache_size gauge\n"
+            'cache_size{cache="guests"} 7\n',
+        )
+
+    def test_timed_method(self):
+        class Timed:
+            name = "Timed"
+
+            @metrics.timed_method("test_sync")
+            def sync(self, fail=False):
+                if fail:
+                    raise ValueError("failed")
+                return "sync"
+
+            @metrics.timed_method("test_async")
+            async def async_(self):
+                return "async"
+
+        timed = Timed()
+        self.assertEqual(timed.sync(), "sync")
+        with self.assertRaises(ValueError):
+            timed.sync(fail=True)
+        self.assertEqual(asyncio.run(timed.async_()), "async")
+        self.assertEqual(metrics.STAGE_SECONDS.labels("test_sync", "Timed", "").count, 2)
+        self.assertEqual(metrics.STAGE_ERRORS.labels("test_sync", "Timed", "").value, 1)
+        self.assertEqual(metrics.STAGE_SECONDS.labels("test_async", "Timed", "").count, 1)
+
+    def test_hotel_labels_are_off_by_default(self):
+        self.assertEqual(metrics.hotel_label("hotel-1"), "")
+        with override_settings(METRICS_HOTEL_LABELS=True):
+            self.assertEqual(metrics.hotel_label("hotel-1"), "hotel-1")
+
+    @override_settings(METRICS_API_TOKENS=["scrape"])
+    def test_endpoint_needs_a_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 401)
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        self.assertIn("# TYPE hotel_stage_seconds histogram", response.content.decode())
+
+
+class HotelResolverTests(TestCase):
+    def create_in_other_process(self, pms_hotel_id: str) -> Hotel:
+        # bulk_create doesn't send the signal that clears the cache, like a save in another process
+        return Hotel.objects.bulk_create([Hotel(pms_hotel_id=pms_hotel_id, name="New", city="Utrecht")])[0]
+
+    def test_unknown_ids_are_cached_briefly(self):
+        resolver = HotelResolver(maxsize=10, ttl=300, miss_ttl=60)
+        self.assertIsNone(resolver.resolve("new-hotel"))
+        self.create_in_other_process("new-hotel")
+        self.assertIsNone(resolver.resolve("new-hotel"))
+        with mock.patch("hotel.cache.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertEqual(resolver.resolve("new-hotel").pms_hotel_id, "new-hotel")
+
+    def test_unknown_ids_are_not_cached_without_miss_ttl(self):
+        resolver = HotelResolver(maxsize=10, ttl=300, miss_ttl=0)
+        self.assertEqual(resolver.resolve_many(["new-hotel"]), {})
+        self.create_in_other_process("new-hotel")
+        self.assertEqual(list(resolver.resolve_many(["new-hotel"])), ["new-hotel"])
+
+
+@override_settings(ARRIVALS_API_TOKENS=["secret"])
+class ArrivalsEndpointTests(TestCase):
+    def setUp(self):
+        self.hotel = Hotel.objects.create(pms_hotel_id="hotel-1", name="Hotel", city="Utrecht")
+        self.url = f"/hotels/{self.hotel.pk}/arrivals/"
+
+    def get(self, date: str, token: str = "secret"):
+        return self.client.get(self.url, {"date": date}, HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_requires_a_token(self):
+        self.assertEqual(self.client.get(self.url, {"date": "2024-05-01"}).status_code, 401)
+        self.assertEqual(self.get("2024-05-01", token="wrong").status_code, 401)
+        self.assertEqual(self.get("2024-05-01").status_code, 200)
+
+    @override_settings(ARRIVALS_API_TOKENS=[])
+    def test_refused_without_tokens(self):
+        self.assertEqual(self.get("2024-05-01", token="").status_code, 401)
+
+    def test_moved_stay_leaves_the_cached_page_of_the_old_date(self):
+        stay = Stay.objects.create(hotel=self.hotel, pms_reservation_id="r1", checkin=datetime.date(2024, 5, 1))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(len(self.get("2024-05-01").json()["results"]), 1)
+            stay.checkin = datetime.date(2024, 5, 2)
+            stay.save()
+        self.assertEqual(self.get("2024-05-01").json()["results"], [])
+        self.assertEqual(len(self.get("2024-05-02").json()["results"]), 1)
+
+
+class AsyncPathTests(MockAPITestCase):
+    checkin_date = datetime.date(2024, 5, 1)
+
+    def stays(self) -> list:
+        return list(
+            Stay.objects.order_by("pms_reservation_id").values_list(
+                "pms_reservation_id", "checkin", "checkout", "status", "guest__phone", "guest__name"
+            )
+        )
+
+    def test_async_sync_of_arrivals_saves_the_same_stays(self):
+        self.assertTrue(self.pms.update_stays(self.checkin_date))
+        stays = self.stays()
+        self.assertTrue(stays)
+        Stay.objects.all().delete()
+        self.pms.guest_cache.clear()
+        self.assertTrue(async_to_sync(self.pms.aupdate_stays)(self.checkin_date))
+        self.assertEqual(self.stays(), stays)
+
+    def test_invalid_arrivals_fail_both_syncs(self):
+        with mock.patch.object(self.pms.api, "call", return_value="[{}, "), self.assertLogs("hotel", "WARNING"):
+            self.assertFalse(self.pms.update_stays(self.checkin_date))
+        with mock.patch.object(self.pms.api, "acall", mock.AsyncMock(return_value="[{}, ")), self.assertLogs(
+            "hotel", "WARNING"
+        ):
+            self.assertFalse(async_to_sync(self.pms.aupdate_stays)(self.checkin_date))
+
+    async def apost(self, path: str, body: str):
+        return await AsyncClient().post(path, body, content_type="application/json")
+
+    def test_async_webhook_archives_and_saves(self):
+        reservation_id = "6f1c3f5e-1d2b-4c3a-9e8f-0a1b2c3d4e5f"
+        body = json.dumps(
+            {
+                "HotelId": self.hotel.pms_hotel_id,
+                "Events": [{"Name": "ReservationUpdated", "Value": {"ReservationId": reservation_id}}],
+            }
+        )
+        with tempfile.TemporaryDirectory() as directory, override_settings(WEBHOOK_ARCHIVE_DIR=directory):
+            response = async_to_sync(self.apost)("/webhook/async/mews/", body)
+            webhook_archive.close()
+            archived = [webhook.body for webhook in webhook_archive.read(self.pms.name)]
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(archived, [body.encode()])
+        self.assertTrue(Stay.objects.filter(hotel=self.hotel, pms_reservation_id=reservation_id).exists())
+
+
+class TieredCacheTests(SimpleTestCase):
+    def test_async_reads_the_shared_cache_in_a_thread(self):
+        with tempfile.TemporaryDirectory() as directory:
+            shared = SQLiteCache(f"{directory}/cache.sqlite3", "test", ttl=60)
+            shared.set("key", "shared value")
+            cache = TieredCache(TTLCache(maxsize=10, ttl=60), shared)
+            threads = []
+            get_with_ttl = shared.get_with_ttl
+
+            def record_thread(*args):
+                threads.append(threading.get_ident())
+                return get_with_ttl(*args)
+
+            async def fetch():
+                raise AssertionError("the shared cache has the value")
+
+            with mock.patch.object(shared, "get_with_ttl", record_thread):
+                self.assertEqual(asyncio.run(cache.aget_or_fetch("key", fetch)), "shared value")
+            self.assertNotIn(threading.get_ident(), threads)
+            self.assertEqual(cache.stats()["shared_hits"], 1)
+            self.assertEqual(cache.local.get("key"), "shared value")
+
+    def test_shared_hit_keeps_its_remaining_ttl(self):
+        with tempfile.TemporaryDirectory() as directory:
+            shared = SQLiteCache(f"{directory}/cache.sqlite3", "test", ttl=300)
+            shared.set("key", "shared value", ttl=10)
+            cache = TieredCache(TTLCache(maxsize=10, ttl=300), shared)
+            self.assertEqual(cache.get_or_fetch("key", lambda: "fetched"), "shared value")
+            self.assertEqual(cache.local.get("key"), "shared value")
+            with mock.patch("hotel.cache.time.monotonic", return_value=time.monotonic() + 11):
+                self.assertIs(cache.local.get("key"), MISSING)
+
+    def test_expired_entries_are_purged_by_writes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/cache.sqlite3"
+            other = SQLiteCache(path, "other", ttl=300)
+            other.set("fresh", 2)
+            other.set("never read again", 1, ttl=-1)
+            self.assertEqual(other._connection().execute("SELECT count(*) FROM cache").fetchone(), (2,))
+            shared = SQLiteCache(path, "test", ttl=300, purge_interval=60)
+            shared.set("key", 3)
+            self.assertEqual(other.get("fresh"), 2)
+            rows = shared._connection().execute("SELECT key FROM cache ORDER BY key").fetchall()
+            self.assertEqual(rows, [("other:fresh",), ("test:key",)])
+
+            # Not more than once per purge_interval
+            other.set("expired", 4, ttl=-1)
+            shared.set("key", 5)
+            self.assertEqual(shared._connection().execute("SELECT count(*) FROM cache").fetchone(), (3,))
+            self.assertEqual(shared.purge(), 1)
+
+
+class IterJsonArrayTests(SimpleTestCase):
+    document = '[1.5e3, -12, "a,]\\"b", true, null, {"k": [1, 2]}, [], false]'
+
+    def test_every_chunk_boundary(self):
+        expected = json.loads(self.document)
+        for i in range(len(self.document) + 1):
+            with self.subTest(split=i):
+                self.assertEqual(list(iter_json_array([self.document[:i], self.document[i:]])), expected)
+        self.assertEqual(list(iter_json_array(iter(self.document))), expected)
+
+    def test_split_number(self):
+        self.assertEqual(list(iter_json_array(["[12", "34, 1.", "5, 2", "e3]"])), [1234, 1.5, 2000.0])
+
+    def test_split_literal(self):
+        self.assertEqual(list(iter_json_array(["[tr", "ue, nu", "ll, f", "alse]"])), [True, None, False])
+
+    def test_trailing_garbage(self):
+        for chunks in (["[1] x"], ["[1]", " ", "x"], ["[] ,"], ["[1]]"]):
+            with self.subTest(chunks=chunks), self.assertRaises(ValueError):
+                list(iter_json_array(chunks))
+        self.assertEqual(list(iter_json_array(["[1] ", "\n"])), [1])
+
+    def test_items_before_an_error_are_yielded(self):
+        items = iter_json_array(["[1, ", "2 3]"])
+        self.assertEqual(next(items), 1)
+        self.assertEqual(next(items), 2)
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def test_not_an_array(self):
+        for data in ("{}", "", "[1,", "[1 2]"):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                list(iter_json_array(data))
+
+
+class ListOfTests(SimpleTestCase):
+    reservation_id = "6f1c3f5e-1d2b-4c3a-9e8f-0a1b2c3d4e5f"
+
+    def test_invalid_items_are_left_out_and_logged(self):
+        payload = {
+            "HotelId": "851df8c8-90f2-4c4a-8e01-a4fc46b25178",
+            "Events": [
+                {"Name": "ReservationUpdated", "Value": {"ReservationId": self.reservation_id}},
+                {"Name": "ReservationUpdated", "Value": {"ReservationId": "not-a-uuid"}},
+                "garbage",
+            ],
+        }
+        with self.assertLogs("hotel.schema", "WARNING") as logs:
+            webhook = PMS_Mews.WEBHOOK.validate(payload)
+        self.assertEqual([event.reservation_id for event in webhook.events], [self.reservation_id])
+        [message] = logs.output
+        self.assertIn("Left out 2 invalid MewsWebhookEvent items", message)
+        self.assertIn("(1, [('Value.ReservationId', 'invalid')])", message)
+        self.assertIn("(2, [('', 'not an object')])", message)
+
+
+class PruneWebhookArchiveTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = Path(directory.name)
+        days = [("Mews", "2024-04-01"), ("Mews", "2024-04-30"), ("Mews", "2024-05-01"), ("Other", "2024-03-01")]
+        for pms_name, day in days:
+            (self.root / pms_name / day).mkdir(parents=True)
+            (self.root / pms_name / day / "000000-host-1-1.jsonl.gz").write_bytes(b"")
+
+    def days(self) -> list:
+        return sorted(f"{path.parent.name}/{path.name}" for path in self.root.glob("*/*"))
+
+    def test_days_before_the_retention_are_deleted(self):
+        pruned = webhook_archive.prune(1, root=self.root, today=datetime.date(2024, 5, 1))
+        self.assertEqual(sorted(path.name for path in pruned), ["2024-03-01", "2024-04-01"])
+        self.assertEqual(self.days(), ["Mews/2024-04-30", "Mews/2024-05-01"])
+
+    def test_dry_run_and_command(self):
+        with override_settings(WEBHOOK_ARCHIVE_DIR=self.root, WEBHOOK_ARCHIVE_RETENTION_DAYS=100_000):
+            call_command("prune_webhook_archive", "--days", "1", "--dry-run", stdout=io.StringIO())
+            self.assertEqual(len(self.days()), 4)
+            call_command("prune_webhook_archive", stdout=io.StringIO())
+            self.assertEqual(len(self.days()), 4)
+            call_command("prune_webhook_archive", "--days", "1", stdout=io.StringIO())
+        self.assertEqual(len(self.days()), 0)
+
+    def test_open_segment_of_a_pruned_day_is_closed(self):
+        writer = webhook_archive.ArchiveWriter(self.root, max_bytes=1 << 20, max_seconds=3600)
+        writer.append(webhook_archive.ArchivedWebhook(time.time(), "Mews", "h", b"{}"))
+        webhook_archive.prune(1, root=self.root, today=datetime.date.today() + datetime.timedelta(days=2))
+        writer.close()
+        self.assertEqual(self.days(), [])
+
+
+class AsyncAcquireCancellationTests(SimpleTestCase):
+    def make_limit(self) -> AdaptiveLimit:
+        limit = AdaptiveLimit(initial=1, min_limit=1, max_limit=1)
+        limit.acquire()
+        return limit
+
+    def test_cancelled_waiter_is_skipped(self):
+        async def scenario():
+            limit = self.make_limit()
+            first = asyncio.ensure_future(limit.aacquire())
+            second = asyncio.ensure_future(limit.aacquire())
+            await asyncio.sleep(0)
+            self.assertEqual(limit.waiting, 2)
+            first.cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(limit.waiting, 1)
+            limit.release(latency=0, failed=False)
+            await asyncio.wait_for(second, timeout=1)
+            self.assertTrue(first.cancelled())
+            self.assertEqual((limit.in_flight, limit.waiting), (1, 0))
+
+        asyncio.run(scenario())
+
+    def test_slot_handed_to_a_cancelled_waiter_is_given_back(self):
+        async def scenario(yields: int):
+            limit = self.make_limit()
+            waiter = asyncio.ensure_future(limit.aacquire())
+            await asyncio.sleep(0)
+            # The slot is handed over, the waiter is cancelled before (yields=0) or after (yields=1) the
+            # handover reaches it
+            limit.release(latency=0, failed=False)
+            for _ in range(yields):
+                await asyncio.sleep(0)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            await asyncio.sleep(0)
+            self.assertEqual((limit.in_flight, limit.waiting), (0, 0))
+            await asyncio.wait_for(limit.aacquire(), timeout=1)
+
+        for yields in (0, 1):
+            with self.subTest(yields=yields):
+                asyncio.run(scenario(yields))
+
+    def test_cancelled_token_is_given_back(self):
+        async def scenario():
+            bucket = TokenBucket(rate=10, burst=1)
+            await bucket.aacquire()
+            waiter = asyncio.ensure_future(bucket.aacquire())
+            await asyncio.sleep(0)
+            self.assertEqual(bucket.waiting, 1)
+            waiter.cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(bucket.waiting, 0)
+            # Without the token of the cancelled waiter, the next one waits 0.2s
+            self.assertLess(bucket._reserve(), 0.15)
+
+        asyncio.run(scenario())
+
+
+class ResolveGuestsConflictTests(TestCase):
+    phone = "+31612345678"
+
+    def setUp(self):
+        self.record = PMS_Mews.GUEST.record
+        self.stored = Guest(phone=self.phone, name="Stored", language="nl")
+        self.stored.fingerprint = self.stored.compute_fingerprint()
+        self.stored.save()
+        lookup = guests.lookup
+        self.lookups = 0
+
+        def racing_lookup(phones):
+            # The first lookup runs before another writer inserts the guest
+            self.lookups += 1
+            return {} if self.lookups == 1 else lookup(phones)
+
+        patcher = mock.patch("hotel.guests.lookup", racing_lookup)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_guest_inserted_by_another_writer_is_merged(self):
+        with self.assertLogs("hotel.guests", "DEBUG"):
+            resolution = guests.resolve_guests([self.record("New name", self.phone, None)], attempts=3)
+        self.assertEqual(resolution.guest_ids, {self.phone: self.stored.pk})
+        self.assertEqual(resolution.written, 1)
+        self.assertEqual(self.lookups, 2)
+        guest = Guest.objects.get()
+        # The name of this import, the language of the other writer
+        self.assertEqual((guest.name, guest.language), ("New name", "nl"))
+        self.assertEqual(guest.fingerprint, guest.compute_fingerprint())
+
+    def test_unchanged_guest_inserted_by_another_writer_is_not_written(self):
+        with self.assertLogs("hotel.guests", "DEBUG"):
+            resolution = guests.resolve_guests([self.record("", self.phone, None)], attempts=3)
+        self.assertEqual(resolution, guests.Resolution({self.phone: self.stored.pk}, 0, 1))
+        self.assertEqual(Guest.objects.get().name, "Stored")
+
+    def test_out_of_attempts_links_the_stored_guest(self):
+        with self.assertLogs("hotel.guests", "DEBUG"):
+            resolution = guests.resolve_guests([self.record("New name", self.phone, None)], attempts=1)
+        self.assertEqual(resolution.guest_ids, {self.phone: self.stored.pk})
+        self.assertEqual(resolution.written, 0)
+        self.assertEqual(Guest.objects.get().name, "Stored")
+
+    def test_guest_that_is_deleted_again_is_left_out(self):
+        # Another writer inserts the guest and deletes it again before every lookup
+        with mock.patch("hotel.guests.lookup", return_value={}), mock.patch.object(
+            Guest.objects, "bulk_create"
+        ), self.assertLogs("hotel.guests", "WARNING"):
+            resolution = guests.resolve_guests([self.record("New name", self.phone, None)], attempts=2)
+        self.assertEqual(resolution.guest_ids, {})
+
+
+class UpsertReservationsTests(TestCase):
+    checkin = datetime.date(2026, 5, 1)
+
+    def setUp(self):
+        self.hotel = Hotel.objects.create(pms_hotel_id="hotel-1", name="Hotel", city="Utrecht")
+        self.guest = Guest.objects.create(phone="+31612345678", name="Guest", language="nl")
+        self.stay = Stay.objects.create(
+            hotel=self.hotel,
+            guest=self.guest,
+            pms_reservation_id="r1",
+            pms_guest_id="g1",
+            status=Stay.Status.BEFORE,
+            checkin=self.checkin,
+            checkout=self.checkin + datetime.timedelta(days=2),
+        )
+
+    def row(self, reservation_id: str = "r1", guest="stored", **changes) -> bulk.ReservationRow:
+        values = {
+            "reservation_id": reservation_id,
+            "hotel_id": self.hotel.pms_hotel_id,
+            "guest_id": "g1",
+            "status": Stay.Status.BEFORE,
+            "checkin": self.checkin,
+            "checkout": self.checkin + datetime.timedelta(days=2),
+            "breakfast_included": None,
+            "room_number": None,
+            **changes,
+        }
+        if guest == "stored":
+            guest = PMS_Mews.GUEST.record(self.guest.name, self.guest.phone, self.guest.language)
+        return bulk.ReservationRow(self.hotel.pk, PMS_Mews.RESERVATION.record(**values), guest)
+
+    def skipped(self) -> float:
+        return bulk.BULK_ROWS.labels("stay", "skipped").value
+
+    def test_unchanged_stay_is_not_written(self):
+        updated_at = self.stay.updated_at
+        skipped = self.skipped()
+        self.assertEqual(bulk.upsert_reservations([self.row()]), 0)
+        self.assertEqual(self.skipped(), skipped + 1)
+        self.stay.refresh_from_db()
+        self.assertEqual(self.stay.updated_at, updated_at)
+
+    def test_changed_field_is_written(self):
+        self.assertEqual(bulk.upsert_reservations([self.row(status=Stay.Status.INSTAY)]), 1)
+        self.stay.refresh_from_db()
+        self.assertEqual(self.stay.status, Stay.Status.INSTAY)
+        self.assertEqual(self.stay.fingerprint, self.stay.compute_fingerprint())
+
+    def test_unknown_or_empty_guest_keeps_the_current_guest(self):
+        empty_guest = PMS_Mews.GUEST.record("", None, None)
+        for guest in (None, empty_guest):
+            with self.subTest(guest=guest):
+                bulk.upsert_reservations([self.row(guest=guest, status=Stay.Status.INSTAY)])
+                self.stay.refresh_from_db()
+                self.assertEqual(self.stay.guest_id, self.guest.pk)
+                self.assertEqual(self.stay.status, Stay.Status.INSTAY)
+
+    def test_arrivals_of_both_dates_are_invalidated(self):
+        moved_to = self.checkin + datetime.timedelta(days=1)
+        generations = {checkin: arrivals._generation(self.hotel.pk, checkin) for checkin in (self.checkin, moved_to)}
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk.upsert_reservations([self.row(checkin=moved_to)])
+        for checkin, generation in generations.items():
+            self.assertGreater(arrivals._generation(self.hotel.pk, checkin), generation)
+
+    def test_queries_of_a_batch_dont_grow_with_its_size(self):
+        rows = [
+            self.row(f"r{i}", guest=PMS_Mews.GUEST.record(f"Guest {i}", f"+3161234{i:04d}", "nl")) for i in range(50)
+        ]
+        # Guests: lookup, insert and lookup of the new ids. Stays: lookup and insert. Plus the savepoint.
+        with self.assertNumQueries(7):
+            self.assertEqual(bulk.upsert_reservations(rows, chunk_size=50), 50)
+        self.assertEqual(Stay.objects.count(), 50)
+
+
+@override_settings(WEBHOOK_QUEUE_MAX_ATTEMPTS=2, WEBHOOK_COALESCE_WINDOW=0)
+class WebhookQueueClaimTests(TestCase):
+    def setUp(self):
+        self.event = webhook_queue.enqueue("Mews", {"HotelId": "hotel-1", "ReservationIds": []})
+
+    def claim_at(self, moment, batch_size: int = 10) -> list:
+        with mock.patch("hotel.webhook_queue.timezone.now", return_value=moment):
+            return webhook_queue.claim(batch_size, lease_seconds=60)
+
+    def test_claimed_event_is_not_claimed_again_during_its_lease(self):
+        now = timezone.now()
+        [claimed] = self.claim_at(now)
+        self.assertEqual((claimed.status, claimed.attempts), (WebhookEvent.Status.PROCESSING, 1))
+        self.assertEqual(self.claim_at(now + datetime.timedelta(seconds=59)), [])
+
+    def test_expired_lease_is_claimed_again(self):
+        now = timezone.now()
+        [first] = self.claim_at(now)
+        [second] = self.claim_at(now + datetime.timedelta(seconds=61))
+        self.assertNotEqual(first.claim_token, second.claim_token)
+        self.assertEqual(second.attempts, 2)
+
+        # The worker whose lease expired can't change the event anymore
+        webhook_queue.complete(first)
+        webhook_queue.fail(first, "too late")
+        self.event.refresh_from_db()
+        self.assertEqual((self.event.status, self.event.last_error), (WebhookEvent.Status.PROCESSING, ""))
+
+        webhook_queue.complete_many([second])
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.status, WebhookEvent.Status.DONE)
+        self.assertIsNone(self.event.claim_token)
+
+    def test_failed_event_waits_for_its_backoff_and_runs_out_of_attempts(self):
+        now = timezone.now()
+        [claimed] = self.claim_at(now)
+        webhook_queue.fail(claimed, "boom")
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.status, WebhookEvent.Status.PENDING)
+        self.assertEqual(self.claim_at(now), [])
+
+        [claimed] = self.claim_at(self.event.available_at)
+        webhook_queue.fail(claimed, "boom again")
+        self.event.refresh_from_db()
+        self.assertEqual((self.event.status, self.event.last_error), (WebhookEvent.Status.FAILED, "boom again"))
+        self.assertEqual(self.claim_at(now + datetime.timedelta(days=1)), [])
+
+    def test_batches_are_claimed_in_order(self):
+        events = [self.event] + [webhook_queue.enqueue("Mews", {"HotelId": str(i)}) for i in range(3)]
+        now = timezone.now()
+        first = self.claim_at(now, batch_size=3)
+        second = self.claim_at(now, batch_size=3)
+        self.assertEqual([event.pk for event in first + second], [event.pk for event in events])
+
+
+class SyncArrivalsCommandTests(MockAPITestCase):
+    checkin = datetime.date(2026, 5, 1)
+
+    def setUp(self):
+        super().setUp()
+        self.hotels = [self.hotel]
+        for i in range(3):
+            pms_hotel_id = f"00000000-0000-4000-8000-00000000000{i}"
+            self.hotels.append(Hotel.objects.create(pms_hotel_id=pms_hotel_id, name=f"Hotel {i}", city="Utrecht"))
+
+    def sync(self, *args) -> str:
+        stdout = io.StringIO()
+        call_command(
+            "sync_arrivals", "mews", "--date", self.checkin.isoformat(), "--workers", "1", *args, stdout=stdout
+        )
+        return stdout.getvalue()
+
+    def checkpoints(self) -> dict[int, tuple[str, int]]:
+        return {
+            hotel_id: (status, attempts)
+            for hotel_id, status, attempts in SyncCheckpoint.objects.filter(checkin_date=self.checkin).values_list(
+                "hotel_id", "status", "attempts"
+            )
+        }
+
+    def test_every_hotel_gets_a_checkpoint(self):
+        self.sync()
+        self.assertEqual(self.checkpoints(), {hotel.pk: (SyncCheckpoint.Status.DONE, 1) for hotel in self.hotels})
+        self.assertTrue(Stay.objects.filter(hotel=self.hotel, checkin=self.checkin).exists())
+
+    def test_shards_divide_the_hotels(self):
+        self.sync("--shard-index", "1", "--shard-count", "2")
+        self.assertEqual(set(self.checkpoints()), {hotel.pk for hotel in self.hotels if hotel.pk % 2 == 1})
+        self.sync("--shard-index", "0", "--shard-count", "2")
+        self.assertEqual(set(self.checkpoints()), {hotel.pk for hotel in self.hotels})
+
+    def test_resume_only_syncs_the_hotels_that_are_not_done(self):
+        self.sync("--hotel", str(self.hotels[0].pk), "--hotel", str(self.hotels[1].pk))
+        output = self.sync()
+        self.assertIn("Syncing 2 hotels", output)
+        self.assertEqual(self.checkpoints(), {hotel.pk: (SyncCheckpoint.Status.DONE, 1) for hotel in self.hotels})
+
+    def test_failing_hotel_doesnt_stop_the_serial_sync(self):
+        sync_hotel_window = arrivals_sync.sync_hotel_window
+        broken = self.hotels[1].pk
+
+        def flaky_sync_hotel_window(pms_name, hotel_id, *args):
+            if hotel_id == broken:
+                raise RuntimeError("connection lost")
+            return sync_hotel_window(pms_name, hotel_id, *args)
+
+        with mock.patch("hotel.arrivals_sync.sync_hotel_window", flaky_sync_hotel_window):
+            with self.assertRaisesMessage(CommandError, "1 of 4 hotels failed") as raised:
+                self.sync()
+        self.assertTrue(str(raised.exception).endswith(f"--hotel {broken}"))
+        self.assertEqual(
+            self.checkpoints(),
+            {hotel.pk: (SyncCheckpoint.Status.DONE, 1) for hotel in self.hotels if hotel.pk != broken},
+        )
+
+
+class SyncHotelWindowTests(TestCase):
+    checkin_dates = arrivals_sync.window(datetime.date(2026, 5, 1), 3)
+
+    def setUp(self):
+        self.hotel = Hotel.objects.create(pms_hotel_id="hotel-1", name="Hotel", city="Utrecht")
+        self.pms = get_pms("mews")
+
+    def test_next_dates_are_fetched_while_a_date_is_saved(self):
+        fetching = {checkin_date: threading.Event() for checkin_date in self.checkin_dates}
+        saved = []
+
+        def fetch_arrivals(checkin_date, hotel):
+            fetching[checkin_date].set()
+            return checkin_date.isoformat()
+
+        def save_arrivals(checkin_date, data, hotel):
+            self.assertEqual(data, checkin_date.isoformat())
+            if checkin_date == self.checkin_dates[0]:
+                # The next date is fetched while this one is saved, the one after that waits
+                self.assertTrue(fetching[self.checkin_dates[1]].wait(5))
+                self.assertFalse(fetching[self.checkin_dates[2]].is_set())
+            saved.append(checkin_date)
+            return True
+
+        with mock.patch.object(self.pms, "fetch_arrivals", fetch_arrivals), mock.patch.object(
+            self.pms, "save_arrivals", save_arrivals
+        ):
+            checkpoints = arrivals_sync.sync_hotel_window(self.pms.name, self.hotel.pk, self.checkin_dates, prefetch=1)
+        self.assertEqual(saved, self.checkin_dates)
+        self.assertEqual([checkpoint.status for checkpoint in checkpoints], [SyncCheckpoint.Status.DONE] * 3)
+
+    def test_recently_synced_dates_are_skipped(self):
+        now = timezone.now()
+        first, second, third = self.checkin_dates
+        for checkin_date, status, age in (
+            (first, SyncCheckpoint.Status.DONE, 60),
+            (second, SyncCheckpoint.Status.DONE, 2 * 60 * 60),
+            (third, SyncCheckpoint.Status.FAILED, 60),
+        ):
+            SyncCheckpoint.objects.create(
+                pms_name=self.pms.name,
+                hotel=self.hotel,
+                checkin_date=checkin_date,
+                status=status,
+                finished_at=now - datetime.timedelta(seconds=age),
+            )
+        self.assertEqual(
+            arrivals_sync.dates_to_sync(self.pms.name, self.hotel.pk, self.checkin_dates, max_age=60 * 60),
+            [second, third],
+        )
+        # Without max_age, every date that is done is skipped
+        self.assertEqual(arrivals_sync.dates_to_sync(self.pms.name, self.hotel.pk, self.checkin_dates), [third])
+
+
+class GenerateSyntheticDataTests(TestCase):
+    def test_refuses_the_configured_database_without_force(self):
+        with self.assertRaisesMessage(CommandError, "--database"):
+            call_command("generate_synthetic_data", "--hotels", "1", stdout=io.StringIO())
+        self.assertFalse(Hotel.objects.exists())
@@ -1,8 +1,16 @@
+import asyncio
+import hmac
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
-from django.http import HttpResponse
+from django.views.decorators.http import require_GET, require_POST
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, JsonResponse
 
-from hotel import pms_systems
+from hotel import arrivals, metrics, pms_systems, webhook_archive, webhook_queue
+from hotel.models import Hotel, Stay
+from hotel.schema import INVALID, parse_date
 
 
 @csrf_exempt
@@ -12,14 +20,148 @@ def webhook(request, pms_name):
     Assume a webhook call from the PMS with a status update for a reservation.
     The webhook call is a POST request to the url: /webhook/<pms_name>/
     The body of the request should always be a valid JSON string and contain the needed information to perform an update.
+    With WEBHOOK_ARCHIVE_DIR set, the raw body is archived (see hotel.webhook_archive), valid or not, to replay it.
+    With WEBHOOK_ASYNC_PROCESSING enabled, the cleaned payload is queued and handled by a background worker.
     """
 
-    pms = pms_systems.get_pms(pms_name)
+    try:
+        pms = pms_systems.get_pms(pms_name)
+    except pms_systems.UnknownPMS:
+        raise Http404(f"Unknown PMS: {pms_name}")
+
+    with metrics.sampled_profile(f"webhook for {pms.name}"), metrics.stage("request", pms.name):
+        response = handle_webhook_request(request, pms)
+
+    if settings.METRICS_ENABLED:
+        metrics.WEBHOOK_REQUESTS.labels(pms.name, str(response.status_code)).inc()
+    return response
 
+
+def handle_webhook_request(request, pms: pms_systems.PMS) -> HttpResponse:
     payload_cleaned = pms.clean_webhook_payload(request.body)
+    with metrics.stage("archive", pms.name):
+        webhook_archive.archive(pms.name, request.body, payload_cleaned.get("HotelId"))
+
+    if settings.WEBHOOK_ASYNC_PROCESSING:
+        if not payload_cleaned:
+            return HttpResponse(status=400)
+        with metrics.stage("enqueue", pms.name):
+            webhook_queue.enqueue(pms.name, payload_cleaned)
+        return HttpResponse("Accepted.", status=202)
+
     success = pms.handle_webhook(payload_cleaned)
 
     if not success:
         return HttpResponse(status=400)
     else:
         return HttpResponse("Thanks for the update.")
+
+
+async def async_webhook(request, pms_name):
+    """
+    The webhook view for ASGI servers (see integrations/asgi.py), at /webhook/async/<pms_name>/.
+    Waiting for the PMS API doesn't hold a thread, so one process can handle many webhooks at the same time.
+    """
+    # The method and CSRF decorators of Django 4.2 don't support async views
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    try:
+        pms = pms_systems.get_pms(pms_name)
+    except pms_systems.UnknownPMS:
+        raise Http404(f"Unknown PMS: {pms_name}")
+
+    with metrics.stage("request", pms.name):
+        payload_cleaned = pms.clean_webhook_payload(request.body)
+        # Compressing and writing the archive takes a lock that all requests share, not on the event loop
+        with metrics.stage("archive", pms.name):
+            await asyncio.to_thread(webhook_archive.archive, pms.name, request.body, payload_cleaned.get("HotelId"))
+
+        if settings.WEBHOOK_ASYNC_PROCESSING:
+            if payload_cleaned:
+                with metrics.stage("enqueue", pms.name):
+                    await sync_to_async(webhook_queue.enqueue)(pms.name, payload_cleaned)
+                response = HttpResponse("Accepted.", status=202)
+            else:
+                response = HttpResponse(status=400)
+        elif await pms.ahandle_webhook(payload_cleaned):
+            response = HttpResponse("Thanks for the update.")
+        else:
+            response = HttpResponse(status=400)
+
+    if settings.METRICS_ENABLED:
+        metrics.WEBHOOK_REQUESTS.labels(pms.name, str(response.status_code)).inc()
+    return response
+
+
+async_webhook.csrf_exempt = True
+
+
+def service_token_required(setting: str):
+    """
+    Only let requests through with an "Authorization: Bearer <token>" header, for one of the tokens in the
+    setting. Answers 401 otherwise, also when the setting has no tokens.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+            tokens = getattr(settings, setting)
+            # Compare every token in constant time, the response time doesn't reveal a valid prefix
+            valid = [hmac.compare_digest(token.encode(), allowed.encode()) for allowed in tokens]
+            if scheme.lower() != "bearer" or not any(valid):
+                response = HttpResponse("Unauthorized", status=401)
+                response["WWW-Authenticate"] = "Bearer"
+                return response
+            return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@require_GET
+@service_token_required("ARRIVALS_API_TOKENS")
+def hotel_arrivals(request, hotel_id):
+    """
+    The stays checking in at a hotel on a date: /hotels/<hotel_id>/arrivals/?date=YYYY-MM-DD
+    The stays include guest names and phone numbers, requests need a token of ARRIVALS_API_TOKENS.
+    Optional parameters:
+        status: only stays with this Stay.Status, can be repeated
+        limit: the number of stays per page, at most ARRIVALS_MAX_PAGE_SIZE
+        cursor: the next_cursor of the previous page
+    """
+    checkin = parse_date(request.GET.get("date"))
+    if checkin is INVALID:
+        return HttpResponseBadRequest("date should have the format YYYY-MM-DD")
+
+    statuses = request.GET.getlist("status")
+    if not set(statuses) <= set(Stay.Status.values):
+        return HttpResponseBadRequest(f"status should be one of {', '.join(Stay.Status.values)}")
+
+    try:
+        after = int(request.GET["cursor"]) if "cursor" in request.GET else None
+        limit = int(request.GET.get("limit", settings.ARRIVALS_PAGE_SIZE))
+    except ValueError:
+        return HttpResponseBadRequest("cursor and limit should be numbers")
+    if not 1 <= limit <= settings.ARRIVALS_MAX_PAGE_SIZE:
+        return HttpResponseBadRequest(f"limit should be between 1 and {settings.ARRIVALS_MAX_PAGE_SIZE}")
+
+    try:
+        page = arrivals.arrivals_page(hotel_id, checkin, statuses, after, limit)
+    except Hotel.DoesNotExist:
+        raise Http404(f"Unknown hotel: {hotel_id}")
+    return JsonResponse(page)
+
+
+@require_GET
+@service_token_required("METRICS_API_TOKENS")
+def prometheus_metrics(request):
+    """
+    The metrics of this process in the Prometheus text format, see hotel.metrics.
+    Requests need a token of METRICS_API_TOKENS.
+    """
+    if not settings.METRICS_ENABLED:
+        raise Http404("Metrics are disabled")
+    return HttpResponse(metrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,386 @@
+import atexit
+import base64
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+from django.conf import settings
+from django.db import connection
+
+from hotel import write_buffer
+from hotel.pms_systems import PMS
+
+"""
+Append-only archive of the raw webhook bodies, so the traffic of a PMS can be replayed after an outage
+or a bug (see the replay_webhooks management command).
+
+Every process appends to its own segment, a gzipped file with one JSON record per line:
+    WEBHOOK_ARCHIVE_DIR/<pms>/<YYYY-MM-DD>/<HHMMSS>-<host>-<pid>-<n>.jsonl.gz
+Records are flushed as they are written, a process that dies loses at most the record it was writing.
+Segments are rotated at WEBHOOK_ARCHIVE_SEGMENT_BYTES (uncompressed) or WEBHOOK_ARCHIVE_SEGMENT_SECONDS
+and at midnight. A closed segment gets a sidecar index (<segment>.index.json) with its time range and
+the records per hotel, so readers skip the segments outside a time range or without the hotels.
+Segments without an index are being written or belonged to a process that died, readers scan them.
+
+Day directories older than WEBHOOK_ARCHIVE_RETENTION_DAYS are deleted by prune(), see the
+prune_webhook_archive management command.
+
+Replaying is safe in any order: handle_webhook fetches the current reservation details from the PMS,
+an old webhook doesn't bring back old data.
+"""
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".jsonl.gz"
+INDEX_SUFFIX = ".index.json"
+
+
+class ArchivedWebhook(NamedTuple):
+    received_at: float
+    pms_name: str
+    hotel_id: Optional[str]
+    body: bytes
+
+
+def encode(webhook: ArchivedWebhook) -> bytes:
+    try:
+        body = {"body": webhook.body.decode()}
+    except UnicodeDecodeError:
+        body = {"body_b64": base64.b64encode(webhook.body).decode()}
+    record = {"t": webhook.received_at, "pms": webhook.pms_name, "hotel": webhook.hotel_id, **body}
+    return json.dumps(record, separators=(",", ":")).encode() + b"\n"
+
+
+def decode(line: bytes) -> ArchivedWebhook:
+    record = json.loads(line)
+    body = record["body"].encode() if "body" in record else base64.b64decode(record["body_b64"])
+    return ArchivedWebhook(record["t"], record["pms"], record["hotel"], body)
+
+
+class Segment:
+    """
+    The segment a process is appending to. Not thread-safe, see ArchiveWriter.
+    """
+
+    def __init__(self, path: Path, opened_at: float):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.opened_at = opened_at
+        self.day = datetime.date.fromtimestamp(opened_at)
+        self._file = gzip.open(path, "ab", compresslevel=6)
+        self.bytes = 0
+        self.records = 0
+        self.start = None
+        self.end = None
+        self.hotels = Counter()
+
+    def append(self, webhook: ArchivedWebhook) -> None:
+        data = encode(webhook)
+        self._file.write(data)
+        # A sync flush makes everything written so far readable, without resetting the compression
+        self._file.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes += len(data)
+        self.records += 1
+        self.start = webhook.received_at if self.start is None else min(self.start, webhook.received_at)
+        self.end = webhook.received_at if self.end is None else max(self.end, webhook.received_at)
+        self.hotels[webhook.hotel_id or ""] += 1
+
+    def close(self) -> None:
+        self._file.close()
+        if not self.records:
+            self.path.unlink(missing_ok=True)
+            return
+        if not self.path.parent.is_dir():
+            # Pruned while this process was idle
+            return
+        index = {"start": self.start, "end": self.end, "records": self.records, "hotels": dict(self.hotels)}
+        index_path = self.path.with_name(self.path.name + INDEX_SUFFIX)
+        # Write the index under a temporary name, readers never see a partial index
+        tmp_path = index_path.with_name(index_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(index))
+        tmp_path.replace(index_path)
+
+
+class ArchiveWriter:
+    """
+    Appends webhooks to the current segment of this process and rotates it. Shared by the threads of a process:
+    they compress and flush their webhooks one at a time.
+    """
+
+    def __init__(self, root: Path, max_bytes: int, max_seconds: float):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._segments = {}
+        self._counter = 0
+
+    def append(self, webhook: ArchivedWebhook) -> None:
+        with self._lock:
+            segment = self._segments.get(webhook.pms_name)
+            if segment is not None and self._should_rotate(segment, webhook.received_at):
+                segment.close()
+                segment = None
+            if segment is None:
+                segment = self._segments[webhook.pms_name] = self._open(webhook.pms_name, webhook.received_at)
+            segment.append(webhook)
+
+    def close(self) -> None:
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+
+    def _should_rotate(self, segment: Segment, now: float) -> bool:
+        return (
+            segment.bytes >= self.max_bytes
+            or now - segment.opened_at >= self.max_seconds
+            or datetime.date.fromtimestamp(now) != segment.day
+        )
+
+    def _open(self, pms_name: str, now: float) -> Segment:
+        self._counter += 1
+        opened = datetime.datetime.fromtimestamp(now)
+        name = f"{opened:%H%M%S}-{socket.gethostname()}-{self.pid}-{self._counter}{SEGMENT_SUFFIX}"
+        return Segment(self.root / pms_name / f"{opened:%Y-%m-%d}" / name, now)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> Optional[ArchiveWriter]:
+    """
+    The writer of this process, None when the archive is disabled. A forked process gets its own writer.
+    """
+    global _writer
+    if not settings.WEBHOOK_ARCHIVE_DIR:
+        return None
+    with _writer_lock:
+        if _writer is None or _writer.pid != os.getpid() or _writer.root != Path(settings.WEBHOOK_ARCHIVE_DIR):
+            if _writer is not None and _writer.pid == os.getpid():
+                _writer.close()
+            _writer = ArchiveWriter(
+                settings.WEBHOOK_ARCHIVE_DIR,
+                settings.WEBHOOK_ARCHIVE_SEGMENT_BYTES,
+                settings.WEBHOOK_ARCHIVE_SEGMENT_SECONDS,
+            )
+            atexit.register(_writer.close)
+        return _writer
+
+
+def close() -> None:
+    """
+    Close the segments of this process, the next webhook starts new ones.
+    """
+    with _writer_lock:
+        if _writer is not None and _writer.pid == os.getpid():
+            _writer.close()
+
+
+def archive(pms_name: str, body: bytes, hotel_id: Optional[str] = None) -> None:
+    """
+    Archive the raw body of a webhook. Failures are logged, they never fail the webhook.
+    """
+    try:
+        writer = get_writer()
+        if writer is not None:
+            writer.append(ArchivedWebhook(time.time(), pms_name, hotel_id, bytes(body)))
+    except Exception:
+        logger.exception("Could not archive a %s webhook", pms_name)
+
+
+def segments(
+    pms_name: str,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    hotel_ids: Optional[Iterable[str]] = None,
+    root: Optional[Path] = None,
+) -> list[Path]:
+    """
+    The segments of the PMS that can have webhooks received between since and until (timestamps) for
+    the hotels, oldest first. Only the day directories of the range are listed, and the indexes of
+    closed segments are used to skip the rest.
+    """
+    root = Path(root or settings.WEBHOOK_ARCHIVE_DIR) / pms_name
+    if not root.is_dir():
+        return []
+    hotel_ids = set(hotel_ids) if hotel_ids is not None else None
+    first_day = datetime.date.fromtimestamp(since).isoformat() if since is not None else ""
+    last_day = datetime.date.fromtimestamp(until).isoformat() if until is not None else "9999"
+
+    found = []
+    for day in sorted(path for path in root.iterdir() if path.is_dir()):
+        if not first_day <= day.name <= last_day:
+            continue
+        for path in day.glob("*" + SEGMENT_SUFFIX):
+            index_path = path.with_name(path.name + INDEX_SUFFIX)
+            start = None
+            if index_path.exists():
+                index = json.loads(index_path.read_text())
+                start = index["start"]
+                if since is not None and index["end"] < since or until is not None and start > until:
+                    continue
+                if hotel_ids is not None and not hotel_ids & set(index["hotels"]):
+                    continue
+            found.append((start if start is not None else path.stat().st_mtime, path))
+    return [path for _, path in sorted(found)]
+
+
+def prune(
+    retention_days: int, root: Optional[Path] = None, today: Optional[datetime.date] = None, dry_run: bool = False
+) -> list[Path]:
+    """
+    Delete the day directories of every PMS that are more than retention_days before today, and return them.
+    Segments are rotated at midnight, so only processes that have been idle since then still have a segment
+    open in those directories; they don't write to it again.
+    """
+    if retention_days < 1:
+        raise ValueError("Keep at least the archive of today and yesterday, retention_days must be 1 or more")
+    root = Path(root or settings.WEBHOOK_ARCHIVE_DIR)
+    if not root.is_dir():
+        return []
+    oldest_day = ((today or datetime.date.today()) - datetime.timedelta(days=retention_days)).isoformat()
+
+    pruned = []
+    for pms_root in sorted(path for path in root.iterdir() if path.is_dir()):
+        for day in sorted(path for path in pms_root.iterdir() if path.is_dir()):
+            if day.name >= oldest_day:
+                break
+            if not dry_run:
+                shutil.rmtree(day)
+            pruned.append(day)
+    return pruned
+
+
+def read_segment(path: Path) -> Iterator[ArchivedWebhook]:
+    """
+    The webhooks of a segment, in the order they were written. A segment that is being written or
+    whose process died ends with an incomplete record, the records before it are returned.
+    """
+    with gzip.open(path, "rb") as f:
+        try:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                yield decode(line)
+        except (EOFError, zlib.error, gzip.BadGzipFile):
+            # The end of the data that was flushed
+            return
+
+
+def read(
+    pms_name: str,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    hotel_ids: Optional[Iterable[str]] = None,
+    root: Optional[Path] = None,
+) -> Iterator[ArchivedWebhook]:
+    """
+    Stream the webhooks of the PMS received between since and until for the hotels (all by default).
+    Segments are read one after the other, webhooks of processes that ran at the same time are not merged
+    in time order.
+    """
+    hotel_ids = set(hotel_ids) if hotel_ids is not None else None
+    for path in segments(pms_name, since, until, hotel_ids, root):
+        for webhook in read_segment(path):
+            if since is not None and webhook.received_at < since or until is not None and webhook.received_at > until:
+                continue
+            if hotel_ids is not None and webhook.hotel_id not in hotel_ids:
+                continue
+            yield webhook
+
+
+def payload_digest(payload: dict) -> bytes:
+    """
+    Identifies a cleaned payload: webhooks that were delivered twice, or that only differ in fields
+    the PMS doesn't use, have the same digest.
+    """
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True, default=str).encode(), digest_size=16).digest()
+
+
+def replay(
+    pms: PMS,
+    webhooks: Iterable[ArchivedWebhook],
+    workers: int = 4,
+    batch_size: int = 100,
+    dry_run: bool = False,
+    progress: Optional[Callable[[Counter], None]] = None,
+) -> Counter:
+    """
+    Clean the webhooks and handle them again, in batches of batch_size payloads on `workers` threads.
+    Payloads that were replayed already are skipped, and the rows of a batch are written in one transaction.
+    Returns the counts of read, invalid, duplicate, handled and failed (or incomplete) webhooks.
+    """
+    counts = Counter()
+    seen = set()
+
+    def batches() -> Iterator[list[dict]]:
+        batch = []
+        for webhook in webhooks:
+            counts["read"] += 1
+            payload = pms.clean_webhook_payload(webhook.body)
+            if not payload:
+                counts["invalid"] += 1
+                continue
+            digest = payload_digest(payload)
+            if digest in seen:
+                counts["duplicate"] += 1
+                continue
+            seen.add(digest)
+            batch.append(payload)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def handle(batch: list[dict]) -> Counter:
+        result = Counter()
+        # Flushed once at the end of the batch
+        buffer = write_buffer.WriteBehindBuffer(max_rows=float("inf"), max_delay=float("inf"))
+        try:
+            with write_buffer.buffered(buffer):
+                for payload in batch:
+                    result["handled" if pms.handle_webhook(payload) else "failed"] += 1
+            buffer.flush()
+        except Exception:
+            logger.exception("Replaying a batch of %s %s webhooks failed", len(batch), pms.name)
+            result = Counter(failed=len(batch))
+        finally:
+            # Connections are per thread, don't leave them open in the pool
+            connection.close()
+        return result
+
+    def collect(futures) -> None:
+        for future in futures:
+            counts.update(future.result())
+        if progress is not None:
+            progress(counts)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = set()
+        for batch in batches():
+            if dry_run:
+                counts["handled"] += len(batch)
+                continue
+            pending.add(executor.submit(handle, batch))
+            # Reading ahead of the workers would only fill the memory
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(wait(pending).done)
+    return counts
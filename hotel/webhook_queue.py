@@ -0,0 +1,262 @@
+import datetime
+import logging
+import time
+import uuid
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from hotel import metrics, pms_systems, write_buffer
+from hotel.models import WebhookEvent
+
+"""
+Durable queue for webhook payloads, stored in the database as WebhookEvent rows.
+The webhook view enqueues cleaned payloads and answers right away, the workers started by
+the `process_webhooks` management command claim events and call PMS.handle_webhook.
+Workers buffer the writes of the events they handle, and mark the events done in the same
+transaction that writes their rows.
+
+A new event waits WEBHOOK_COALESCE_WINDOW seconds before a worker can claim it. Payloads of the same
+hotel that arrive in the meantime are merged into it, so repeated events for a reservation seconds
+apart are fetched once, after the window, with its latest details (see also hotel.coalescing).
+"""
+
+logger = logging.getLogger(__name__)
+
+COALESCED_EVENTS = metrics.registry.counter(
+    "hotel_webhook_events_coalesced_total",
+    "Queued reservation events merged into a waiting event: duplicates are fetches saved.",
+    ("pms", "kind"),
+)
+
+
+class Failure(NamedTuple):
+    error: str
+    # Set when the circuit breaker of the PMS rejected calls of the event: the seconds until it lets calls through
+    retry_after: Optional[float] = None
+
+
+def enqueue(pms_name: str, payload: dict) -> WebhookEvent:
+    """
+    Store a cleaned webhook payload so a worker can handle it later, or merge it into the waiting
+    event of the same hotel.
+    """
+    window = settings.WEBHOOK_COALESCE_WINDOW
+    if window <= 0 or not payload.get("HotelId"):
+        return WebhookEvent.objects.create(pms_name=pms_name, payload=payload)
+
+    with transaction.atomic():
+        now = timezone.now()
+        # Events that were never claimed, until their window closes. Claims only take available events,
+        # and run in their own transaction: a merged payload is never missed by a worker.
+        waiting = (
+            WebhookEvent.objects.select_for_update()
+            .filter(
+                pms_name=pms_name,
+                status=WebhookEvent.Status.PENDING,
+                attempts=0,
+                available_at__gt=now,
+                payload__HotelId=payload["HotelId"],
+            )
+            .order_by("id")
+            .first()
+        )
+        if waiting is None:
+            return WebhookEvent.objects.create(
+                pms_name=pms_name, payload=payload, available_at=now + datetime.timedelta(seconds=window)
+            )
+
+        reservation_ids = waiting.payload.get("ReservationIds", [])
+        new_ids = list(payload.get("ReservationIds", []))
+        waiting.payload = {**waiting.payload, "ReservationIds": list(dict.fromkeys(reservation_ids + new_ids))}
+        waiting.save(update_fields=["payload", "updated_at"])
+
+    if settings.METRICS_ENABLED:
+        duplicates = len(new_ids) - (len(waiting.payload["ReservationIds"]) - len(reservation_ids))
+        COALESCED_EVENTS.labels(pms_name, "duplicate").inc(duplicates)
+        COALESCED_EVENTS.labels(pms_name, "merged").inc(len(new_ids) - duplicates)
+    return waiting
+
+
+def claim(batch_size: int, lease_seconds: int) -> list[WebhookEvent]:
+    """
+    Claim up to batch_size events that are available for processing.
+    Events that are still PROCESSING after their lease expired belong to a worker that died,
+    they are claimed again. Every claim gets a unique token, so two workers never get
+    the same event during the same lease.
+    """
+    now = timezone.now()
+    available = Q(status=WebhookEvent.Status.PENDING) | Q(status=WebhookEvent.Status.PROCESSING)
+    available &= Q(available_at__lte=now)
+    token = uuid.uuid4().hex
+
+    with transaction.atomic():
+        ids = list(
+            WebhookEvent.objects.filter(available)
+            .order_by("available_at", "id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not ids:
+            return []
+        # The filter is repeated in the update: if another worker claimed the event in the meantime,
+        # it is not available anymore and the update skips it.
+        WebhookEvent.objects.filter(available, id__in=ids).update(
+            status=WebhookEvent.Status.PROCESSING,
+            available_at=now + datetime.timedelta(seconds=lease_seconds),
+            claim_token=token,
+            attempts=F("attempts") + 1,
+            updated_at=now,
+        )
+
+    return list(WebhookEvent.objects.filter(claim_token=token).order_by("id"))
+
+
+def complete(event: WebhookEvent) -> None:
+    _finish(event, status=WebhookEvent.Status.DONE, last_error="")
+
+
+def complete_many(events: list[WebhookEvent]) -> None:
+    """
+    complete() for many events, with one update per claim.
+    """
+    by_token = {}
+    for event in events:
+        by_token.setdefault(event.claim_token, []).append(event.pk)
+    for token, ids in by_token.items():
+        WebhookEvent.objects.filter(pk__in=ids, claim_token=token).update(
+            status=WebhookEvent.Status.DONE, last_error="", claim_token=None, updated_at=timezone.now()
+        )
+
+
+def fail(event: WebhookEvent, error: str, retry_after: Optional[float] = None) -> None:
+    """
+    Make the event available again after a backoff, or mark it FAILED when it ran out of attempts.
+    With retry_after, the circuit breaker rejected the calls of the event without making them: the event
+    is available again after retry_after seconds, and the attempt doesn't count.
+    """
+    if retry_after is not None:
+        _finish(
+            event,
+            status=WebhookEvent.Status.PENDING,
+            last_error=error,
+            available_at=timezone.now() + datetime.timedelta(seconds=retry_after),
+            attempts=F("attempts") - 1,
+        )
+        return
+
+    if event.attempts >= settings.WEBHOOK_QUEUE_MAX_ATTEMPTS:
+        _finish(event, status=WebhookEvent.Status.FAILED, last_error=error)
+        return
+
+    backoff = settings.WEBHOOK_QUEUE_RETRY_BACKOFF * 2 ** (event.attempts - 1)
+    _finish(
+        event,
+        status=WebhookEvent.Status.PENDING,
+        last_error=error,
+        available_at=timezone.now() + datetime.timedelta(seconds=backoff),
+    )
+
+
+def _finish(event: WebhookEvent, **fields) -> None:
+    # Only the worker holding the current claim may change the event. When the lease expired and
+    # another worker claimed it again, this update does nothing and the other worker takes over.
+    WebhookEvent.objects.filter(pk=event.pk, claim_token=event.claim_token).update(
+        claim_token=None, updated_at=timezone.now(), **fields
+    )
+
+
+def handle_event(event: WebhookEvent) -> Optional[Failure]:
+    """
+    Handle a single claimed event, returns the Failure or None when it succeeded.
+    The outcome is not recorded on the event.
+    """
+    breaker = None
+    try:
+        pms = pms_systems.get_pms(event.pms_name)
+        breaker = pms.api.breaker
+        rejected = breaker.rejected
+        # A retried event may have lost its writes in a failed flush, its reservations are always fetched
+        success = pms.handle_webhook(event.payload, retry=event.attempts > 1)
+        error = None if success else "handle_webhook returned False"
+    except Exception as e:
+        logger.exception("Webhook event %s raised an exception", event.pk)
+        error = f"{e.__class__.__name__}: {e}"
+
+    if error is None:
+        return None
+    if breaker is not None and breaker.rejected > rejected:
+        return Failure(error, breaker.retry_after())
+    return Failure(error)
+
+
+def process_event(event: WebhookEvent) -> bool:
+    """
+    Handle a single claimed event and record the outcome on the event.
+    """
+    failure = handle_event(event)
+    if failure is not None:
+        fail(event, *failure)
+        return False
+
+    complete(event)
+    return True
+
+
+def flush(buffer: write_buffer.WriteBehindBuffer, events: list[WebhookEvent]) -> None:
+    """
+    Write the buffered rows of the handled events and mark the events done, in one transaction.
+    When the write fails, the events are retried.
+    """
+    try:
+        with transaction.atomic():
+            buffer.flush()
+            complete_many(events)
+    except Exception as e:
+        logger.exception("Writing the rows of %s webhook events failed", len(events))
+        for event in events:
+            fail(event, f"{e.__class__.__name__}: {e}")
+
+
+def run_worker(
+    batch_size: int = 10,
+    lease_seconds: int = 60,
+    poll_interval: float = 1.0,
+    once: bool = False,
+    should_stop=lambda: False,
+) -> int:
+    """
+    Process events until should_stop() returns True. With once=True, return as soon as the queue is empty.
+    The writes of successful events are buffered until WRITE_BUFFER_MAX_ROWS rows are buffered,
+    WRITE_BUFFER_MAX_DELAY seconds passed or the queue is empty. Returns the number of processed events.
+    """
+    processed = 0
+    buffer = write_buffer.WriteBehindBuffer(settings.WRITE_BUFFER_MAX_ROWS, settings.WRITE_BUFFER_MAX_DELAY)
+    handled = []
+
+    with write_buffer.buffered(buffer):
+        while not should_stop():
+            events = claim(batch_size, lease_seconds)
+            for event in events:
+                failure = handle_event(event)
+                if failure is None:
+                    handled.append(event)
+                else:
+                    fail(event, *failure)
+                processed += 1
+
+            if handled and (not events or buffer.should_flush()):
+                flush(buffer, handled)
+                handled = []
+
+            if not events:
+                if once:
+                    break
+                time.sleep(poll_interval)
+
+        if handled:
+            flush(buffer, handled)
+
+    return processed
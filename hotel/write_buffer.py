@@ -0,0 +1,95 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, Optional
+
+from django.db import transaction
+
+from hotel.bulk import ReservationRow, upsert_reservations
+
+"""
+Write-behind buffering of cleaned reservations. Webhook events usually update a handful of reservations,
+writing every event on its own costs a transaction (and an fsync) per event and makes the writers
+queue up for the SQLite write lock. A WriteBehindBuffer collects the rows of many events and writes them
+in one transaction.
+
+The webhook workers (see hotel.webhook_queue.run_worker) activate a buffer with buffered(). Without an
+active buffer, write_reservations writes right away.
+"""
+
+_active_buffer: ContextVar[Optional["WriteBehindBuffer"]] = ContextVar("write_buffer", default=None)
+
+
+class WriteBehindBuffer:
+    """
+    Collects ReservationRows until the owner flushes them. should_flush() is True when max_rows rows
+    are buffered or the oldest row waited max_delay seconds. Buffered rows are lost when the process dies,
+    so only report work as done after the flush that wrote it.
+    """
+
+    def __init__(self, max_rows: int, max_delay: float):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._rows = []
+        self._first_added_at = None
+        self.flushes = 0
+        self.rows_flushed = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, rows: Iterable[ReservationRow]) -> None:
+        rows = list(rows)
+        with self._lock:
+            if rows and not self._rows:
+                self._first_added_at = time.monotonic()
+            self._rows.extend(rows)
+
+    def should_flush(self) -> bool:
+        with self._lock:
+            if not self._rows:
+                return False
+            return len(self._rows) >= self.max_rows or time.monotonic() - self._first_added_at >= self.max_delay
+
+    def flush(self) -> int:
+        """
+        Write all buffered rows in one transaction, returns the number of written Stays.
+        The rows are taken out of the buffer first: when the write fails they are dropped,
+        the caller should retry the work that produced them.
+        """
+        with self._lock:
+            rows, self._rows = self._rows, []
+            self._first_added_at = None
+        if not rows:
+            return 0
+
+        with transaction.atomic():
+            written = upsert_reservations(rows)
+        self.flushes += 1
+        self.rows_flushed += len(rows)
+        return written
+
+
+@contextmanager
+def buffered(buffer: WriteBehindBuffer):
+    """
+    Send the writes of write_reservations in this thread (or task) to the buffer. Doesn't flush at the end.
+    """
+    token = _active_buffer.set(buffer)
+    try:
+        yield buffer
+    finally:
+        _active_buffer.reset(token)
+
+
+def write_reservations(rows: Iterable[ReservationRow]) -> None:
+    """
+    Add the rows to the active buffer, or write them right away when there is none.
+    """
+    buffer = _active_buffer.get()
+    if buffer is None:
+        upsert_reservations(rows)
+    else:
+        buffer.add(rows)
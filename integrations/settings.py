@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -76,11 +77,25 @@ WSGI_APPLICATION = "integrations.wsgi.application"
 
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
+        # django.db.backends.sqlite3, with transactions that wait for the write lock (see the module)
+        "ENGINE": "integrations.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Keep connections open between requests instead of reconnecting (and re-applying SQLITE_PRAGMAS)
+        "CONN_MAX_AGE": 60,
     }
 }
 
+# High-write profile for SQLite, applied to every new connection (see hotel.signals).
+# WAL lets readers continue while a webhook worker writes, and with synchronous=NORMAL a commit
+# doesn't wait for an fsync (a power loss can lose the last commits, but not corrupt the database).
+# Writers wait up to busy_timeout milliseconds for the write lock instead of failing with "database is locked".
+# Set to {} for the SQLite defaults.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 20_000,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -122,3 +137,116 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+
+# Webhooks
+# When WEBHOOK_ASYNC_PROCESSING is enabled, the webhook view only validates and queues the payload.
+# The queued events are handled by the workers of: python manage.py process_webhooks
+
+WEBHOOK_ASYNC_PROCESSING = False
+
+WEBHOOK_QUEUE_MAX_ATTEMPTS = 5
+
+# Seconds a queued webhook event waits for more events of the same hotel, which are merged into it:
+# a reservation that is updated repeatedly within the window is fetched once. 0 handles every event
+# as soon as possible.
+WEBHOOK_COALESCE_WINDOW = 2
+
+# Seconds before the first retry of a failed event, doubled on every next attempt
+WEBHOOK_QUEUE_RETRY_BACKOFF = 5
+
+# Set WEBHOOK_ARCHIVE_DIR to archive the raw webhook bodies in compressed segments under that directory,
+# so they can be replayed (see hotel.webhook_archive and the replay_webhooks command). Off by default.
+# Every webhook is compressed and flushed under one lock per process, so the webhooks of a process are
+# archived one at a time: about 35 microseconds for a 0.5 kB body, at most some 30,000 webhooks a second.
+# A segment is closed after this many uncompressed bytes or seconds.
+WEBHOOK_ARCHIVE_DIR = os.environ.get("WEBHOOK_ARCHIVE_DIR") or None
+WEBHOOK_ARCHIVE_SEGMENT_BYTES = 64 * 1024 * 1024
+WEBHOOK_ARCHIVE_SEGMENT_SECONDS = 60 * 60
+
+# Days of archived webhooks kept by the prune_webhook_archive command, which should run daily. None keeps all
+WEBHOOK_ARCHIVE_RETENTION_DAYS = 30
+
+
+# PMS integrations
+
+# The maximum number of concurrent external API calls per PMS operation (e.g. one webhook)
+PMS_MAX_CONCURRENCY = 10
+
+# Reservations written per transaction by hotel.bulk.upsert_reservations
+BULK_UPSERT_CHUNK_SIZE = 500
+
+# Times hotel.guests.resolve_guests looks up and merges new guests again that another writer inserted first
+GUEST_RESOLVE_ATTEMPTS = 3
+
+# Cache of guest details by PMS GuestId. Set GUEST_CACHE_SHARED_PATH to a file, e.g.
+# BASE_DIR / "guest_cache.sqlite3", to share the cache between worker processes.
+GUEST_CACHE_TTL = 60 * 60
+GUEST_CACHE_MAXSIZE = 10_000
+GUEST_CACHE_SHARED_PATH = None
+
+# Retry policy of the external API clients, see hotel.api_client
+API_RETRY_ATTEMPTS = 3
+API_RETRY_BASE_DELAY = 0.1
+API_RETRY_MAX_DELAY = 2
+# Retries (and hedged requests) are limited to this fraction of all calls
+API_RETRY_BUDGET_RATIO = 0.2
+# Consecutive failures before calls to a PMS are rejected, and seconds before calls are tried again
+API_CIRCUIT_FAILURE_THRESHOLD = 5
+API_CIRCUIT_RESET_TIMEOUT = 30
+# Seconds after which a slow call is duplicated, None to disable hedging
+API_HEDGE_AFTER = None
+# Calls per second to every endpoint of a PMS API, None for no limit. API_RATE_LIMITS overrides it
+# per endpoint, e.g. {"Mews.get_guest_details": 50}. Bursts of API_RATE_BURST calls are allowed.
+API_RATE_LIMIT = None
+API_RATE_LIMITS = {}
+API_RATE_BURST = 10
+# Concurrent calls per endpoint start at PMS_MAX_CONCURRENCY and adapt between these bounds: the limit
+# grows while calls succeed and is multiplied by API_CONCURRENCY_BACKOFF on an APIError while the recent
+# error rate is above API_ERROR_RATE_THRESHOLD, or on a call slower than API_LATENCY_TARGET seconds
+# (None to only back off on errors).
+API_CONCURRENCY_MIN = 1
+API_CONCURRENCY_MAX = 50
+API_CONCURRENCY_BACKOFF = 0.5
+API_ERROR_RATE_THRESHOLD = 0.2
+API_LATENCY_TARGET = None
+
+# Process-local cache of Hotels by pms_hotel_id. Saving a Hotel clears the cache of the saving
+# process, other processes see the change after at most HOTEL_CACHE_TTL seconds.
+# Unknown IDs are cached for HOTEL_CACHE_MISS_TTL seconds, so a new hotel is found soon everywhere (0 disables it).
+HOTEL_CACHE_MAXSIZE = 10_000
+HOTEL_CACHE_TTL = 5 * 60
+HOTEL_CACHE_MISS_TTL = 5
+
+# Metrics of the hot paths, served at /metrics in the Prometheus text format (see hotel.metrics)
+METRICS_ENABLED = True
+# The metrics reveal hotel IDs and traffic: scrapes need "Authorization: Bearer <token>" with one of these
+# tokens (comma separated in the environment). Without tokens every scrape is refused.
+METRICS_API_TOKENS = [token for token in os.environ.get("METRICS_API_TOKENS", "").split(",") if token]
+# Label stage timings with the hotel. Every hotel adds series to every stage, only turn it on for a few hotels.
+METRICS_HOTEL_LABELS = False
+# Fraction of webhook requests that is profiled with cProfile, 0 to disable. The profile is logged
+# when the request takes longer than METRICS_PROFILE_SLOW_SECONDS.
+METRICS_PROFILE_SAMPLE_RATE = 0
+METRICS_PROFILE_SLOW_SECONDS = 1.0
+
+# Webhook workers buffer the rows of the events they handle and write them in one transaction,
+# when this many rows are buffered or the oldest row waited this many seconds (see hotel.write_buffer).
+# Keep the delay well below the lease of the process_webhooks command.
+WRITE_BUFFER_MAX_ROWS = 500
+WRITE_BUFFER_MAX_DELAY = 1.0
+
+# Pages of the arrivals endpoint are cached in the default cache for ARRIVALS_CACHE_TTL seconds, and
+# invalidated when a Stay of the hotel and date is written. With the default (local memory) cache that
+# invalidation only reaches the writing process, configure a shared CACHES backend when running more.
+ARRIVALS_CACHE_TTL = 30
+ARRIVALS_PAGE_SIZE = 100
+ARRIVALS_MAX_PAGE_SIZE = 500
+
+# The arrivals endpoint serves guest names and phone numbers: requests need "Authorization: Bearer <token>"
+# with one of these tokens (comma separated in the environment). Without tokens every request is refused.
+ARRIVALS_API_TOKENS = [token for token in os.environ.get("ARRIVALS_API_TOKENS", "").split(",") if token]
+
+# The sync_arrivals command skips hotels and dates that were synced less than this many seconds ago.
+# With --days, run it more often than this to keep the window fresh and retry the dates that failed.
+ARRIVALS_SYNC_MAX_AGE = 6 * 60 * 60
@@ -0,0 +1,16 @@
+from django.db.backends.sqlite3 import base
+
+"""
+The SQLite backend of Django, but transactions start with BEGIN IMMEDIATE.
+
+A deferred transaction (plain BEGIN) that reads first and writes later can't wait for the write lock:
+when another connection wrote in the meantime, SQLite fails with "database is locked" right away,
+whatever the busy_timeout. BEGIN IMMEDIATE takes the write lock at the start of the transaction,
+so concurrent writers wait for each other instead. Django 5.1 has this built in, as the
+"transaction_mode" option.
+"""
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
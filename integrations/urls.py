@@ -21,4 +21,7 @@ from hotel import views
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("webhook/<str:pms_name>/", views.webhook, name="webhook"),
+    path("webhook/async/<str:pms_name>/", views.async_webhook, name="async_webhook"),
+    path("hotels/<int:hotel_id>/arrivals/", views.hotel_arrivals, name="hotel_arrivals"),
+    path("metrics", views.prometheus_metrics, name="metrics"),
 ]